@@ -0,0 +1,515 @@
+"""Benchmark y generador de carga offline para LocationBot.
+
+Levanta un servidor local que imita la Bot API de Telegram (latencia,
+límites 429 por chat y fallos de edición), registra hogares sintéticos y
+reproduce trayectos de ubicación en tiempo real a través de los handlers
+registrados en setup_handlers. Al final reporta throughput, latencias,
+llamadas a la API y memoria.
+
+Uso:
+    python benchmark.py --pairs 500 --duration 30 --interval 1
+    python benchmark.py --templates 100000   # solo textos de /start, /status y /time
+    python benchmark.py --pairs 500 --workers 4   # reparto entre procesos worker
+    python benchmark.py --broadcast 1000 --pool-size 8 --latency-ms 300 [--shared-pool]   # ediciones durante una difusión
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import secrets
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import parse_qsl
+
+FAKE_TOKEN = '123456:BENCHMARK'
+
+
+class FakeBotAPI:
+    """Servidor HTTP/1.1 mínimo (keep-alive) que responde como la Bot API"""
+
+    def __init__(self, latency_ms=30.0, jitter_ms=20.0, chat_rate=1.0, global_rate=30.0,
+                 edit_failure_rate=0.0, seed=0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        self.edit_failure_rate = edit_failure_rate
+        self.random = random.Random(seed)
+        self.calls = {}  # método -> cantidad
+        self.errors = {}  # código -> cantidad
+        self._message_ids = {}
+        self._chat_last = {}  # chat_id -> [instantes de los últimos envíos]
+        self._global_window = []
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path = request_line.split(b" ")[1].decode()
+                status, payload = await self._dispatch(path.rsplit('/', 1)[-1], body, headers)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _params(self, body, headers):
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    def _flooded(self, chat_id, now):
+        """Simula el control de flujo de Telegram: ventana de 1 s por chat y global"""
+        self._global_window = [t for t in self._global_window if now - t < 1]
+        recent = [t for t in self._chat_last.get(chat_id, ()) if now - t < 1]
+        if len(recent) >= max(1, self.chat_rate) or len(self._global_window) >= self.global_rate:
+            self._chat_last[chat_id] = recent
+            return True
+        recent.append(now)
+        self._chat_last[chat_id] = recent
+        self._global_window.append(now)
+        return False
+
+    def _error(self, code, description, **parameters):
+        self.errors[code] = self.errors.get(code, 0) + 1
+        payload = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return code, payload
+
+    def _message(self, chat_id, **fields):
+        message_id = self._message_ids.get(chat_id, 0) + 1
+        self._message_ids[chat_id] = message_id
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    async def _dispatch(self, method, body, headers):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+        params = self._params(body, headers)
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 123456, 'is_bot': True, 'first_name': 'weekbot', 'username': 'weekbot_bench'}}
+        if method in ('setWebhook', 'deleteWebhook', 'setMyCommands'):
+            return 200, {'ok': True, 'result': True}
+        if method == 'getUpdates':
+            await asyncio.sleep(1)
+            return 200, {'ok': True, 'result': []}
+
+        chat_id = params.get('chat_id', 0)
+        if self._flooded(chat_id, time.monotonic()):
+            return self._error(429, 'Too Many Requests: retry after 1', retry_after=1)
+
+        if method == 'sendMessage':
+            return 200, {'ok': True, 'result': self._message(chat_id, text=params.get('text', ''))}
+        if method == 'sendLocation':
+            location = {'latitude': params['latitude'], 'longitude': params['longitude']}
+            if params.get('live_period'):
+                location['live_period'] = params['live_period']
+            return 200, {'ok': True, 'result': self._message(chat_id, location=location)}
+        if method in ('editMessageLiveLocation', 'stopMessageLiveLocation', 'editMessageText'):
+            if self.random.random() < self.edit_failure_rate:
+                return self._error(400, "Bad Request: message can't be edited")
+            return 200, {'ok': True, 'result': True}
+        return self._error(404, 'Not Found: method not found')
+
+
+class MovementTrace:
+    """Trayecto sintético: camina/maneja con rumbo y velocidad que varían"""
+
+    def __init__(self, rng, latitude=-33.45, longitude=-70.66):
+        self.rng = rng
+        self.latitude = latitude + rng.uniform(-0.1, 0.1)
+        self.longitude = longitude + rng.uniform(-0.1, 0.1)
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.speed = rng.choice((0.0, 1.4, 8.0, 14.0))  # m/s: detenido, a pie, bus, auto
+
+    def step(self, seconds):
+        self.heading += self.rng.gauss(0, 0.3)
+        meters = self.speed * seconds + self.rng.gauss(0, 3)  # incluye ruido de GPS
+        self.latitude += meters * math.cos(self.heading) / 111_320
+        self.longitude += meters * math.sin(self.heading) / (111_320 * math.cos(math.radians(self.latitude)))
+        return self.latitude, self.longitude
+
+
+def location_update(update_id, user_id, latitude, longitude, edited, live_period=3600):
+    message = {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': int(user_id), 'type': 'private'},
+        'from': {'id': int(user_id), 'is_bot': False, 'first_name': f"U{user_id}"},
+        'location': {'latitude': latitude, 'longitude': longitude, 'live_period': live_period},
+    }
+    if edited:
+        message['edit_date'] = int(time.time())
+        return {'update_id': update_id, 'edited_message': message}
+    return {'update_id': update_id, 'message': message}
+
+
+async def run_benchmark(args):
+    fake_api = await FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate,
+        edit_failure_rate=args.edit_failure_rate,
+        seed=args.seed,
+    ).start()
+
+    # La configuración del bot se lee al importar el módulo
+    if args.pool_size:
+        os.environ['API_POOL_SIZE'] = str(args.pool_size)
+    if args.shared_pool:
+        os.environ['API_BROADCAST_POOL_SIZE'] = '0'
+    os.environ['BOT_TOKEN'] = FAKE_TOKEN
+    os.environ['TELEGRAM_API_URL'] = fake_api.url
+    os.environ['API_HTTP_VERSION'] = '1.1'  # la API falsa no entiende HTTP/2
+    os.environ.setdefault('STATE_BACKEND', 'memory')
+    os.environ.setdefault('HISTORY_DIR', tempfile.mkdtemp(prefix='weekbot-bench-'))
+    import bot_ubicacion
+    from telegram import Update
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    bot = bot_ubicacion.LocationBot(FAKE_TOKEN)
+    rng = random.Random(args.seed)
+    users = []
+    for pair in range(args.pairs):
+        first, second = str(1_000_000 + 2 * pair), str(1_000_001 + 2 * pair)
+        bot.registry.add_member(f"bench{pair}", first, 'esposo')
+        bot.registry.add_member(f"bench{pair}", second, 'esposa')
+        users.extend((first, second))
+    traces = {user_id: MovementTrace(rng) for user_id in users}
+
+    application = bot.application
+    update_id = 0
+    submitted = 0
+    async with application:
+        await application.start()
+        await bot.post_init(application)
+        started = time.perf_counter()
+
+        # Cada usuario comparte su ubicación en tiempo real y luego la edita
+        for user_id in users:
+            update_id += 1
+            latitude, longitude = traces[user_id].step(0)
+            await application.update_queue.put(Update.de_json(
+                location_update(update_id, user_id, latitude, longitude, edited=False), application.bot))
+            submitted += 1
+
+        rounds = max(1, int(args.duration / args.interval))
+        broadcast = None
+        for round_number in range(rounds):
+            if args.broadcast and round_number == rounds // 2:
+                # Difusión a chats sintéticos en medio del stream de ediciones
+                # Lote propio por corrida: con estado persistente la outbox no la toma por repetida
+                chat_ids = [str(9_000_000 + i) for i in range(args.broadcast)]
+                batch = f"benchmark-{secrets.token_hex(4)}"
+                broadcast = asyncio.create_task(
+                    bot.broadcast_location_request(chat_ids, "Benchmark", "difusión", batch))
+            round_started = time.perf_counter()
+            for user_id in users:
+                update_id += 1
+                latitude, longitude = traces[user_id].step(args.interval)
+                await application.update_queue.put(Update.de_json(
+                    location_update(update_id, user_id, latitude, longitude, edited=True), application.bot))
+                submitted += 1
+            await asyncio.sleep(max(0.0, args.interval - (time.perf_counter() - round_started)))
+        broadcast_report = await broadcast if broadcast is not None else None
+
+        # Esperar a que se vacíen la cola de updates y la de ediciones
+        while application.update_queue.qsize() or bot.live_updates._pending or bot.live_updates._in_flight:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        await bot.post_shutdown(application)
+        await application.stop()
+
+    await fake_api.stop()
+    result = report(args, bot, fake_api, submitted, elapsed)
+    if broadcast_report is not None:
+        result['broadcast'] = {key: broadcast_report[key] for key in ('total', 'delivered', 'retries', 'elapsed')}
+    return result
+
+
+async def run_sharded_benchmark(args):
+    """Igual que run_benchmark pero con UpdateRouter y `args.workers` procesos.
+
+    Los workers son procesos aparte, así que el reporte sale de lo que ve la
+    API falsa (llamadas y errores) y del tiempo hasta que todos terminan.
+    """
+    fake_api = await FakeBotAPI(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate,
+        edit_failure_rate=args.edit_failure_rate,
+        seed=args.seed,
+    ).start()
+
+    # Los workers heredan el entorno y comparten el estado por SQLite
+    workdir = tempfile.mkdtemp(prefix='weekbot-bench-')
+    os.environ['BOT_TOKEN'] = FAKE_TOKEN
+    os.environ['TELEGRAM_API_URL'] = fake_api.url
+    os.environ['API_HTTP_VERSION'] = '1.1'  # la API falsa no entiende HTTP/2
+    os.environ['STATE_BACKEND'] = 'sqlite'
+    os.environ['STATE_DB_PATH'] = os.path.join(workdir, 'state.db')
+    os.environ['HISTORY_DIR'] = os.path.join(workdir, 'historial')
+    import bot_ubicacion
+
+    state = bot_ubicacion.SQLiteStateStore(os.environ['STATE_DB_PATH'])
+    rng = random.Random(args.seed)
+    users = []
+    for pair in range(args.pairs):
+        first, second = str(1_000_000 + 2 * pair), str(1_000_001 + 2 * pair)
+        state.save_member(f"bench{pair}", first, 'esposo')
+        state.save_member(f"bench{pair}", second, 'esposa')
+        users.extend((first, second))
+    state.close()
+    traces = {user_id: MovementTrace(rng) for user_id in users}
+
+    router = bot_ubicacion.UpdateRouter(FAKE_TOKEN, args.workers)
+    router.start_workers()
+    # Cada worker pide getMe al iniciar su Application
+    while fake_api.calls.get('getMe', 0) < args.workers:
+        await asyncio.sleep(0.05)
+
+    update_id = 0
+    started = time.perf_counter()
+    for user_id in users:
+        update_id += 1
+        latitude, longitude = traces[user_id].step(0)
+        await router.submit(user_id, location_update(update_id, user_id, latitude, longitude, edited=False))
+
+    rounds = max(1, int(args.duration / args.interval))
+    for _ in range(rounds):
+        round_started = time.perf_counter()
+        for user_id in users:
+            update_id += 1
+            latitude, longitude = traces[user_id].step(args.interval)
+            await router.submit(user_id, location_update(update_id, user_id, latitude, longitude, edited=True))
+        await asyncio.sleep(max(0.0, args.interval - (time.perf_counter() - round_started)))
+
+    await router.stop_workers()
+    elapsed = time.perf_counter() - started
+    await fake_api.stop()
+    return {
+        'pairs': args.pairs,
+        'workers': args.workers,
+        'updates': update_id,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(update_id / elapsed, 1),
+        'router': router.stats,
+        'api_calls': dict(sorted(fake_api.calls.items())),
+        'api_errors': fake_api.errors,
+    }
+
+
+def report(args, bot, fake_api, submitted, elapsed):
+    metrics = bot.metrics
+    live_stats = bot.live_updates.snapshot()
+    result = {
+        'pairs': args.pairs,
+        'updates': submitted,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(submitted / elapsed, 1),
+        'handlers': {},
+        'api_calls': dict(sorted(fake_api.calls.items())),
+        'api_errors': fake_api.errors,
+        'live_updates': live_stats,
+        'movement': dict(bot.movement.stats),
+        'outbox': bot.outbox.snapshot(),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for name in metrics.labels('handler_seconds'):
+        p = metrics.percentiles('handler_seconds', name)
+        result['handlers'][name] = {
+            'count': metrics.count('handler_seconds_count', name),
+            'p50_ms': round(p[0.5] * 1000, 3),
+            'p95_ms': round(p[0.95] * 1000, 3),
+            'p99_ms': round(p[0.99] * 1000, 3),
+        }
+    edit_latency = metrics.percentiles('api_seconds', 'editMessageLiveLocation')
+    if edit_latency:
+        result['edit_api_p50_ms'] = round(edit_latency[0.5] * 1000, 3)
+        result['edit_api_p99_ms'] = round(edit_latency[0.99] * 1000, 3)
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        result['tracemalloc_peak_mb'] = round(peak / 1024 / 1024, 1)
+        tracemalloc.stop()
+    return result
+
+
+def legacy_start_text(bot_ubicacion, user_name, user_role):
+    """Texto de /start tal como se construía antes de MessageTemplates"""
+    keyboard = bot_ubicacion.ReplyKeyboardMarkup([
+        [bot_ubicacion.KeyboardButton("📍 Compartir Ubicación", request_location=True)]
+    ], resize_keyboard=True)
+    text = (
+        f"Hola {user_name}!\n\n"
+        f"Rol: {user_role}\n\n"
+        f"🔄 **Funcionalidad de Ubicación en Tiempo Real:**\n"
+        f"• Envía tu ubicación normal\n"
+        f"• El bot la convierte automáticamente a tiempo real\n"
+        f"• Duración: {bot_ubicacion.LIVE_LOCATION_DURATION // 3600} horas\n"
+        f"• Se actualiza automáticamente si compartes ubicación en vivo\n\n"
+        f"📅 Automatización:\n"
+        f"• 6:30 AM (Mar-Jue): Solo esposa\n"
+        f"• 6:15 PM (Mar-Jue): Ambos\n\n"
+        f"Comandos:\n"
+        f"/ubicacion - Solicitar ubicación\n"
+        f"/test - Probar automatización\n"
+        f"/status - Estado del bot\n"
+        f"/hogar - Miembros de tu hogar\n"
+        f"/invitar - Invitar a alguien a tu hogar"
+    )
+    return text, keyboard
+
+
+def legacy_time_text(bot_ubicacion):
+    """Texto de /time (sin próximos envíos) tal como se construía antes"""
+    chile_time = bot_ubicacion.datetime.now(bot_ubicacion.CHILE_TZ)
+    utc_time = bot_ubicacion.datetime.now(bot_ubicacion.pytz.UTC)
+    offset_hours = int((chile_time.utcoffset().total_seconds()) / 3600)
+    morning_utc = (6 - offset_hours + 24) % 24
+    evening_utc = (18 - offset_hours + 24) % 24
+
+    msg = f"🕒 **Información de Horarios**\n\n"
+    msg += f"🌍 UTC actual: {utc_time.strftime('%H:%M:%S')}\n"
+    msg += f"🇨🇱 Chile actual: {chile_time.strftime('%H:%M:%S')}\n\n"
+    msg += f"📅 **Automatización:**\n"
+    msg += f"• Mañana: 06:30 Chile = {morning_utc:02d}:30 UTC\n"
+    msg += f"• Tarde: 18:15 Chile = {evening_utc:02d}:15 UTC\n"
+    msg += "\n"
+    msg += f"📍 **Ubicación en Tiempo Real:**\n"
+    msg += f"• Duración automática: {bot_ubicacion.LIVE_LOCATION_DURATION // 3600}h\n"
+    msg += f"• Actualización: Automática\n"
+    msg += f"📆 Días: Martes, Miércoles, Jueves"
+    return msg
+
+
+def benchmark_templates(iterations):
+    """Compara el armado de textos anterior con MessageTemplates (µs por llamada)"""
+    os.environ.setdefault('BOT_TOKEN', FAKE_TOKEN)
+    import bot_ubicacion
+
+    templates = bot_ubicacion.MessageTemplates()
+    pytz, datetime, tz = bot_ubicacion.pytz, bot_ubicacion.datetime, bot_ubicacion.CHILE_TZ
+    schedules = tuple(bot_ubicacion.load_schedule_definitions(None).values())
+
+    def cached_start():
+        return (templates.render('es', 'start', user_name='Ana', user_role='esposa')
+                + templates.static('es', 'start_static')
+                + templates.schedules('es', 'start', schedules, tz)
+                + templates.static('es', 'start_commands'), bot_ubicacion.SHARE_LOCATION_KEYBOARD)
+
+    def cached_time():
+        utc_time = datetime.now(pytz.UTC)
+        chile_time = utc_time.astimezone(tz)
+        return "".join((
+            templates.render('es', 'time_header', timezone=tz.zone, utc_time=utc_time.strftime('%H:%M:%S'),
+                             local_time=chile_time.strftime('%H:%M:%S')),
+            templates.schedules('es', 'time', schedules, tz, now=utc_time.timestamp()),
+            templates.static('es', 'time_footer'),
+        ))
+
+    cases = {
+        'start_legacy': lambda: legacy_start_text(bot_ubicacion, 'Ana', 'esposa'),
+        'start_cached': cached_start,
+        'time_legacy': lambda: legacy_time_text(bot_ubicacion),
+        'time_cached': cached_time,
+    }
+    result = {}
+    for name, func in cases.items():
+        func()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        result[name + '_us'] = round((time.perf_counter() - started) / iterations * 1e6, 2)
+    return {'iterations': iterations, **result}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=200, help="hogares de dos personas")
+    parser.add_argument('--duration', type=float, default=10, help="segundos de ediciones")
+    parser.add_argument('--interval', type=float, default=1, help="segundos entre ediciones de cada usuario")
+    parser.add_argument('--latency-ms', type=float, default=30, help="latencia media de la API falsa")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="desviación de la latencia")
+    parser.add_argument('--chat-rate', type=float, default=3, help="envíos por segundo y chat antes de un 429")
+    parser.add_argument('--global-rate', type=float, default=30, help="envíos por segundo globales antes de un 429")
+    parser.add_argument('--edit-failure-rate', type=float, default=0.0, help="fracción de ediciones rechazadas")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tracemalloc', action='store_true', help="medir memoria con tracemalloc (más lento)")
+    parser.add_argument('--templates', type=int, default=0, metavar='N',
+                        help="solo comparar N renderizados de /start y /time (anterior vs caché)")
+    parser.add_argument('--broadcast', type=int, default=0, metavar='N',
+                        help="difundir una solicitud a N chats a mitad de la prueba")
+    parser.add_argument('--pool-size', type=int, default=0, help="conexiones del pool de envíos (API_POOL_SIZE)")
+    parser.add_argument('--shared-pool', action='store_true',
+                        help="difusiones por el mismo pool que las ediciones (API_BROADCAST_POOL_SIZE=0)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="procesos worker (>1 usa UpdateRouter y estado compartido en SQLite)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.templates:
+        result = benchmark_templates(args.templates)
+    elif args.workers > 1:
+        result = asyncio.run(run_sharded_benchmark(args))
+    else:
+        result = asyncio.run(run_benchmark(args))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,3168 @@
-import logging
-import schedule
 import time
-import threading
+_IMPORT_STARTED = time.perf_counter()  # para el reporte de tiempos de arranque
+import logging
+import logging.handlers
+import atexit
+import json
+import queue
+import signal
+import zlib
+import functools
+import importlib.util
+import math
+import heapq
 import asyncio
 import os
-from datetime import datetime
+import random
+import secrets
+import struct
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+# pytz y telegram se importan aquí y no en diferido: CHILE_TZ, InstrumentedRequest
+# (subclase de HTTPXRequest) y las anotaciones de los handlers los usan al
+# definir el módulo. Los que solo sirven en algunos modos (sqlite3,
+# multiprocessing, python-dotenv) se importan donde se usan.
 import pytz
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Bot, Update, KeyboardButton, ReplyKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+
+
+def _find_dotenv():
+    """El .env que usaría load_dotenv(): el primero subiendo desde la carpeta del script"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, '.env')
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+# Cargar variables de entorno (en Railway vienen del entorno y no hay .env que
+# leer: python-dotenv solo se importa si hay un archivo)
+_dotenv_path = _find_dotenv()
+if _dotenv_path:
+    from dotenv import load_dotenv
+    load_dotenv(_dotenv_path)
+
+# Configuración
+CHILE_TZ = pytz.timezone('America/Santiago')
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+CHAT_ID_TUYO = os.getenv('CHAT_ID_TUYO')
+CHAT_ID_ESPOSA = os.getenv('CHAT_ID_ESPOSA')
+
+# Modo de recepción de updates: 'polling' (por defecto) o 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+OFFICIAL_API_URL = 'https://api.telegram.org'
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', OFFICIAL_API_URL)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # URL pública, p. ej. https://weekbot.up.railway.app
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))  # Railway entrega el puerto en PORT
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+# Telegram guarda los updates mientras el bot reinicia (redeploy): no descartarlos
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', 'false').lower() == 'true'
+
+# Cliente HTTP de la Bot API: un pool para getUpdates, otro para los envíos del
+# bot (respuestas y ediciones) y otro para las difusiones programadas
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '256'))
+API_BROADCAST_POOL_SIZE = int(os.getenv('API_BROADCAST_POOL_SIZE', '32'))  # 0 = usar el de envíos
+# '2' requiere h2 (python-telegram-bot[http2]). Sin valor, HTTP/2 solo con la API oficial:
+# los servidores Bot API propios (y la API falsa de benchmark.py) hablan solo HTTP/1.1
+API_HTTP_VERSION = os.getenv('API_HTTP_VERSION') or (
+    '2' if TELEGRAM_API_URL.rstrip('/') == OFFICIAL_API_URL else '1.1')
+API_KEEPALIVE_EXPIRY = float(os.getenv('API_KEEPALIVE_EXPIRY', '30'))  # segundos de conexión ociosa
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', '5'))
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', '5'))
+API_WRITE_TIMEOUT = float(os.getenv('API_WRITE_TIMEOUT', '5'))
+API_POOL_TIMEOUT = float(os.getenv('API_POOL_TIMEOUT', '3'))  # espera por una conexión libre
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '30'))  # long polling de getUpdates (segundos)
+
+# Procesamiento en varios procesos: uno de entrada recibe los updates y los
+# reparte por hash de user_id entre WORKER_COUNT workers (1 = un solo proceso)
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '1'))
+WORKER_STOP_TIMEOUT = 30  # segundos para que un worker termine su cola al apagar
+
+# Métricas en formato Prometheus (0 = sin servidor HTTP de métricas)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_WINDOW = 2048  # Muestras recientes usadas para calcular percentiles
+
+# Administradores que pueden crear hogares nuevos con /nuevo_hogar
+ADMIN_USERS = frozenset(
+    x.strip() for x in os.getenv('ADMIN_USERS', CHAT_ID_TUYO or '').split(',') if x.strip())
+DEFAULT_GROUP_ID = 'hogar'
+DEFAULT_MEMBER_ROLE = 'familiar'
+MORNING_ROLES = frozenset({'esposa'})  # Roles que reciben la solicitud matutina
+INVITE_TTL = 24 * 3600
+bot_application = None
+
+# Horarios de automatización (hora de Chile). Días: 0 = lunes ... 6 = domingo
+MORNING_TIME = (6, 30)
+EVENING_TIME = (18, 15)
+SCHEDULE_DAYS = (1, 2, 3)  # Martes, miércoles y jueves
+
+# Definiciones de horarios y feriados (JSON, ver README); sin archivo se usan las de abajo
+SCHEDULE_FILE = os.getenv('SCHEDULE_FILE', 'horarios.json')
+DEFAULT_SCHEDULES = (
+    {'name': 'matutino', 'time': "%02d:%02d" % MORNING_TIME, 'days': list(SCHEDULE_DAYS),
+     'timezone': CHILE_TZ.zone, 'roles': sorted(MORNING_ROLES)},
+    {'name': 'vespertino', 'time': "%02d:%02d" % EVENING_TIME, 'days': list(SCHEDULE_DAYS),
+     'timezone': CHILE_TZ.zone, 'roles': None},
+)
+# Texto de cada solicitud automática ({time} = hora local del envío)
+SCHEDULE_MESSAGES = {
+    'matutino': "📍 Ubicación Automática Matutina\n\nHora: {time}\nComparte tu ubicación para el trayecto al trabajo",
+    'vespertino': "📍 Ubicación Automática Vespertina\n\nHora: {time}\nComparte tu ubicación para coordinar el regreso",
+}
+DEFAULT_SCHEDULE_MESSAGE = "📍 Ubicación Automática\n\nHora: {time}\nComparte tu ubicación"
+
+# Idioma por defecto de los mensajes (se usa el del usuario si hay traducción)
+DEFAULT_LOCALE = 'es'
+
+# Configuración de ubicación en tiempo real
+LIVE_LOCATION_DURATION = 7200  # 2 horas en segundos (máximo recomendado)
+
+# Ciclo de vida de los mensajes en tiempo real
+LIVE_RENEW_MARGIN = 60  # segundos antes de vencer en que se renueva o se detiene
+LIVE_RENEW_IF_ACTIVE = 300  # se renueva solo si el emisor envió una posición hace menos de 5 min
+
+# Límites de envío para ediciones en tiempo real (Telegram: ~30 msg/s global, ~1 msg/s por chat)
+LIVE_EDIT_GLOBAL_RATE = float(os.getenv('LIVE_EDIT_GLOBAL_RATE', '25'))
+LIVE_EDIT_CHAT_RATE = float(os.getenv('LIVE_EDIT_CHAT_RATE', '1'))
+LIVE_EDIT_MAX_IN_FLIGHT = int(os.getenv('LIVE_EDIT_MAX_IN_FLIGHT', '8'))
+LIVE_EDIT_MAX_PENDING = int(os.getenv('LIVE_EDIT_MAX_PENDING', '10000'))
+# Un 429 de un chat solo pausa ese chat; la tasa global se reduce si varios chats
+# distintos reciben 429 dentro de la ventana (señal de límite global)
+LIVE_EDIT_BACKOFF_CHATS = 3
+LIVE_EDIT_BACKOFF_WINDOW = 5.0  # segundos
+LIVE_EDIT_RECOVERY = 1.05  # factor de recuperación de la tasa global por envío exitoso
+
+# Filtro de movimiento: no reenviar ediciones por ruido de GPS con el teléfono quieto
+MOVEMENT_MIN_DISTANCE = float(os.getenv('MOVEMENT_MIN_DISTANCE', '25'))  # metros
+MOVEMENT_MIN_INTERVAL = float(os.getenv('MOVEMENT_MIN_INTERVAL', '5'))  # segundos
+MOVEMENT_KEEPALIVE = float(os.getenv('MOVEMENT_KEEPALIVE', '120'))  # reenviar igual cada N segundos
+
+# Historial de ubicaciones (segmentos binarios append-only, uno por día UTC)
+HISTORY_DIR = os.getenv('HISTORY_DIR', 'historial')
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '30'))
+HISTORY_MIN_DISTANCE = 10  # metros: no guardar ruido de GPS con el teléfono quieto
+HISTORY_MIN_INTERVAL = 60  # segundos: guardar igual al menos una vez por minuto
+
+# Geocercas (casa, trabajo, colegio...) con aviso de llegada/salida
+GEOFENCE_CELL_DEG = 0.01  # Celda de la grilla del índice espacial (~1,1 km)
+GEOFENCE_DEFAULT_RADIUS = 150  # metros
+GEOFENCE_MAX_RADIUS = 5000  # metros; el índice inserta la geocerca en cada celda que toca
+GEOFENCE_EXIT_FACTOR = 1.2  # Histéresis: para "salir" hay que alejarse un 20% más que el radio
+
+# ETA y punto de encuentro cuando ambos comparten ubicación (solo datos offline)
+ETA_ROAD_FACTOR = float(os.getenv('ETA_ROAD_FACTOR', '1.3'))  # Distancia por calle / en línea recta
+ETA_DEFAULT_SPEED = 25 / 3.6  # m/s cuando no hay historial suficiente
+ETA_MIN_SPEED = 1.0  # m/s: piso para no dividir por una persona detenida
+ETA_SPEED_WINDOW = 900  # segundos de historial para estimar la velocidad
+ETA_MAX_FIX_AGE = 900  # solo se calcula si ambas posiciones tienen menos de 15 min
+ETA_CACHE_SIZE = 1024
+ETA_CACHE_TTL = 60  # segundos
+
+# Persistencia del estado (solicitudes pendientes y mensajes en tiempo real)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')  # 'sqlite' o 'memory'
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'weekbot.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '1'))
+STATE_BATCH_SIZE = int(os.getenv('STATE_BATCH_SIZE', '100'))
+PENDING_REQUEST_TTL = 12 * 3600  # Una solicitud sin responder caduca a las 12 horas
+
+# Envíos masivos de solicitudes programadas
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '16'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+
+# Cola de salida durable: cada envío queda anotado en el estado hasta que Telegram lo acepta
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '2'))  # segundos; se duplica en cada intento
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '600'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '8'))  # reintentos en paralelo
+# Un envío que no salió en este tiempo (p. ej. tras una caída larga) ya no sirve:
+# ubicaciones y solicitudes viejas van a dead letter en vez de enviarse
+OUTBOX_MAX_AGE = float(os.getenv('OUTBOX_MAX_AGE', '900'))
+OUTBOX_KEEP = 2 * 24 * 3600  # los enviados se recuerdan 2 días para descartar duplicados
+OUTBOX_DEAD_KEEP = 7 * 24 * 3600
+OUTBOX_RATE_WINDOW = 60  # segundos usados para calcular la tasa de vaciado
+
+# Logging: un hilo aparte formatea y escribe, los handlers solo encolan
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' o 'json' (una línea JSON por registro)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_EDIT_SAMPLE = int(os.getenv('LOG_EDIT_SAMPLE', '20'))  # 1 de cada N logs de ediciones por par
+LOG_API_CALLS = os.getenv('LOG_API_CALLS', 'false').lower() == 'true'  # una línea por llamada a la API
+
+# Identificador del update (o trabajo) en curso; viaja con las tareas asyncio
+# que se crean a partir de él y aparece en cada log y llamada a la API
+_correlation_id = ContextVar('correlation_id', default=None)
+
+# Atributos propios de LogRecord: el resto son campos pasados con extra=
+_LOG_RECORD_FIELDS = frozenset(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime', 'correlation_id', 'sample_key', 'taskName'}
+
+
+class LogContextFilter(logging.Filter):
+    """Agrega el correlation_id y muestrea los streams de alta frecuencia.
+
+    Corre en el hilo que loguea (antes de encolar), así lee el contexto del
+    update correcto. Los registros con extra={'sample_key': clave} pasan solo
+    1 de cada `sample_every` por clave (el primero siempre pasa).
+    """
+
+    def __init__(self, sample_every=LOG_EDIT_SAMPLE):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self._counts = defaultdict(int)
+        self.stats = {'sampled_out': 0}
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is not None:
+            count = self._counts[key]
+            self._counts[key] = count + 1
+            if count % self.sample_every:
+                self.stats['sampled_out'] += 1
+                return False
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos de extra= y el correlation_id"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'correlation_id', None):
+            entry['correlation_id'] = record.correlation_id
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no formatea en el hilo que loguea: el mensaje se arma
+    (%-formato perezoso) recién en el hilo del QueueListener"""
+
+    def prepare(self, record):
+        return record
+
+
+_log_filter = LogContextFilter()
+_log_listener = None
+
+
+def setup_logging(log_format=LOG_FORMAT, level=LOG_LEVEL):
+    """Configura el logging no bloqueante (una vez por proceso)"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(JsonLogFormatter() if log_format == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(_log_filter)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # httpx registra cada request en INFO; lo reemplaza api_logger (con correlation_id)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if LOG_API_CALLS:
+        api_logger.setLevel(logging.DEBUG)
+    _log_listener = logging.handlers.QueueListener(log_queue, output)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)  # vacía la cola al salir
+
+
+logger = logging.getLogger(__name__)
+api_logger = logger.getChild('api')
+setup_logging()
+
+
+def validate_config():
+    """Validación de variables requeridas (al arrancar, no al importar el módulo)"""
+    if not BOT_TOKEN:
+        raise ValueError(
+            "BOT_TOKEN no configurado. Verifica tu archivo .env o variables de entorno en Railway")
+
+    if not CHAT_ID_TUYO or not CHAT_ID_ESPOSA:
+        logger.warning("CHAT_ID_TUYO o CHAT_ID_ESPOSA no configurados")
+
+
+class StartupTimer:
+    """Tiempos de arranque por fase, contados desde que empezó la importación"""
+
+    def __init__(self, started):
+        self.started = started
+        self._last = started
+        self.phases = []  # [(fase, segundos)]
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def total(self):
+        return self._last - self.started
+
+    def summary(self):
+        return ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases)
+
+
+STARTUP = StartupTimer(_IMPORT_STARTED)
+STARTUP.mark('imports')
+
+
+class TokenBucket:
+    """Limitador de tasa: `rate` tokens por segundo con ráfaga de `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def delay(self, now=None):
+        """Segundos que faltan para disponer de un token (0 si ya hay uno)"""
+        now = time.monotonic() if now is None else now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now=None):
+        """Bloquea el bucket (p. ej. tras un RetryAfter de Telegram)"""
+        now = time.monotonic() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+
+
+# Llamadas a la Bot API hechas mientras se procesa el update actual
+_api_calls_in_update = ContextVar('api_calls_in_update', default=None)
+
+
+class Metrics:
+    """Contadores y latencias en memoria, exportables en formato Prometheus.
+
+    Registrar una muestra cuesta un append a un deque acotado; los percentiles
+    se calculan solo al consultar (/status o /metrics), fuera del hot path.
+    """
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.counters = defaultdict(int)  # (nombre, etiqueta) -> valor
+        self.samples = {}  # (nombre, etiqueta) -> deque de segundos
+        self.sums = defaultdict(float)  # (nombre, etiqueta) -> suma total en segundos
+        self.gauges = {}  # nombre -> función sin argumentos
+
+    # Nombre de la etiqueta Prometheus de cada métrica (por defecto "name")
+    LABEL_NAMES = {
+        'handler_seconds': 'handler',
+        'handler_errors': 'handler',
+        'api_calls_per_handler': 'handler',
+        'api_seconds': 'method',
+        'api_errors': 'method',
+        'api_rate_limited': 'method',
+    }
+
+    def inc(self, name, label, amount=1):
+        self.counters[(name, label)] += amount
+
+    def observe(self, name, label, seconds):
+        key = (name, label)
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+        self.sums[key] += seconds
+        self.counters[(name + '_count', label)] += 1
+
+    @contextmanager
+    def timer(self, name, label, errors=None):
+        """Mide el bloque en `name`; si falla y se indica, cuenta el error en `errors`"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                self.inc(errors, label)
+            raise
+        finally:
+            self.observe(name, label, time.perf_counter() - started)
+
+    def register_gauge(self, name, getter):
+        self.gauges[name] = getter
+
+    def percentiles(self, name, label, quantiles=(0.5, 0.95, 0.99)):
+        samples = sorted(self.samples.get((name, label), ()))
+        if not samples:
+            return {}
+        last = len(samples) - 1
+        return {q: samples[min(last, int(q * len(samples)))] for q in quantiles}
+
+    def labels(self, name):
+        return sorted(label for sample_name, label in self.samples if sample_name == name)
+
+    def count(self, name, label=None):
+        if label is not None:
+            return self.counters.get((name, label), 0)
+        return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    def render_prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.samples}):
+            label_name = self.LABEL_NAMES.get(name, 'name')
+            metric = f"weekbot_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for label in self.labels(name):
+                for q, value in self.percentiles(name, label).items():
+                    lines.append(f'{metric}{{{label_name}="{label}",quantile="{q}"}} {value:.6f}')
+                lines.append(f'{metric}_sum{{{label_name}="{label}"}} {self.sums[(name, label)]:.6f}')
+                lines.append(f'{metric}_count{{{label_name}="{label}"}} {self.counters[(name + "_count", label)]}')
+        counter_names = sorted({name for name, _ in self.counters if not name.endswith('_count')})
+        for name in counter_names:
+            metric = f"weekbot_{name}_total"
+            label_name = self.LABEL_NAMES.get(name, 'name')
+            lines.append(f"# TYPE {metric} counter")
+            for (counter, label), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(f'{metric}{{{label_name}="{label}"}} {value}')
+        for name, getter in sorted(self.gauges.items()):
+            lines.append(f"# TYPE weekbot_{name} gauge")
+            lines.append(f"weekbot_{name} {getter()}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Servidor HTTP mínimo que responde GET /metrics"""
+        async def handle(reader, writer):
+            try:
+                request_line = await reader.readline()
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                    status, body = "200 OK", self.render_prometheus().encode()
+                else:
+                    status, body = "404 Not Found", b"not found\n"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    f"Content-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info("Métricas disponibles en http://%s:%s/metrics", host, port)
+        return server
+
+
+@functools.lru_cache(maxsize=None)
+def api_http_version():
+    if API_HTTP_VERSION == '2' and importlib.util.find_spec('h2') is None:
+        logger.warning("API_HTTP_VERSION=2 requiere h2 (python-telegram-bot[http2]); se usa HTTP/1.1")
+        return '1.1'
+    return API_HTTP_VERSION
+
+
+def api_request(metrics, pool_size, http_version=None):
+    """InstrumentedRequest con la configuración API_* de pool, protocolo y timeouts"""
+    import httpx
+    return InstrumentedRequest(
+        metrics,
+        connection_pool_size=pool_size,
+        http_version=http_version or api_http_version(),
+        connect_timeout=API_CONNECT_TIMEOUT,
+        read_timeout=API_READ_TIMEOUT,
+        write_timeout=API_WRITE_TIMEOUT,
+        pool_timeout=API_POOL_TIMEOUT,
+        httpx_kwargs={
+            # Cargar los certificados cuesta ~25 ms por cliente: todos comparten un contexto SSL
+            'verify': shared_ssl_context(),
+            # Mantener las conexiones abiertas más que los 5 s de httpx: las ediciones
+            # llegan cada pocos segundos y así no se repite el handshake TLS
+            'limits': httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size,
+                keepalive_expiry=API_KEEPALIVE_EXPIRY),
+        },
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def shared_ssl_context():
+    import httpx
+    return httpx.create_ssl_context()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest que mide latencia, errores y límites (429) por método de la API"""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        calls = _api_calls_in_update.get()
+        if calls is not None:
+            calls[0] += 1
+        started = time.perf_counter()
+        code = None
+        try:
+            code, payload = await super().do_request(url, *args, **kwargs)
+        except Exception:
+            self.metrics.inc('api_errors', api_method)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe('api_seconds', api_method, elapsed)
+            api_logger.debug("%s -> %s en %.1f ms", api_method, code, elapsed * 1000,
+                             extra={'api_method': api_method, 'status': code})
+        if code == 429:
+            self.metrics.inc('api_rate_limited', api_method)
+        elif code >= 400:
+            self.metrics.inc('api_errors', api_method)
+        return code, payload
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def fast_distance_m(lat1, lon1, lat2, lon2):
+    """Distancia equirectangular en metros: precisa para tramos cortos y sin trigonometría inversa"""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_M * math.hypot(x, y)
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distancia de gran círculo en metros (para tramos largos)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class MovementFilter:
+    """Decide si una edición de ubicación merece reenviarse.
+
+    Compara cada posición con la última reenviada en el mismo flujo
+    (emisor, destinatario): se suprime si no pasó MOVEMENT_MIN_INTERVAL o si
+    se movió menos de MOVEMENT_MIN_DISTANCE, salvo que hayan pasado
+    MOVEMENT_KEEPALIVE segundos desde el último reenvío.
+    """
+
+    def __init__(self, min_distance=MOVEMENT_MIN_DISTANCE, min_interval=MOVEMENT_MIN_INTERVAL,
+                 keepalive=MOVEMENT_KEEPALIVE):
+        self.defaults = (min_distance, min_interval, keepalive)
+        self.overrides = {}  # (emisor, destinatario) -> (distancia, intervalo, keepalive)
+        self._last = {}  # (emisor, destinatario) -> (lat, lon, instante)
+        self.stats = {'forwarded': 0, 'suppressed': 0, 'keepalive': 0}
+
+    def thresholds(self, sender_id, recipient_id):
+        return self.overrides.get((sender_id, recipient_id), self.defaults)
+
+    def set_thresholds(self, sender_id, recipient_id, min_distance, min_interval, keepalive):
+        self.overrides[(sender_id, recipient_id)] = (min_distance, min_interval, keepalive)
+
+    def record(self, sender_id, recipient_id, latitude, longitude, now=None):
+        """Registra una posición como reenviada (p. ej. al iniciar el flujo)"""
+        now = time.monotonic() if now is None else now
+        self._last[(sender_id, recipient_id)] = (latitude, longitude, now)
+
+    def forget(self, sender_id, recipient_id):
+        self._last.pop((sender_id, recipient_id), None)
+
+    def should_forward(self, sender_id, recipient_id, latitude, longitude, now=None):
+        now = time.monotonic() if now is None else now
+        key = (sender_id, recipient_id)
+        last = self._last.get(key)
+        if last is not None:
+            min_distance, min_interval, keepalive = self.overrides.get(key, self.defaults)
+            elapsed = now - last[2]
+            if elapsed >= keepalive:
+                self.stats['keepalive'] += 1
+            elif (elapsed < min_interval
+                  or fast_distance_m(last[0], last[1], latitude, longitude) < min_distance):
+                self.stats['suppressed'] += 1
+                return False
+        self._last[key] = (latitude, longitude, now)
+        self.stats['forwarded'] += 1
+        return True
+
+
+class UserTrack:
+    """Posiciones de un usuario en columnas compactas ordenadas por tiempo"""
+
+    __slots__ = ('timestamps', 'latitudes', 'longitudes')
+
+    def __init__(self):
+        self.timestamps = array('I')  # segundos epoch
+        self.latitudes = array('i')  # grados * HISTORY_SCALE
+        self.longitudes = array('i')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, latitude, longitude):
+        self.timestamps.append(timestamp)
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+
+    def index_at(self, timestamp):
+        """Primera posición con tiempo >= timestamp (búsqueda binaria)"""
+        return bisect_left(self.timestamps, timestamp)
+
+    def trim_before(self, timestamp):
+        index = self.index_at(timestamp)
+        if index:
+            del self.timestamps[:index]
+            del self.latitudes[:index]
+            del self.longitudes[:index]
+
+    def trim_from(self, timestamp):
+        index = self.index_at(timestamp)
+        del self.timestamps[index:]
+        del self.latitudes[index:]
+        del self.longitudes[index:]
+
+    def extend(self, other):
+        self.timestamps.extend(other.timestamps)
+        self.latitudes.extend(other.latitudes)
+        self.longitudes.extend(other.longitudes)
+
+
+class LocationHistory:
+    """Historial append-only de posiciones.
+
+    En disco: un segmento por día UTC (`AAAAMMDD.loc`) con registros fijos de
+    20 bytes (user_id int64, timestamp uint32, lat/lon int32 escalados a 1e-7°).
+    En memoria: un UserTrack por usuario, cuyas columnas ordenadas por tiempo
+    sirven de índice para responder consultas sin recorrer todo el historial.
+    """
+
+    RECORD = struct.Struct('<qIii')
+    SCALE = 10_000_000
+
+    def __init__(self, directory=HISTORY_DIR, retention_days=HISTORY_RETENTION_DAYS, suffix=''):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.suffix = suffix  # con varios workers cada uno escribe sus propios segmentos
+        self.tracks = {}  # user_id (str) -> UserTrack
+        self._buffers = {}  # nombre de segmento -> bytearray pendiente de escribir
+        os.makedirs(directory, exist_ok=True)
+
+    def _segment_name(self, timestamp):
+        return time.strftime('%Y%m%d', time.gmtime(timestamp)) + self.suffix + '.loc'
+
+    def load(self, now=None, owns=None):
+        """Carga los segmentos dentro del periodo de retención; devuelve cuántas posiciones"""
+        return self.merge(self.read_segments(now, owns))
+
+    def read_segments(self, now=None, owns=None):
+        """{user_id: UserTrack} leído de disco, sin tocar el historial en memoria
+        (se puede llamar desde otro hilo). Con `owns` solo se leen los usuarios
+        para los que devuelve True."""
+        self.remove_expired_segments(now)
+        tracks = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.loc'):
+                continue
+            with open(os.path.join(self.directory, name), 'rb') as segment:
+                data = segment.read()
+            usable = len(data) - len(data) % self.RECORD.size  # ignora un registro truncado
+            for user_id, timestamp, latitude, longitude in self.RECORD.iter_unpack(data[:usable]):
+                user_id = str(user_id)
+                if owns is not None and not owns(user_id):
+                    continue
+                self._append_to(tracks, user_id, timestamp, latitude, longitude)
+        return tracks
+
+    def merge(self, tracks):
+        """Incorpora lo leído de disco; las posiciones registradas mientras tanto
+        (más nuevas) se conservan. Devuelve cuántas posiciones se cargaron."""
+        loaded = 0
+        for user_id, track in tracks.items():
+            live = self.tracks.get(user_id)
+            if live:
+                # Lo que ya se registró en memoria también puede estar en disco
+                track.trim_from(live.timestamps[0])
+                track.extend(live)
+            self.tracks[user_id] = track
+            loaded += len(track) - (len(live) if live else 0)
+        return loaded
+
+    @staticmethod
+    def _append_to(tracks, user_id, timestamp, latitude, longitude):
+        track = tracks.get(user_id)
+        if track is None:
+            track = tracks[user_id] = UserTrack()
+        elif track.timestamps and timestamp < track.timestamps[-1]:
+            return False  # fuera de orden: el índice exige tiempos crecientes
+        track.append(timestamp, latitude, longitude)
+        return True
+
+    def _append(self, user_id, timestamp, latitude, longitude):
+        return self._append_to(self.tracks, user_id, timestamp, latitude, longitude)
+
+    def record(self, user_id, latitude, longitude, now=None):
+        """Agrega una posición; devuelve False si se descartó por ruido"""
+        now = int(time.time() if now is None else now)
+        scaled_lat = round(latitude * self.SCALE)
+        scaled_lon = round(longitude * self.SCALE)
+        track = self.tracks.get(user_id)
+        if track:
+            moved = fast_distance_m(
+                track.latitudes[-1] / self.SCALE, track.longitudes[-1] / self.SCALE, latitude, longitude)
+            if moved < HISTORY_MIN_DISTANCE and now - track.timestamps[-1] < HISTORY_MIN_INTERVAL:
+                return False
+        if not self._append(user_id, now, scaled_lat, scaled_lon):
+            return False
+        buffer = self._buffers.setdefault(self._segment_name(now), bytearray())
+        buffer += self.RECORD.pack(int(user_id), now, scaled_lat, scaled_lon)
+        return True
+
+    def flush(self):
+        buffers, self._buffers = self._buffers, {}
+        for name, buffer in buffers.items():
+            with open(os.path.join(self.directory, name), 'ab') as segment:
+                segment.write(buffer)
+
+    def remove_expired_segments(self, now=None):
+        """Borra los segmentos de días fuera del periodo de retención; devuelve cuántos"""
+        now = time.time() if now is None else now
+        cutoff = self._segment_name(now - self.retention_days * 86400)[:8]
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.loc') and name[:8] < cutoff:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass  # otro worker ya lo borró
+        return removed
+
+    def prune(self, now=None):
+        """Descarta las posiciones fuera del periodo de retención, en memoria y en disco"""
+        now = time.time() if now is None else now
+        cutoff = int(now - self.retention_days * 86400)
+        for user_id, track in list(self.tracks.items()):
+            track.trim_before(cutoff)
+            if not track:
+                del self.tracks[user_id]
+        self.remove_expired_segments(now)
+
+    def close(self):
+        self.flush()
+
+    # Consultas
+
+    def last_fixes(self, user_id, count):
+        """[(timestamp, lat, lon)] de las últimas `count` posiciones, de la más nueva a la más vieja"""
+        track = self.tracks.get(user_id)
+        if not track:
+            return []
+        start = max(0, len(track) - count)
+        scale = self.SCALE
+        return [(t, lat / scale, lon / scale) for t, lat, lon in zip(
+            reversed(track.timestamps[start:]),
+            reversed(track.latitudes[start:]),
+            reversed(track.longitudes[start:]))]
+
+    def last_fix(self, user_id):
+        fixes = self.last_fixes(user_id, 1)
+        return fixes[0] if fixes else None
+
+    def distance_since(self, user_id, since):
+        """Metros recorridos desde el timestamp `since`"""
+        track = self.tracks.get(user_id)
+        if not track:
+            return 0.0
+        start = track.index_at(since)
+        scale = self.SCALE
+        lats = [value / scale for value in track.latitudes[start:]]
+        lons = [value / scale for value in track.longitudes[start:]]
+        return sum(map(fast_distance_m, lats, lons, lats[1:], lons[1:]))
+
+    def average_speed(self, user_id, window, now=None):
+        """Velocidad media (m/s) en los últimos `window` segundos, o None sin datos"""
+        track = self.tracks.get(user_id)
+        if not track:
+            return None
+        now = time.time() if now is None else now
+        start = track.index_at(int(now - window))
+        if len(track) - start < 2:
+            return None
+        elapsed = track.timestamps[-1] - track.timestamps[start]
+        if elapsed <= 0:
+            return None
+        return self.distance_since(user_id, track.timestamps[start]) / elapsed
+
+    def speed_trend(self, user_id, windows=(300, 900, 1800), now=None):
+        """[(ventana en segundos, m/s o None)] para ver si va acelerando o frenando"""
+        return [(window, self.average_speed(user_id, window, now)) for window in windows]
+
+
+class Geofence:
+    __slots__ = ('user_id', 'name', 'latitude', 'longitude', 'radius')
+
+    def __init__(self, user_id, name, latitude, longitude, radius):
+        self.user_id = user_id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+
+
+class GeofenceIndex:
+    """Geocercas circulares indexadas en una grilla por usuario.
+
+    Cada geocerca se inserta en todas las celdas que toca su radio de salida,
+    así una posición solo se compara con las geocercas de su propia celda más
+    las que el usuario ya tenía "adentro" (para detectar la salida).
+    """
+
+    def __init__(self, cell_deg=GEOFENCE_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = defaultdict(list)  # (user_id, fila, columna) -> [Geofence]
+        self.fences = {}  # user_id -> {nombre: Geofence}
+        self.inside = {}  # user_id -> {nombre: bool}; sin entrada = estado desconocido
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg)
+
+    def _fence_cells(self, fence):
+        reach = fence.radius * GEOFENCE_EXIT_FACTOR
+        dlat = reach / 111_320
+        dlon = reach / (111_320 * max(0.01, math.cos(math.radians(fence.latitude))))
+        row_min, col_min = self._cell(fence.latitude - dlat, fence.longitude - dlon)
+        row_max, col_max = self._cell(fence.latitude + dlat, fence.longitude + dlon)
+        return [(fence.user_id, row, col)
+                for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+
+    def add(self, fence):
+        self.remove(fence.user_id, fence.name)
+        self.fences.setdefault(fence.user_id, {})[fence.name] = fence
+        for cell in self._fence_cells(fence):
+            self.cells[cell].append(fence)
+
+    def remove(self, user_id, name):
+        fence = self.fences.get(user_id, {}).pop(name, None)
+        if fence is None:
+            return False
+        if not self.fences[user_id]:
+            del self.fences[user_id]
+        for cell in self._fence_cells(fence):
+            remaining = [other for other in self.cells[cell] if other is not fence]
+            if remaining:
+                self.cells[cell] = remaining
+            else:
+                del self.cells[cell]
+        self.inside.get(user_id, {}).pop(name, None)
+        return True
+
+    def user_fences(self, user_id):
+        return list(self.fences.get(user_id, {}).values())
+
+    def check(self, user_id, latitude, longitude):
+        """Actualiza el estado del usuario; devuelve [(Geofence, 'arrived' | 'left')]"""
+        user_fences = self.fences.get(user_id)
+        if not user_fences:
+            return []
+        states = self.inside.setdefault(user_id, {})
+
+        events = []
+        row, col = self._cell(latitude, longitude)
+        candidates = {fence.name: fence for fence in self.cells.get((user_id, row, col), ())}
+        for name, was_inside in states.items():
+            if was_inside and name not in candidates:
+                candidates[name] = user_fences[name]
+
+        for name, fence in candidates.items():
+            distance = fast_distance_m(fence.latitude, fence.longitude, latitude, longitude)
+            was_inside = states.get(name)
+            if was_inside:
+                is_inside = distance <= fence.radius * GEOFENCE_EXIT_FACTOR
+            else:
+                is_inside = distance <= fence.radius
+            states[name] = is_inside
+            # La primera posición solo fija el estado, no avisa
+            if was_inside is not None and is_inside != was_inside:
+                events.append((fence, 'arrived' if is_inside else 'left'))
+
+        # Geocercas que no están en la celda: el usuario queda afuera de ellas
+        if len(states) < len(user_fences):
+            for name in user_fences:
+                states.setdefault(name, False)
+        return events
+
+
+class TTLCache:
+    """Caché LRU con expiración por tiempo"""
+
+    def __init__(self, max_size=ETA_CACHE_SIZE, ttl=ETA_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # clave -> (vence, valor)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, now=None):
+        now = time.monotonic() if now is None else now
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ETAService:
+    """Estima distancia, tiempo de llegada y punto de encuentro entre dos personas.
+
+    Usa la última posición y la velocidad reciente de cada una según el
+    historial, con la distancia en línea recta corregida por ETA_ROAD_FACTOR.
+    Los resultados se memorizan por par y por celda de ~100 m de cada
+    posición, así las ediciones seguidas no recalculan nada.
+
+    Con varios workers el historial de la otra persona puede estar en otro
+    proceso: `remote(user_id)` devuelve su última posición compartida
+    (timestamp, lat, lon, velocidad) cuando el historial local no la tiene.
+    """
+
+    def __init__(self, history, cache=None, remote=None):
+        self.history = history
+        self.cache = cache if cache is not None else TTLCache()
+        self.remote = remote
+
+    def _fix(self, user_id, now):
+        """(timestamp, lat, lon) y la velocidad compartida (None = calcularla del historial)"""
+        fix = self.history.last_fix(user_id)
+        if self.remote is not None and (fix is None or now - fix[0] > ETA_MAX_FIX_AGE):
+            shared = self.remote(user_id)
+            if shared is not None:
+                return shared[:3], shared[3]
+        return fix, None
+
+    def _speed(self, user_id, now, shared_speed=None):
+        if shared_speed is not None:
+            speed = shared_speed
+        else:
+            speed = self.history.average_speed(user_id, ETA_SPEED_WINDOW, now)
+        return max(ETA_MIN_SPEED, speed if speed is not None else ETA_DEFAULT_SPEED)
+
+    def estimate(self, user_a, user_b, now=None):
+        """{'distance_m', 'eta_s': {user: s}, 'meet_s', 'meeting_point'} o None"""
+        now = time.time() if now is None else now
+        fix_a, shared_a = self._fix(user_a, now)
+        fix_b, shared_b = self._fix(user_b, now)
+        if fix_a is None or fix_b is None:
+            return None
+        if now - fix_a[0] > ETA_MAX_FIX_AGE or now - fix_b[0] > ETA_MAX_FIX_AGE:
+            return None
+
+        if user_b < user_a:
+            user_a, user_b, fix_a, fix_b = user_b, user_a, fix_b, fix_a
+            shared_a, shared_b = shared_b, shared_a
+        key = (user_a, user_b,
+               round(fix_a[1], 3), round(fix_a[2], 3), round(fix_b[1], 3), round(fix_b[2], 3))
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        distance = haversine_m(fix_a[1], fix_a[2], fix_b[1], fix_b[2]) * ETA_ROAD_FACTOR
+        speed_a = self._speed(user_a, now, shared_a)
+        speed_b = self._speed(user_b, now, shared_b)
+        # Si ambos avanzan uno hacia el otro, se encuentran en la fracción
+        # speed_a / (speed_a + speed_b) del trayecto desde A
+        share = speed_a / (speed_a + speed_b)
+        result = {
+            'distance_m': distance,
+            'eta_s': {user_a: distance / speed_a, user_b: distance / speed_b},
+            'meet_s': distance / (speed_a + speed_b),
+            'meeting_point': (fix_a[1] + (fix_b[1] - fix_a[1]) * share,
+                              fix_a[2] + (fix_b[2] - fix_a[2]) * share),
+        }
+        self.cache.put(key, result)
+        return result
+
+
+class BackgroundLoop:
+    """Una sola tarea de fondo (start/stop) que duerme hasta un plazo o hasta
+    que la despiertan con `_wakeup.set()`. Las subclases implementan _run()."""
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sleep(self, timeout=None):
+        """Espera a que la despierten o `timeout` segundos (None = sin límite);
+        no limpia el evento, eso lo decide el loop"""
+        if timeout is None:
+            await self._wakeup.wait()
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        raise NotImplementedError
+
+
+class LiveLocationLifecycle(BackgroundLoop):
+    """Vencimientos de los mensajes en tiempo real en un min-heap.
+
+    Una sola tarea duerme hasta el vencimiento más cercano (menos
+    LIVE_RENEW_MARGIN) y llama `on_expire(user_id, recipient_id)`. Reprogramar
+    o cancelar un mensaje no toca el heap: las entradas obsoletas se
+    descartan al llegar a la cima.
+    """
+
+    def __init__(self, on_expire, margin=LIVE_RENEW_MARGIN):
+        super().__init__()
+        self.on_expire = on_expire
+        self.margin = margin
+        self._heap = []
+        self._deadlines = {}  # (emisor, destinatario) -> vencimiento vigente
+        self.stats = {'renewed': 0, 'stopped': 0}
+
+    def track(self, user_id, recipient_id, expires_at):
+        key = (user_id, recipient_id)
+        self._deadlines[key] = expires_at
+        heapq.heappush(self._heap, (expires_at, key))
+        self._wakeup.set()
+
+    def untrack(self, user_id, recipient_id):
+        self._deadlines.pop((user_id, recipient_id), None)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._sleep()
+                continue
+
+            expires_at, key = self._heap[0]
+            if self._deadlines.get(key) != expires_at:
+                heapq.heappop(self._heap)
+                continue
+
+            delay = expires_at - self.margin - time.time()
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            heapq.heappop(self._heap)
+            del self._deadlines[key]
+            try:
+                _correlation_id.set(f"expiry-{key[0]}-{key[1]}")
+                await self.on_expire(*key)
+            except Exception as e:
+                logger.error("Error en vencimiento de ubicación en tiempo real %s: %s", key, e)
+
+
+class LiveLocationCoalescer(BackgroundLoop):
+    """Cola de ediciones de ubicación en tiempo real por par (emisor, destinatario).
+
+    Solo se conserva la coordenada más reciente de cada par: si llegan varias
+    ediciones antes de que se pueda enviar, se agrupan en una sola llamada.
+    Los envíos respetan un token bucket global y otro por chat. Un RetryAfter
+    pausa el chat que lo recibió; si lo reciben LIVE_EDIT_BACKOFF_CHATS chats
+    distintos en LIVE_EDIT_BACKOFF_WINDOW, la tasa global se reduce a la mitad
+    (una vez por ventana) y se recupera de forma multiplicativa con los envíos
+    exitosos.
+    """
+
+    def __init__(self, send, global_rate=LIVE_EDIT_GLOBAL_RATE, per_chat_rate=LIVE_EDIT_CHAT_RATE,
+                 max_in_flight=LIVE_EDIT_MAX_IN_FLIGHT, max_pending=LIVE_EDIT_MAX_PENDING):
+        super().__init__()
+        self._send = send
+        self.max_rate = global_rate
+        self.min_rate = max(0.5, global_rate / 16)
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self._chat_buckets = {}
+        self._retry_after_chats = deque()  # (instante, chat) de los RetryAfter recientes
+        self._last_backoff = float('-inf')
+        self._pending = {}  # (emisor, destinatario) -> (lat, lon, correlation_id)
+        self._in_flight = set()
+        self.started_at = time.monotonic()
+        self.stats = {
+            'received': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'sent': 0,
+            'failed': 0,
+            'retry_after': 0,
+        }
+
+    async def drain(self, timeout):
+        """Espera a que se envíe lo pendiente (p. ej. antes de apagar un worker)"""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def submit(self, sender_id, recipient_id, latitude, longitude):
+        """Encola la última posición del par; nunca bloquea al handler"""
+        self.stats['received'] += 1
+        key = (sender_id, recipient_id)
+        if key in self._pending:
+            # Se reemplaza la coordenada conservando la posición en la cola
+            self.stats['coalesced'] += 1
+        elif len(self._pending) >= self.max_pending:
+            self.stats['dropped'] += 1
+            return
+        self._pending[key] = (latitude, longitude, _correlation_id.get())
+        self._wakeup.set()
+
+    def snapshot(self):
+        """Contadores actuales más tasa, pendientes y llamadas ahorradas"""
+        stats = dict(self.stats)
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        stats['pending'] = len(self._pending)
+        stats['in_flight'] = len(self._in_flight)
+        stats['rate_limit'] = round(self.global_bucket.rate, 2)
+        stats['sent_per_second'] = round(stats['sent'] / elapsed, 3)
+        stats['calls_saved'] = stats['coalesced'] + stats['dropped']
+        return stats
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def _run(self):
+        while True:
+            await self._sleep()
+            self._wakeup.clear()
+            while self._pending:
+                wait = self._dispatch_ready()
+                if wait is None:
+                    break
+                await self._sleep(wait)
+                self._wakeup.clear()
+
+    def _dispatch_ready(self):
+        """Lanza los envíos permitidos; devuelve cuánto esperar o None si hay que
+        esperar a que termine algún envío en curso"""
+        now = time.monotonic()
+        min_wait = None
+        for key in list(self._pending):
+            if len(self._in_flight) >= self.max_in_flight:
+                return None
+            if key in self._in_flight:
+                continue
+            chat_wait = self._chat_bucket(key[1]).delay(now)
+            if chat_wait > 0:
+                min_wait = chat_wait if min_wait is None else min(min_wait, chat_wait)
+                continue
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                return global_wait
+            self.global_bucket.consume(now)
+            self._chat_bucket(key[1]).consume(now)
+            latitude, longitude, correlation_id = self._pending.pop(key)
+            self._in_flight.add(key)
+            asyncio.create_task(self._deliver(key, latitude, longitude, correlation_id))
+        return min_wait
+
+    async def _deliver(self, key, latitude, longitude, correlation_id=None):
+        # La edición se asocia al update que trajo la coordenada
+        _correlation_id.set(correlation_id)
+        sender_id, recipient_id = key
+        try:
+            await self._send(sender_id, recipient_id, latitude, longitude)
+            self.stats['sent'] += 1
+            bucket = self.global_bucket
+            bucket.rate = min(self.max_rate, bucket.rate * LIVE_EDIT_RECOVERY)
+        except RetryAfter as e:
+            self.stats['retry_after'] += 1
+            bucket = self.global_bucket
+            self._chat_bucket(recipient_id).pause(e.retry_after)
+            self._backoff_if_global(recipient_id)
+            logger.warning(
+                "RetryAfter de Telegram para chat %s: %ss (tasa global %.1f/s)",
+                recipient_id, e.retry_after, bucket.rate)
+            # Reintentar la coordenada salvo que ya haya llegado una más nueva
+            self._pending.setdefault(key, (latitude, longitude, correlation_id))
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.error("Error enviando edición de ubicación en tiempo real: %s", e)
+        finally:
+            self._in_flight.discard(key)
+            self._wakeup.set()
+
+    def _backoff_if_global(self, chat_id, now=None):
+        """Reduce la tasa global si varios chats recibieron RetryAfter hace poco"""
+        now = time.monotonic() if now is None else now
+        recent = self._retry_after_chats
+        recent.append((now, chat_id))
+        while recent and recent[0][0] < now - LIVE_EDIT_BACKOFF_WINDOW:
+            recent.popleft()
+        if (len({chat for _, chat in recent}) >= LIVE_EDIT_BACKOFF_CHATS
+                and now - self._last_backoff >= LIVE_EDIT_BACKOFF_WINDOW):
+            self.global_bucket.rate = max(self.min_rate, self.global_bucket.rate / 2)
+            self._last_backoff = now
+            recent.clear()
+
+
+class MemoryStateStore:
+    """Estado del bot indexado por tuplas, solo en memoria.
+
+    - live_messages: (user_id, recipient_id) -> (message_id, expires_at)
+    - pending: target_id -> (requester, requested_at, expires_at)
+
+    Las entradas caducan cuando termina su live_period (o PENDING_REQUEST_TTL),
+    así nunca se intenta editar un mensaje que Telegram ya no acepta.
+    """
+
+    def __init__(self):
+        self.live_messages = {}
+        self.pending = {}
+        self.members = {}  # user_id -> (group_id, role)
+        self.thresholds = {}  # (user_id, recipient_id) -> (distancia, intervalo, keepalive)
+        self.geofences = {}  # (user_id, nombre) -> (lat, lon, radio)
+        self.invites = {}  # código -> (group_id, rol, expires_at)
+        self.shared_fixes = {}  # user_id -> (timestamp, lat, lon, velocidad)
+        self.user_schedules = {}  # (user_id, nombre o '*') -> (hora, minuto, días, zona, activo)
+        # clave -> [shard, bot, método, params, hook, estado, intentos, next_at, created_at, error]
+        self.outbox = {}
+
+    def load(self, owns=None):
+        return 0
+
+    def members_version(self):
+        """Cambia cada vez que se modifica algún hogar u horario (también desde otro proceso)"""
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_live_message(self, user_id, recipient_id, now=None):
+        entry = self.live_messages.get((user_id, recipient_id))
+        if entry is None:
+            return None
+        now = time.time() if now is None else now
+        if entry[1] <= now:
+            self.delete_live_message(user_id, recipient_id)
+            return None
+        return entry[0]
+
+    def set_live_message(self, user_id, recipient_id, message_id, live_period, now=None):
+        now = time.time() if now is None else now
+        self.live_messages[(user_id, recipient_id)] = (message_id, now + live_period)
+
+    def delete_live_message(self, user_id, recipient_id):
+        self.live_messages.pop((user_id, recipient_id), None)
+
+    def set_pending_request(self, target_id, requester, now=None):
+        now = time.time() if now is None else now
+        self.pending[target_id] = (requester, now, now + PENDING_REQUEST_TTL)
+
+    def pop_pending_request(self, target_id):
+        return self.pending.pop(target_id, None)
+
+    def load_members(self):
+        """[(group_id, user_id, role)] de todos los hogares registrados"""
+        return [(group_id, user_id, role) for user_id, (group_id, role) in self.members.items()]
+
+    def save_member(self, group_id, user_id, role):
+        self.members[user_id] = (group_id, role)
+
+    def delete_member(self, user_id):
+        self.members.pop(user_id, None)
+
+    def load_thresholds(self):
+        """{(user_id, recipient_id): (distancia, intervalo, keepalive)}"""
+        return dict(self.thresholds)
+
+    def save_thresholds(self, user_id, recipient_id, thresholds):
+        self.thresholds[(user_id, recipient_id)] = tuple(thresholds)
+
+    def load_geofences(self):
+        """[(user_id, nombre, lat, lon, radio)]"""
+        return [(user_id, name, *fence) for (user_id, name), fence in self.geofences.items()]
+
+    def save_geofence(self, user_id, name, latitude, longitude, radius):
+        self.geofences[(user_id, name)] = (latitude, longitude, radius)
+
+    def delete_geofence(self, user_id, name):
+        self.geofences.pop((user_id, name), None)
+
+    def load_user_schedules(self):
+        """[(user_id, nombre, hora, minuto, días, zona, activo)]; None = lo de la definición"""
+        return [(*key, *settings) for key, settings in self.user_schedules.items()]
+
+    def save_user_schedule(self, user_id, name, hour, minute, days, timezone, enabled):
+        self.user_schedules[(user_id, name)] = (hour, minute, days, timezone, enabled)
+
+    def delete_user_schedule(self, user_id, name):
+        self.user_schedules.pop((user_id, name), None)
+
+    def notify_change(self):
+        """Avisa a los otros workers que recarguen hogares y horarios"""
+
+    def save_invite(self, code, group_id, role, expires_at):
+        self.invites[code] = (group_id, role, expires_at)
+
+    def pop_invite(self, code):
+        """(group_id, rol, expires_at) de la invitación, que se consume, o None"""
+        return self.invites.pop(code, None)
+
+    def publish_fixes(self, fixes):
+        """Comparte [(user_id, timestamp, lat, lon, velocidad)] con los demás workers"""
+        for user_id, *fix in fixes:
+            self.shared_fixes[user_id] = tuple(fix)
+
+    def get_shared_fix(self, user_id):
+        return self.shared_fixes.get(user_id)
+
+    def add_outbox(self, entries):
+        """Anota [(clave, shard, bot, método, params, hook, created_at)] como
+        pendientes; devuelve las claves nuevas (las ya anotadas se ignoran)"""
+        added = []
+        for key, shard, bot, method, params, hook, created_at in entries:
+            if key not in self.outbox:
+                self.outbox[key] = [shard, bot, method, params, hook, 'pending', 0, created_at, created_at, None]
+                added.append(key)
+        return added
+
+    def load_outbox(self, shard):
+        """[(clave, bot, método, params, hook, intentos, next_at, created_at)] pendientes del shard"""
+        return [(key, *entry[1:5], *entry[6:9]) for key, entry in self.outbox.items()
+                if entry[0] == shard and entry[5] == 'pending']
+
+    def update_outbox(self, key, status, attempts, next_at, error=None):
+        entry = self.outbox.get(key)
+        if entry is not None:
+            entry[5:8] = [status, attempts, next_at]
+            entry[9] = error
+
+    def outbox_counts(self):
+        """{estado: cantidad} de la outbox ('pending', 'sent', 'dead')"""
+        counts = defaultdict(int)
+        for entry in self.outbox.values():
+            counts[entry[5]] += 1
+        return dict(counts)
+
+    def purge_expired(self, now=None):
+        """Elimina las entradas vencidas; devuelve cuántas se borraron"""
+        now = time.time() if now is None else now
+        expired_live = [key for key, entry in self.live_messages.items() if entry[1] <= now]
+        for key in expired_live:
+            self.delete_live_message(*key)
+        expired_pending = [key for key, entry in self.pending.items() if entry[2] <= now]
+        for key in expired_pending:
+            self.pop_pending_request(key)
+        self.invites = {code: invite for code, invite in self.invites.items() if invite[2] > now}
+        self.outbox = {
+            key: entry for key, entry in self.outbox.items()
+            if entry[5] == 'pending'
+            or entry[8] > now - (OUTBOX_KEEP if entry[5] == 'sent' else OUTBOX_DEAD_KEEP)}
+        return len(expired_live) + len(expired_pending)
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """Estado en memoria con escritura diferida por lotes en SQLite (WAL).
+
+    Las lecturas siempre se resuelven desde los índices en memoria; las
+    escrituras se acumulan (la última por clave gana) y se vuelcan en una sola
+    transacción cada STATE_FLUSH_INTERVAL o al llegar a STATE_BATCH_SIZE.
+
+    Con varios workers todos abren el mismo archivo: cada uno escribe solo los
+    mensajes en tiempo real de sus usuarios, y hogares, invitaciones y
+    últimas posiciones se leen de la base (ver members_version). Las
+    solicitudes pendientes de usuarios de otro shard van directo a la base,
+    de donde las borra el worker del destinatario. La outbox se escribe sin
+    demora y cada worker reanuda solo las filas de su shard.
+    """
+
+    def __init__(self, path=STATE_DB_PATH, batch_size=STATE_BATCH_SIZE):
+        super().__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self._dirty_live = {}
+        self._dirty_pending = {}
+        self._owns = None  # con varios workers: True si el usuario es de este shard
+        import sqlite3  # solo con STATE_BACKEND=sqlite
+        self.conn = sqlite3.connect(path, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS live_messages (
+                user_id TEXT NOT NULL,
+                recipient_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (user_id, recipient_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS pending_requests (
+                target_id TEXT PRIMARY KEY,
+                requester TEXT NOT NULL,
+                requested_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS members (
+                user_id TEXT PRIMARY KEY,
+                group_id TEXT NOT NULL,
+                role TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS movement_thresholds (
+                user_id TEXT NOT NULL,
+                recipient_id TEXT NOT NULL,
+                min_distance REAL NOT NULL,
+                min_interval REAL NOT NULL,
+                keepalive REAL NOT NULL,
+                PRIMARY KEY (user_id, recipient_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS geofences (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                radius REAL NOT NULL,
+                PRIMARY KEY (user_id, name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS user_schedules (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                hour INTEGER,
+                minute INTEGER,
+                days TEXT,
+                timezone TEXT,
+                enabled INTEGER,
+                PRIMARY KEY (user_id, name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS invites (
+                code TEXT PRIMARY KEY,
+                group_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS shared_fixes (
+                user_id TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                speed REAL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS outbox (
+                key TEXT PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                bot TEXT NOT NULL,
+                method TEXT NOT NULL,
+                params TEXT NOT NULL,
+                hook TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                next_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                error TEXT
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, shard);
+            CREATE TABLE IF NOT EXISTS members_version (version INTEGER NOT NULL);
+            INSERT INTO members_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM members_version);
+        """)
+
+    def load(self, owns=None):
+        """Carga en memoria las entradas vigentes; devuelve cuántas se cargaron.
+
+        Con `owns` solo se cargan las de los usuarios para los que devuelve True
+        (los mensajes en tiempo real del resto los gestiona otro worker).
+        """
+        now = time.time()
+        self._owns = owns
+        with self.conn:
+            self.conn.execute("DELETE FROM live_messages WHERE expires_at <= ?", (now,))
+            self.conn.execute("DELETE FROM pending_requests WHERE expires_at <= ?", (now,))
+        for user_id, recipient_id, message_id, expires_at in self.conn.execute(
+                "SELECT user_id, recipient_id, message_id, expires_at FROM live_messages"):
+            if owns is None or owns(user_id):
+                self.live_messages[(user_id, recipient_id)] = (message_id, expires_at)
+        for target_id, requester, requested_at, expires_at in self.conn.execute(
+                "SELECT target_id, requester, requested_at, expires_at FROM pending_requests"):
+            if owns is None or owns(target_id):
+                self.pending[target_id] = (requester, requested_at, expires_at)
+        return len(self.live_messages) + len(self.pending)
+
+    def members_version(self):
+        return self.conn.execute("SELECT version FROM members_version").fetchone()[0]
+
+    def _mark_dirty(self):
+        if len(self._dirty_live) + len(self._dirty_pending) >= self.batch_size:
+            self.flush()
+
+    def set_live_message(self, user_id, recipient_id, message_id, live_period, now=None):
+        super().set_live_message(user_id, recipient_id, message_id, live_period, now)
+        key = (user_id, recipient_id)
+        self._dirty_live[key] = self.live_messages[key]
+        self._mark_dirty()
+
+    def delete_live_message(self, user_id, recipient_id):
+        super().delete_live_message(user_id, recipient_id)
+        self._dirty_live[(user_id, recipient_id)] = None
+        self._mark_dirty()
+
+    def set_pending_request(self, target_id, requester, now=None):
+        if self._owns is not None and not self._owns(target_id):
+            # La solicitud la resuelve el worker del destinatario: solo en la base
+            now = time.time() if now is None else now
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO pending_requests VALUES (?, ?, ?, ?)",
+                    (target_id, requester, now, now + PENDING_REQUEST_TTL))
+            return
+        super().set_pending_request(target_id, requester, now)
+        self._dirty_pending[target_id] = self.pending[target_id]
+        self._mark_dirty()
+
+    def pop_pending_request(self, target_id):
+        entry = super().pop_pending_request(target_id)
+        if entry is not None:
+            self._dirty_pending[target_id] = None
+            self._mark_dirty()
+        elif self._owns is not None:
+            # Puede haberla escrito el worker de quien la pidió (ver set_pending_request)
+            with self.conn:
+                entry = self.conn.execute(
+                    "SELECT requester, requested_at, expires_at FROM pending_requests "
+                    "WHERE target_id = ?", (target_id,)).fetchone()
+                if entry is not None:
+                    self.conn.execute("DELETE FROM pending_requests WHERE target_id = ?", (target_id,))
+        return entry
+
+    def flush(self):
+        if not self._dirty_live and not self._dirty_pending:
+            return
+        live, self._dirty_live = self._dirty_live, {}
+        pending, self._dirty_pending = self._dirty_pending, {}
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO live_messages VALUES (?, ?, ?, ?)",
+                [(*key, *entry) for key, entry in live.items() if entry is not None])
+            self.conn.executemany(
+                "DELETE FROM live_messages WHERE user_id = ? AND recipient_id = ?",
+                [key for key, entry in live.items() if entry is None])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pending_requests VALUES (?, ?, ?, ?)",
+                [(key, *entry) for key, entry in pending.items() if entry is not None])
+            self.conn.executemany(
+                "DELETE FROM pending_requests WHERE target_id = ?",
+                [(key,) for key, entry in pending.items() if entry is None])
+
+    def load_members(self):
+        return list(self.conn.execute("SELECT group_id, user_id, role FROM members"))
+
+    # Los cambios de membresía son poco frecuentes: se escriben de inmediato
+    def save_member(self, group_id, user_id, role):
+        super().save_member(group_id, user_id, role)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO members VALUES (?, ?, ?)", (user_id, group_id, role))
+            self.conn.execute("UPDATE members_version SET version = version + 1")
+
+    def delete_member(self, user_id):
+        super().delete_member(user_id)
+        with self.conn:
+            self.conn.execute("DELETE FROM members WHERE user_id = ?", (user_id,))
+            self.conn.execute("UPDATE members_version SET version = version + 1")
+
+    def load_thresholds(self):
+        return {(user_id, recipient_id): (min_distance, min_interval, keepalive)
+                for user_id, recipient_id, min_distance, min_interval, keepalive in self.conn.execute(
+                    "SELECT user_id, recipient_id, min_distance, min_interval, keepalive "
+                    "FROM movement_thresholds")}
+
+    def save_thresholds(self, user_id, recipient_id, thresholds):
+        super().save_thresholds(user_id, recipient_id, thresholds)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO movement_thresholds VALUES (?, ?, ?, ?, ?)",
+                (user_id, recipient_id, *thresholds))
+
+    def load_geofences(self):
+        return list(self.conn.execute(
+            "SELECT user_id, name, latitude, longitude, radius FROM geofences"))
+
+    def save_geofence(self, user_id, name, latitude, longitude, radius):
+        super().save_geofence(user_id, name, latitude, longitude, radius)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geofences VALUES (?, ?, ?, ?, ?)",
+                (user_id, name, latitude, longitude, radius))
+
+    def delete_geofence(self, user_id, name):
+        super().delete_geofence(user_id, name)
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM geofences WHERE user_id = ? AND name = ?", (user_id, name))
+
+    def load_user_schedules(self):
+        return list(self.conn.execute(
+            "SELECT user_id, name, hour, minute, days, timezone, enabled FROM user_schedules"))
+
+    # Los horarios los programa un solo worker: igual que los hogares, avisan por members_version
+    def save_user_schedule(self, user_id, name, hour, minute, days, timezone, enabled):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO user_schedules VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, name, hour, minute, days, timezone, enabled))
+            self.conn.execute("UPDATE members_version SET version = version + 1")
+
+    def delete_user_schedule(self, user_id, name):
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM user_schedules WHERE user_id = ? AND name = ?", (user_id, name))
+            self.conn.execute("UPDATE members_version SET version = version + 1")
+
+    def notify_change(self):
+        with self.conn:
+            self.conn.execute("UPDATE members_version SET version = version + 1")
+
+    # Invitaciones en la base: se pueden canjear en cualquier worker
+    def save_invite(self, code, group_id, role, expires_at):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO invites VALUES (?, ?, ?, ?)", (code, group_id, role, expires_at))
+
+    def pop_invite(self, code):
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT group_id, role, expires_at FROM invites WHERE code = ?", (code,)).fetchone()
+            if row is not None:
+                self.conn.execute("DELETE FROM invites WHERE code = ?", (code,))
+        return row
+
+    def publish_fixes(self, fixes):
+        if not fixes:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO shared_fixes VALUES (?, ?, ?, ?, ?)", fixes)
+
+    def get_shared_fix(self, user_id):
+        return self.conn.execute(
+            "SELECT timestamp, latitude, longitude, speed FROM shared_fixes WHERE user_id = ?",
+            (user_id,)).fetchone()
+
+    # La outbox se escribe de inmediato: es lo que permite reanudar tras una caída
+    def add_outbox(self, entries):
+        added = []
+        with self.conn:
+            for key, shard, bot, method, params, hook, created_at in entries:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO outbox VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?, NULL)",
+                    (key, shard, bot, method, params, hook, created_at, created_at))
+                if cursor.rowcount:
+                    added.append(key)
+        return added
+
+    def load_outbox(self, shard):
+        return list(self.conn.execute(
+            "SELECT key, bot, method, params, hook, attempts, next_at, created_at FROM outbox "
+            "WHERE status = 'pending' AND shard = ?", (shard,)))
+
+    def update_outbox(self, key, status, attempts, next_at, error=None):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_at = ?, error = ? WHERE key = ?",
+                (status, attempts, next_at, error, key))
+
+    def outbox_counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+
+    def purge_expired(self, now=None):
+        now = time.time() if now is None else now
+        purged = super().purge_expired(now)
+        with self.conn:
+            self.conn.execute("DELETE FROM invites WHERE expires_at <= ?", (now,))
+            self.conn.execute("DELETE FROM pending_requests WHERE expires_at <= ?", (now,))
+            self.conn.execute("DELETE FROM outbox WHERE status = 'sent' AND created_at <= ?",
+                              (now - OUTBOX_KEEP,))
+            self.conn.execute("DELETE FROM outbox WHERE status = 'dead' AND created_at <= ?",
+                              (now - OUTBOX_DEAD_KEEP,))
+        return purged
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def create_state_store():
+    if STATE_BACKEND == 'memory':
+        return MemoryStateStore()
+    return SQLiteStateStore(STATE_DB_PATH)
+
+
+class Outbox(BackgroundLoop):
+    """Cola de salida durable: cada envío se anota en el estado antes de
+    llamar a la Bot API y se marca como enviado cuando Telegram lo acepta.
+
+    - La clave de idempotencia identifica al envío (p. ej. el update que lo
+      originó y el destinatario); una clave ya anotada no se vuelve a encolar.
+    - RetryAfter y errores de red se reintentan con backoff exponencial con
+      jitter; los errores permanentes, o agotar OUTBOX_MAX_ATTEMPTS, dejan la
+      entrada como 'dead' con el último error (dead letter).
+    - Al arrancar se reanudan los pendientes de este shard; los que llevan más
+      de OUTBOX_MAX_AGE sin salir pasan a dead letter en vez de enviarse tarde.
+    - Al completarse se llama el hook del envío, un nombre registrado con
+      add_hook más argumentos serializables, con el resultado de la API.
+
+    Si el proceso muere después de que Telegram aceptó un envío pero antes de
+    marcarlo, se repite al reanudar: la entrega es "al menos una vez".
+    """
+
+    def __init__(self, state, shard=0, metrics=None, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 retry_base=OUTBOX_RETRY_BASE, retry_max=OUTBOX_RETRY_MAX, concurrency=OUTBOX_CONCURRENCY,
+                 max_age=OUTBOX_MAX_AGE):
+        super().__init__()
+        self.state = state
+        self.max_age = max_age
+        self.shard = shard
+        self.metrics = metrics
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.concurrency = concurrency
+        self.bots = {}  # nombre -> Bot
+        self.hooks = {}  # nombre -> callable(resultado, *args)
+        self._entries = {}  # clave -> [bot, método, params, hook, intentos, next_at, created_at]
+        self._heap = []  # (next_at, clave); las entradas obsoletas se descartan al llegar a la cima
+        self._claimed = set()  # claves que está enviando otro (en línea o una difusión)
+        self._retrying = set()
+        self._sent_times = deque()
+        self.stats = {
+            'enqueued': 0,
+            'duplicates': 0,
+            'sent': 0,
+            'retried': 0,
+            'dead': 0,
+            'replayed': 0,
+        }
+
+    def add_bot(self, name, bot):
+        self.bots[name] = bot
+
+    def add_hook(self, name, hook):
+        self.hooks[name] = hook
+
+    def __len__(self):
+        return len(self._entries)
+
+    def enqueue(self, key, method, params, bot='main', hook=None):
+        """Anota un envío para que lo haga el loop de reintentos; False si la clave ya existía"""
+        return bool(self.enqueue_many([(key, method, params, bot, hook)]))
+
+    def enqueue_many(self, entries):
+        """Anota [(clave, método, params, bot, hook)] en una sola escritura;
+        devuelve las claves nuevas"""
+        now = time.time()
+        pending = {key: (method, params, bot, hook) for key, method, params, bot, hook in entries}
+        added = self.state.add_outbox([
+            (key, self.shard, bot, method, json.dumps(params, default=lambda value: value.to_dict()),
+             json.dumps(hook) if hook else None, now)
+            for key, (method, params, bot, hook) in pending.items()])
+        for key in added:
+            method, params, bot, hook = pending[key]
+            self._entries[key] = [bot, method, params, hook, 0, now, now]
+            heapq.heappush(self._heap, (now, key))
+        self.stats['enqueued'] += len(added)
+        self.stats['duplicates'] += len(entries) - len(added)
+        if added:
+            self._wakeup.set()
+        return added
+
+    @contextmanager
+    def claim(self, keys):
+        """Mientras dure, el loop de reintentos no toca estas claves; al salir
+        las que sigan pendientes vuelven a su cargo"""
+        keys = set(keys)
+        self._claimed |= keys
+        try:
+            yield
+        finally:
+            self._claimed -= keys
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    heapq.heappush(self._heap, (entry[5], key))
+            self._wakeup.set()
+
+    async def send(self, key, method, params, bot='main', hook=None, raise_errors=False):
+        """Anota el envío y lo intenta de inmediato.
+
+        Devuelve el resultado de la API, o None si la clave ya existía o si el
+        intento falló (queda reprogramado o en dead letter, y en el log). Con
+        `raise_errors` el error del intento se propaga, p. ej. para contarlo.
+        """
+        if not self.enqueue(key, method, params, bot, hook):
+            return None
+        with self.claim([key]):
+            try:
+                return await self.deliver(key)
+            except Exception:
+                if raise_errors:
+                    raise
+                return None
+
+    async def deliver(self, key):
+        """Un intento de envío de una entrada pendiente.
+
+        Devuelve el resultado de la API (None si la clave ya no está pendiente).
+        Si falla, la entrada queda reprogramada o en dead letter y el error se
+        propaga a quien llamó (BulkDispatcher decide sus propios reintentos).
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        bot, method, params, hook, attempts, _, created_at = entry
+        if time.time() - created_at > self.max_age:
+            self._dead(key, entry, f"vencido: más de {self.max_age:.0f}s sin enviarse")
+            return None
+        entry[4] = attempts = attempts + 1
+        try:
+            result = await getattr(self.bots[bot], method)(**params)
+        except RetryAfter as e:
+            self._reschedule(key, entry, e.retry_after, e)
+            raise
+        except BadRequest as e:
+            # Subclase de NetworkError, pero repetirla no cambia nada
+            self._dead(key, entry, e)
+            raise
+        except NetworkError as e:
+            # Incluye TimedOut: error transitorio
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            self._reschedule(key, entry, delay * random.uniform(0.5, 1.5), e)
+            raise
+        except Exception as e:
+            self._dead(key, entry, e)
+            raise
+
+        del self._entries[key]
+        self.state.update_outbox(key, 'sent', attempts, time.time())
+        self.stats['sent'] += 1
+        now = time.monotonic()
+        self._sent_times.append(now)
+        self._trim_sent_times(now)
+        if self.metrics is not None:
+            self.metrics.observe('outbox_lag_seconds', method, time.time() - created_at)
+        if hook:
+            name, *args = hook
+            try:
+                self.hooks[name](result, *args)
+            except Exception as e:
+                logger.error("Error en hook %s del envío %s: %s", name, key, e)
+        return result
+
+    def _reschedule(self, key, entry, delay, error):
+        attempts = entry[4]
+        if attempts >= self.max_attempts:
+            self._dead(key, entry, error)
+            return
+        entry[5] = next_at = time.time() + delay
+        self.state.update_outbox(key, 'pending', attempts, next_at, str(error))
+        heapq.heappush(self._heap, (next_at, key))
+        self.stats['retried'] += 1
+        self._wakeup.set()
+        logger.warning("Envío %s reprogramado en %.1fs (intento %s): %s", key, delay, attempts, error)
+
+    def _dead(self, key, entry, error):
+        del self._entries[key]
+        self.state.update_outbox(key, 'dead', entry[4], time.time(), str(error))
+        self.stats['dead'] += 1
+        logger.error("Envío %s descartado tras %s intentos (dead letter): %s", key, entry[4], error)
+
+    def _trim_sent_times(self, now):
+        cutoff = now - OUTBOX_RATE_WINDOW
+        while self._sent_times and self._sent_times[0] < cutoff:
+            self._sent_times.popleft()
+
+    def drain_rate(self):
+        """Envíos completados por segundo en los últimos OUTBOX_RATE_WINDOW segundos"""
+        self._trim_sent_times(time.monotonic())
+        return len(self._sent_times) / OUTBOX_RATE_WINDOW
+
+    def snapshot(self):
+        """Contadores más profundidad, tasa de vaciado y antigüedad del más viejo"""
+        now = time.time()
+        stats = dict(self.stats)
+        stats['depth'] = len(self._entries)
+        stats['in_flight'] = len(self._claimed) + len(self._retrying)
+        stats['drain_rate'] = round(self.drain_rate(), 3)
+        stats['oldest_s'] = round(max((now - entry[6] for entry in self._entries.values()), default=0), 1)
+        return stats
+
+    async def _replay(self):
+        """Reanuda los envíos que quedaron pendientes en una ejecución anterior;
+        los de más de `max_age` pasan a dead letter sin enviarse"""
+        replayed = expired = 0
+        now = time.time()
+        for key, bot, method, params, hook, attempts, next_at, created_at in self.state.load_outbox(self.shard):
+            if key in self._entries:
+                continue
+            if now - created_at > self.max_age:
+                self.state.update_outbox(key, 'dead', attempts, now, f"vencido al reanudar ({now - created_at:.0f}s)")
+                self.stats['dead'] += 1
+                expired += 1
+                continue
+            if bot not in self.bots:
+                bot = 'main'
+            self._entries[key] = [bot, method, json.loads(params), json.loads(hook) if hook else None,
+                                  attempts, next_at, created_at]
+            heapq.heappush(self._heap, (next_at, key))
+            replayed += 1
+        if replayed:
+            for bot in self.bots.values():
+                await bot.initialize()
+            self.stats['replayed'] += replayed
+            logger.info("Outbox: %s envíos pendientes reanudados", replayed)
+        if expired:
+            logger.warning("Outbox: %s envíos pendientes vencidos (dead letter)", expired)
+
+    async def _run(self):
+        try:
+            await self._replay()
+        except Exception as e:
+            logger.error("Error reanudando la outbox: %s", e)
+        while True:
+            self._wakeup.clear()
+            await self._sleep(self._dispatch_due())
+
+    def _dispatch_due(self):
+        """Lanza los envíos vencidos; devuelve cuánto esperar al próximo o None"""
+        now = time.time()
+        while self._heap and len(self._retrying) < self.concurrency:
+            next_at, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is None or entry[5] != next_at or key in self._claimed or key in self._retrying:
+                # Obsoleta, o la tiene otro: si falla, la reprograma quien la envía
+                heapq.heappop(self._heap)
+                continue
+            if next_at > now:
+                return next_at - now
+            heapq.heappop(self._heap)
+            self._retrying.add(key)
+            asyncio.create_task(self._retry(key))
+        return None
+
+    async def _retry(self, key):
+        _correlation_id.set(f"outbox-{key}")
+        try:
+            await self.deliver(key)
+        except Exception:
+            pass  # ya quedó reprogramada o en dead letter
+        finally:
+            self._retrying.discard(key)
+            self._wakeup.set()
+
+
+class WeeklyJob:
+    """Trabajo que se repite ciertos días de la semana a una hora local fija"""
+
+    # Días hacia adelante en que se busca la próxima ejecución (los feriados pueden saltar semanas)
+    MAX_LOOKAHEAD = 400
+
+    def __init__(self, name, weekdays, hour, minute, callback, tz=CHILE_TZ, holidays=()):
+        self.name = name
+        self.job_id = name  # clave en el AsyncScheduler
+        self.weekdays = frozenset(weekdays)
+        self.hour = hour
+        self.minute = minute
+        self.callback = callback
+        self.tz = tz
+        self.holidays = frozenset(holidays)  # fechas locales en que no se ejecuta
+
+    def next_run(self, after):
+        """Próxima ejecución (UTC) estrictamente posterior a `after` (UTC).
+
+        Se recalcula en la zona horaria del trabajo en cada llamada, así los
+        cambios de horario de verano se respetan sin reprogramar nada.
+        """
+        local_date = after.astimezone(self.tz).date()
+        for offset in range(self.MAX_LOOKAHEAD if self.holidays else 8):
+            day = local_date + timedelta(days=offset)
+            if day.weekday() not in self.weekdays or day in self.holidays:
+                continue
+            naive = datetime(day.year, day.month, day.day, self.hour, self.minute)
+            # normalize() desplaza horas inexistentes (salto de horario de verano)
+            candidate = self.tz.normalize(self.tz.localize(naive)).astimezone(pytz.UTC)
+            if candidate > after:
+                return candidate
+        return None
+
+
+class AsyncScheduler(BackgroundLoop):
+    """Planificador que corre dentro del loop de la Application.
+
+    Los trabajos se ordenan en un heap por su próxima ejecución y una sola
+    tarea duerme hasta el plazo más cercano; no hay hilos ni loops por trabajo.
+    """
+
+    # Tope de cada espera, para reaccionar a saltos del reloj del sistema
+    MAX_SLEEP = 3600
+
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+        self._counter = 0
+        self._stale = 0  # entradas del heap de trabajos quitados o reemplazados
+        self.jobs = {}
+
+    def add_job(self, job, now=None):
+        now = datetime.now(pytz.UTC) if now is None else now
+        replaced = self.jobs.get(job.job_id)
+        self.jobs[job.job_id] = job
+        if replaced is not None and replaced is not job:
+            self._discard()
+        self._push(job, job.next_run(now))
+        self._wakeup.set()
+
+    def remove_job(self, job_id):
+        """Quita un trabajo; su entrada en el heap se descarta al llegar a la cima"""
+        if self.jobs.pop(job_id, None) is not None:
+            self._discard()
+
+    def _discard(self):
+        """Cuenta una entrada obsoleta y compacta el heap cuando superan a las vigentes,
+        así los trabajos que vencen en semanas no se acumulan"""
+        self._stale += 1
+        if self._stale > max(64, len(self.jobs)):
+            self._heap = [entry for entry in self._heap if self.jobs.get(entry[2].job_id) is entry[2]]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def _push(self, job, when):
+        if when is None:
+            return
+        self._counter += 1
+        heapq.heappush(self._heap, (when, self._counter, job))
+
+    def next_runs(self):
+        """[(job_id, próxima ejecución UTC)] ordenado por fecha"""
+        return [(job.job_id, when) for when, _, job in sorted(self._heap)
+                if self.jobs.get(job.job_id) is job]
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._sleep()
+                continue
+
+            when, _, job = self._heap[0]
+            if self.jobs.get(job.job_id) is not job:
+                heapq.heappop(self._heap)  # trabajo quitado o reemplazado
+                self._stale = max(0, self._stale - 1)
+                continue
+            delay = (when - datetime.now(pytz.UTC)).total_seconds()
+            if delay > 0:
+                await self._sleep(min(delay, self.MAX_SLEEP))
+                continue
+
+            heapq.heappop(self._heap)
+            self._push(job, job.next_run(when))
+            asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job):
+        try:
+            _correlation_id.set(f"job-{job.name}-{int(time.time())}")
+            await job.callback()
+        except Exception as e:
+            logger.error("Error en trabajo programado %s: %s", job.job_id, e)
+
+
+class PairingRegistry:
+    """Registro de hogares (grupos de usuarios que comparten ubicación).
+
+    Mantiene índices en memoria para que autorizar un usuario y obtener sus
+    destinatarios sean búsquedas O(1); los destinatarios de cada usuario se
+    precalculan y se invalidan solo cuando cambia su hogar.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.groups = {}  # group_id -> {user_id: role}
+        self.user_group = {}  # user_id -> group_id
+        self._recipients = {}  # user_id -> ((recipient_id, role), ...)
+        self._version = None
+
+    def load(self):
+        self._version = self.state.members_version()
+        for group_id, user_id, role in self.state.load_members():
+            self._index(group_id, user_id, role)
+        return len(self.user_group)
+
+    def refresh(self):
+        """Recarga los hogares si otro worker los modificó; devuelve True si recargó"""
+        if self.state.members_version() == self._version:
+            return False
+        self.groups = {}
+        self.user_group = {}
+        self._recipients = {}
+        self.load()
+        return True
+
+    def seed(self, group_id, members):
+        """Registra un hogar inicial (p. ej. desde variables de entorno) solo si no
+        hay ningún miembro guardado: quien salió con /salir no vuelve al redesplegar"""
+        if self.user_group:
+            return
+        for user_id, role in members:
+            if user_id and user_id not in self.user_group:
+                self.add_member(group_id, user_id, role)
+
+    def _index(self, group_id, user_id, role):
+        self.groups.setdefault(group_id, {})[user_id] = role
+        self.user_group[user_id] = group_id
+        self._invalidate(group_id)
+
+    def _invalidate(self, group_id):
+        for member_id in self.groups.get(group_id, ()):
+            self._recipients.pop(member_id, None)
+
+    def add_member(self, group_id, user_id, role):
+        if user_id in self.user_group:
+            self.remove_member(user_id)
+        self._index(group_id, user_id, role)
+        self.state.save_member(group_id, user_id, role)
+
+    def remove_member(self, user_id):
+        group_id = self.user_group.pop(user_id, None)
+        if group_id is None:
+            return
+        self._invalidate(group_id)
+        self._recipients.pop(user_id, None)
+        members = self.groups[group_id]
+        members.pop(user_id, None)
+        if not members:
+            del self.groups[group_id]
+        self.state.delete_member(user_id)
+
+    def create_group(self):
+        """Reserva un group_id nuevo; el hogar existe (y se guarda) con su primer miembro"""
+        group_id = secrets.token_hex(4)
+        while group_id in self.groups:
+            group_id = secrets.token_hex(4)
+        return group_id
+
+    def is_authorized(self, user_id):
+        return user_id in self.user_group
+
+    def role_of(self, user_id):
+        group_id = self.user_group.get(user_id)
+        if group_id is None:
+            return None
+        return self.groups[group_id][user_id]
+
+    def recipients(self, user_id):
+        """((recipient_id, role), ...) de los demás miembros del hogar"""
+        cached = self._recipients.get(user_id)
+        if cached is None:
+            group_id = self.user_group.get(user_id)
+            if group_id is None:
+                return ()
+            cached = tuple(
+                (member_id, role) for member_id, role in self.groups[group_id].items()
+                if member_id != user_id)
+            self._recipients[user_id] = cached
+        return cached
+
+    def all_members(self):
+        return list(self.user_group)
+
+    def members_with_role(self, roles):
+        return [user_id for user_id, group_id in self.user_group.items()
+                if self.groups[group_id][user_id] in roles]
+
+    def create_invite(self, group_id, role=DEFAULT_MEMBER_ROLE, now=None):
+        now = time.time() if now is None else now
+        code = secrets.token_urlsafe(6)
+        self.state.save_invite(code, group_id, role, now + INVITE_TTL)
+        return code
+
+    def redeem_invite(self, code, user_id, role=None, now=None):
+        """Une al usuario al hogar de la invitación; devuelve el group_id o None"""
+        now = time.time() if now is None else now
+        invite = self.state.pop_invite(code)
+        if invite is None or invite[2] <= now:
+            return None
+        group_id, invite_role = invite[0], invite[1]
+        self.add_member(group_id, user_id, role or invite_role)
+        return group_id
+
+
+WEEKDAY_NAMES = {
+    'lun': 0, 'mar': 1, 'mie': 2, 'mié': 2, 'jue': 3, 'vie': 4, 'sab': 5, 'sáb': 5, 'dom': 6,
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+}
+
+
+def parse_time(text):
+    """'HH:MM' -> (hora, minuto); ValueError si no es una hora válida"""
+    hour, minute = (int(part) for part in text.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"hora inválida: {text}")
+    return hour, minute
+
+
+def parse_weekdays(text):
+    """'mar-jue', 'lun,mie,vie' o '1,2,3' -> tupla ordenada de días (0 = lunes)"""
+    days = set()
+    for part in str(text).lower().split(','):
+        bounds = [WEEKDAY_NAMES[bound] if bound in WEEKDAY_NAMES else int(bound)
+                  for bound in part.strip().split('-')]
+        if len(bounds) > 2 or not all(0 <= bound <= 6 for bound in bounds):
+            raise ValueError(f"días inválidos: {text}")
+        first, last = bounds[0], bounds[-1]
+        days.update((first + offset) % 7 for offset in range((last - first) % 7 + 1))
+    return tuple(sorted(days))
+
+
+class Schedule(WeeklyJob):
+    """Horario efectivo de una solicitud automática.
+
+    Las definiciones (SCHEDULE_FILE) son Schedule y los ajustes de un usuario
+    se derivan de ellas con derive(). Los usuarios con el mismo horario
+    efectivo comparten la instancia, que además es el trabajo del
+    AsyncScheduler: miles de usuarios con pocos horarios distintos son pocas
+    entradas en el heap y una difusión por horario.
+    """
+
+    def __init__(self, name, weekdays, hour, minute, tz, holidays=(), roles=None, message=None):
+        super().__init__(name, weekdays, hour, minute, None, tz, holidays)
+        self.roles = frozenset(roles) if roles is not None else None  # None = todos los miembros
+        self.message = message or SCHEDULE_MESSAGES.get(name, DEFAULT_SCHEDULE_MESSAGE)
+        self.key = (name, hour, minute, tuple(sorted(self.weekdays)), tz.zone)
+
+    def derive(self, hour, minute, weekdays, tz):
+        """La misma solicitud (audiencia, texto y feriados) con otra hora, días o zona"""
+        schedule = Schedule(self.name, weekdays, hour, minute, tz, self.holidays, self.roles, self.message)
+        days = ",".join(map(str, schedule.key[3]))
+        schedule.job_id = f"{self.name} {hour:02d}:{minute:02d} {days} {tz.zone}"
+        return schedule
+
+
+def load_schedule_definitions(path=SCHEDULE_FILE):
+    """Definiciones de horarios {nombre: Schedule} desde un archivo JSON, o las
+    de DEFAULT_SCHEDULES si el archivo no existe:
+
+        {"holidays": ["2026-09-18", "2026-09-19"],
+         "schedules": [{"name": "matutino", "time": "06:30", "days": "mar-jue",
+                        "timezone": "America/Santiago", "roles": ["esposa"]}]}
+
+    `days` acepta una lista (0 = lunes) o texto como en /horario; cada horario
+    puede traer sus propios `holidays` y un `message` con {time}.
+    """
+    config = {'schedules': DEFAULT_SCHEDULES}
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    common_holidays = {date.fromisoformat(day) for day in config.get('holidays', ())}
+    definitions = {}
+    for entry in config['schedules']:
+        name = entry['name']
+        if name == '*':
+            raise ValueError("'*' no es un nombre de horario válido")
+        days = entry.get('days', SCHEDULE_DAYS)
+        hour, minute = parse_time(entry['time'])
+        definitions[name] = Schedule(
+            name,
+            parse_weekdays(days) if isinstance(days, str) else days,
+            hour, minute,
+            pytz.timezone(entry.get('timezone', CHILE_TZ.zone)),
+            common_holidays | {date.fromisoformat(day) for day in entry.get('holidays', ())},
+            entry.get('roles'),
+            entry.get('message'),
+        )
+    return definitions
+
+
+class ScheduleRegistry:
+    """Horarios de las solicitudes automáticas: definiciones de SCHEDULE_FILE
+    más los ajustes de cada usuario (/horario, /zona) guardados en el estado.
+
+    Un ajuste es por nombre de definición o '*' para todas (p. ej. la zona
+    horaria); lo que no ajusta se toma de la definición. La audiencia de una
+    definición se calcula al ejecutarse (miembros con el rol, menos quienes
+    tienen ajustes) más los usuarios con ajustes cuyo horario quedó igual;
+    la de un horario derivado son los usuarios que lo eligieron.
+    """
+
+    FIELDS = ('hour', 'minute', 'days', 'timezone', 'enabled')
+
+    def __init__(self, state, path=SCHEDULE_FILE):
+        self.state = state
+        self.path = path
+        self.definitions = {}  # nombre -> Schedule
+        self.overrides = {}  # user_id -> {nombre o '*': (hora, minuto, días, zona, activo)}
+        self._schedules = {}  # Schedule.key -> Schedule (compartidos entre usuarios)
+        self._users = defaultdict(set)  # Schedule.key -> usuarios con ajustes que lo tienen
+        self._customized = defaultdict(set)  # nombre -> usuarios con ajustes para ese horario
+        self._user_keys = {}  # user_id -> Schedule.key de sus horarios con ajustes
+        self._scheduler = None
+        self._run = None
+        self._job_keys = {}  # Schedule.key -> job_id programado en el AsyncScheduler
+
+    def load(self):
+        """(Re)lee las definiciones y los ajustes; devuelve cuántas definiciones hay"""
+        self.definitions = load_schedule_definitions(self.path)
+        self.overrides = {}
+        for user_id, name, *settings in self.state.load_user_schedules():
+            self.overrides.setdefault(user_id, {})[name] = tuple(settings)
+        self._reindex()
+        return len(self.definitions)
+
+    def _reindex(self):
+        """Recalcula los índices de todos los usuarios (al cargar las definiciones).
+
+        Los horarios derivados que no cambiaron conservan su instancia, así el
+        AsyncScheduler no los vuelve a programar.
+        """
+        previous = self._schedules
+        self._schedules = {definition.key: definition for definition in self.definitions.values()}
+        self._users = defaultdict(set)
+        self._customized = defaultdict(set)
+        self._user_keys = {}
+        for user_id in self.overrides:
+            self._index_user(user_id)
+        for key, schedule in self._schedules.items():
+            old = previous.get(key)
+            if (old is not None and old is not schedule and not self._is_definition(schedule)
+                    and (old.holidays, old.roles, old.message)
+                    == (schedule.holidays, schedule.roles, schedule.message)):
+                self._schedules[key] = old
+        self._sync()
+
+    def _index_user(self, user_id):
+        """Agrega a los índices los horarios con ajustes del usuario; devuelve sus claves"""
+        rows = self.overrides.get(user_id, {})
+        keys = set()
+        for name, definition in self.definitions.items():
+            if name not in rows and '*' not in rows:
+                self._customized[name].discard(user_id)
+                continue
+            self._customized[name].add(user_id)
+            schedule = self._effective(user_id, definition)
+            if schedule is not None:
+                self._users[schedule.key].add(user_id)
+                keys.add(schedule.key)
+        if keys:
+            self._user_keys[user_id] = keys
+        return keys
+
+    def _reindex_user(self, user_id):
+        """Recalcula solo los horarios de `user_id` (tras /horario o /zona) y
+        reprograma únicamente los trabajos que ganaron o perdieron usuarios"""
+        old = self._user_keys.pop(user_id, set())
+        for key in old:
+            self._users[key].discard(user_id)
+        new = self._index_user(user_id)
+        for key in old - new:
+            if self._users[key]:
+                continue
+            del self._users[key]
+            schedule = self._schedules.get(key)
+            if schedule is not None and not self._is_definition(schedule):
+                del self._schedules[key]
+        self._sync(old ^ new)
+
+    def _is_definition(self, schedule):
+        return self.definitions.get(schedule.name) is schedule
+
+    def _is_active(self, key):
+        schedule = self._schedules.get(key)
+        return schedule is not None and (bool(self._users.get(key)) or self._is_definition(schedule))
+
+    def _effective(self, user_id, definition):
+        """Horario de `definition` para el usuario, o None si lo desactivó"""
+        rows = self.overrides.get(user_id)
+        if not rows:
+            return definition
+        layers = [row for row in (rows.get(definition.name), rows.get('*')) if row is not None]
+
+        def pick(index, default):
+            for row in layers:
+                if row[index] is not None:
+                    return row[index]
+            return default
+
+        if not pick(4, True):
+            return None
+        hour, minute = pick(0, definition.hour), pick(1, definition.minute)
+        days = pick(2, None)
+        weekdays = parse_weekdays(days) if days is not None else definition.weekdays
+        tz = pytz.timezone(pick(3, definition.tz.zone))
+        key = (definition.name, hour, minute, tuple(sorted(weekdays)), tz.zone)
+        schedule = self._schedules.get(key)
+        if schedule is None:
+            schedule = self._schedules[key] = definition.derive(hour, minute, weekdays, tz)
+        return schedule
+
+    def for_user(self, user_id):
+        """Horarios efectivos del usuario, en el orden de las definiciones"""
+        schedules = (self._effective(user_id, definition) for definition in self.definitions.values())
+        return tuple(schedule for schedule in schedules if schedule is not None)
+
+    def timezone_for(self, user_id):
+        row = self.overrides.get(user_id, {}).get('*')
+        if row is not None and row[3] is not None:
+            return pytz.timezone(row[3])
+        return next(iter(self.definitions.values())).tz if self.definitions else CHILE_TZ
+
+    def update(self, user_id, name, **changes):
+        """Ajusta el horario `name` (o '*') del usuario; los campos que no se
+        indican se conservan y un ajuste sin campos se borra"""
+        if name != '*' and name not in self.definitions:
+            raise KeyError(name)
+        rows = self.overrides.setdefault(user_id, {})
+        current = dict(zip(self.FIELDS, rows.get(name, (None,) * len(self.FIELDS))))
+        current.update(changes)
+        settings = tuple(current[field] for field in self.FIELDS)
+        if all(value is None for value in settings):
+            return self.reset(user_id, name)
+        rows[name] = settings
+        self.state.save_user_schedule(user_id, name, *settings)
+        self._reindex_user(user_id)
+        return True
+
+    def reset(self, user_id, name):
+        """Vuelve el horario `name` (o '*') del usuario al de la definición"""
+        rows = self.overrides.get(user_id)
+        if not rows or name not in rows:
+            if rows == {}:
+                del self.overrides[user_id]
+            return False
+        del rows[name]
+        if not rows:
+            del self.overrides[user_id]
+        self.state.delete_user_schedule(user_id, name)
+        self._reindex_user(user_id)
+        return True
+
+    def active(self):
+        """Definiciones más los horarios derivados que tiene algún usuario"""
+        return [schedule for key, schedule in self._schedules.items() if self._is_active(key)]
+
+    def audience(self, schedule, registry, group_id=None):
+        """Chats que reciben la solicitud de `schedule` al ejecutarse (solo los
+        del hogar `group_id` si se indica, p. ej. en /test)"""
+        def eligible(user_id):
+            return registry.is_authorized(user_id) and (
+                schedule.roles is None or registry.role_of(user_id) in schedule.roles)
+
+        chat_ids = [user_id for user_id in self._users.get(schedule.key, ()) if eligible(user_id)]
+        if self._is_definition(schedule):
+            customized = self._customized.get(schedule.name, ())
+            members = (registry.all_members() if schedule.roles is None
+                       else registry.members_with_role(schedule.roles))
+            chat_ids.extend(user_id for user_id in members if user_id not in customized)
+        if group_id is not None:
+            chat_ids = [user_id for user_id in chat_ids if registry.user_group.get(user_id) == group_id]
+        return chat_ids
+
+    def attach(self, scheduler, run):
+        """Programa cada horario activo en `scheduler`; al ejecutarse se llama
+        `run(schedule)`. Los cambios posteriores se reflejan solos."""
+        self._scheduler = scheduler
+        self._run = run
+        self._sync()
+
+    def _sync(self, keys=None):
+        """Programa o quita los trabajos de los horarios `keys` (todos si es None)"""
+        if self._scheduler is None:
+            return
+        if keys is None:
+            keys = self._job_keys.keys() | self._schedules.keys()
+        active = [key for key in keys if self._is_active(key)]
+        # Primero las bajas: un job_id (nombre de definición) puede pasar a otra clave
+        for key in set(keys) - set(active):
+            job_id = self._job_keys.pop(key, None)
+            if job_id is not None:
+                self._scheduler.remove_job(job_id)
+        for key in active:
+            schedule = self._schedules[key]
+            if self._scheduler.jobs.get(schedule.job_id) is not schedule:
+                schedule.callback = functools.partial(self._run, schedule)
+                self._scheduler.add_job(schedule)
+            self._job_keys[key] = schedule.job_id
+
+
+# Teclado y texto fijo de las solicitudes de ubicación: se construyen una sola vez
+LOCATION_REQUEST_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📍 Compartir Ubicación", request_location=True)]
+], resize_keyboard=True, one_time_keyboard=True)
+
+LOCATION_REQUEST_FOOTER = (
+    f"\n\n"
+    f"📍 **Opciones de Ubicación:**\n"
+    f"• Ubicación normal: El bot la convierte a tiempo real automáticamente\n"
+    f"• Ubicación en tiempo real: Se mantiene y actualiza automáticamente\n\n"
+    f"💡 **Recomendación:** Para mejor precisión, usa 'Ubicación en tiempo real' desde Telegram"
+)
 
-# Cargar variables de entorno
-from dotenv import load_dotenv
-load_dotenv()
 
-# Configuración
-CHILE_TZ = pytz.timezone('America/Santiago')
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-CHAT_ID_TUYO = os.getenv('CHAT_ID_TUYO')
-CHAT_ID_ESPOSA = os.getenv('CHAT_ID_ESPOSA')
+class BulkDispatcher:
+    """Envía un mismo mensaje a muchos chats con concurrencia acotada.
 
-# Validación de variables requeridas
-if not BOT_TOKEN:
-    raise ValueError(
-        "BOT_TOKEN no configurado. Verifica tu archivo .env o variables de entorno en Railway")
+    Todos los envíos comparten un token bucket global; los errores de red se
+    reintentan con backoff exponencial con jitter y los RetryAfter pausan el
+    bucket el tiempo indicado por Telegram. Los errores permanentes (chat
+    bloqueado, chat inexistente) no se reintentan.
+    """
 
-if not CHAT_ID_TUYO or not CHAT_ID_ESPOSA:
-    print("WARNING: CHAT_ID_TUYO o CHAT_ID_ESPOSA no configurados")
+    def __init__(self, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 batch_size=BROADCAST_BATCH_SIZE, max_retries=BROADCAST_MAX_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
 
-AUTHORIZED_USERS = [CHAT_ID_TUYO, CHAT_ID_ESPOSA]
-bot_application = None
+    async def _acquire(self):
+        while True:
+            wait = self.bucket.delay()
+            if wait <= 0:
+                self.bucket.consume()
+                return
+            await asyncio.sleep(wait)
 
-# Configuración de ubicación en tiempo real
-LIVE_LOCATION_DURATION = 7200  # 2 horas en segundos (máximo recomendado)
+    async def dispatch(self, chat_ids, send, label="envío"):
+        """Llama `send(chat_id)` para cada chat y devuelve un reporte con
+        entregas, fallos, reintentos y latencia de cada lote"""
+        chat_ids = list(chat_ids)
+        report = {
+            'total': len(chat_ids),
+            'delivered': 0,
+            'failed': [],
+            'retries': 0,
+            'batches': [],
+        }
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
 
-# Logging
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+        for index in range(0, len(chat_ids), self.batch_size):
+            batch = chat_ids[index:index + self.batch_size]
+            batch_started = time.monotonic()
+            results = await asyncio.gather(
+                *(self._send_one(chat_id, send, semaphore, report) for chat_id in batch))
+            delivered = sum(results)
+            report['delivered'] += delivered
+            report['failed'].extend(chat_id for chat_id, ok in zip(batch, results) if not ok)
+            report['batches'].append({
+                'size': len(batch),
+                'delivered': delivered,
+                'latency': round(time.monotonic() - batch_started, 3),
+            })
+
+        report['elapsed'] = round(time.monotonic() - started, 3)
+        logger.info(
+            "%s: %s/%s entregados, %s fallidos, %s reintentos, %s lotes en %ss (lote más lento %ss)",
+            label, report['delivered'], report['total'], len(report['failed']), report['retries'],
+            len(report['batches']), report['elapsed'],
+            max((b['latency'] for b in report['batches']), default=0))
+        return report
+
+    async def _send_one(self, chat_id, send, semaphore, report):
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await self._acquire()
+                try:
+                    await send(chat_id)
+                    return True
+                except RetryAfter as e:
+                    self.bucket.pause(e.retry_after)
+                    delay = e.retry_after
+                except BadRequest as e:
+                    logger.error("Error permanente enviando a %s: %s", chat_id, e)
+                    return False
+                except NetworkError as e:
+                    # Incluye TimedOut: error transitorio, backoff con jitter
+                    delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+                    logger.warning("Error transitorio enviando a %s: %s", chat_id, e)
+                except Exception as e:
+                    logger.error("Error permanente enviando a %s: %s", chat_id, e)
+                    return False
+            if attempt < self.max_retries:
+                report['retries'] += 1
+                await asyncio.sleep(delay)
+        return False
+
+
+SHARE_LOCATION_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📍 Compartir Ubicación", request_location=True)]
+], resize_keyboard=True)
+
+
+# Textos de los comandos por idioma. Las secciones *_static solo dependen de la
+# configuración, así que se renderizan una vez por idioma; las de horarios se
+# arman desde ScheduleRegistry y se guardan por combinación de horarios y
+# offset UTC (ver MessageTemplates.schedules); el resto son plantillas con
+# datos por llamada.
+TEMPLATES = {
+    'es': {
+        'status_header': "🤖 Estado del Bot\n\n⏰ Hora actual: {current_time}\n",
+        'status_static': (
+            "\n📍 Funcionalidad:\n"
+            "• Convierte ubicaciones a tiempo real automáticamente\n"
+            "• Duración: {duration_hours}h\n"
+            "• Recibe actualizaciones en tiempo real\n\n"
+        ),
+        'status_household': "🏠 Miembros de tu hogar: {members}\n",
+        'status_operations': (
+            "📡 Ediciones en tiempo real:\n"
+            "• Recibidas: {received} | Enviadas: {sent}\n"
+            "• Agrupadas: {coalesced} | Descartadas: {dropped}\n"
+            "• Llamadas ahorradas: {calls_saved}\n"
+            "• RetryAfter: {retry_after} | Tasa: {rate_limit}/s\n"
+            "• Sin movimiento (no reenviadas): {suppressed} | Keepalive: {keepalive}\n\n"
+            "📤 Cola de salida: {depth} pendientes | {drain_rate}/s\n"
+            "• Reintentos: {retried} | Dead letter: {dead}\n\n"
+        ),
+        'status_metrics_title': "⏱️ Rendimiento (p50/p95/p99):\n",
+        'status_metrics_line': "• {name}: {p50:.0f}/{p95:.0f}/{p99:.0f} ms ({count} llamadas, {errors} errores)\n",
+        'status_api': "• API: {calls} llamadas, {errors} errores, {rate_limited} límites 429\n\n",
+        'status_users': "👥 Usuarios autorizados: {users}\n🏠 Hogares: {groups}\n",
+        'status_footer': "✅ Bot funcionando correctamente",
+        'start': "Hola {user_name}!\n\nRol: {user_role}\n\n",
+        'start_static': (
+            "🔄 **Funcionalidad de Ubicación en Tiempo Real:**\n"
+            "• Envía tu ubicación normal\n"
+            "• El bot la convierte automáticamente a tiempo real\n"
+            "• Duración: {duration_hours} horas\n"
+            "• Se actualiza automáticamente si compartes ubicación en vivo\n\n"
+        ),
+        'start_commands': (
+            "\nComandos:\n"
+            "/ubicacion - Solicitar ubicación\n"
+            "/test - Probar automatización\n"
+            "/status - Estado del bot\n"
+            "/hogar - Miembros de tu hogar\n"
+            "/invitar - Invitar a alguien a tu hogar\n"
+            "/horario - Ajustar tus solicitudes automáticas\n"
+            "/zona - Cambiar tu zona horaria"
+        ),
+        'schedule_zone': "🏠 Zona horaria: {timezone}\n\n",
+        'schedule_title': "📅 Automatización:\n",
+        'schedule_line': "• {time_ampm} ({days}): {audience}\n",
+        'schedule_none': "• Sin solicitudes automáticas\n",
+        'audience_all': "Todos",
+        'audience_roles': "Solo {roles}",
+        'time_header': (
+            "🕒 **Información de Horarios**\n\n"
+            "🌍 UTC actual: {utc_time}\n"
+            "🕓 Hora local ({timezone}): {local_time}\n\n"
+        ),
+        'time_title': "📅 **Automatización:**\n",
+        'time_line': "• {label}: {local_time} {zone} = {utc_time} UTC ({days})\n",
+        'time_next_run': "• Próximo {job_name}: {when}\n",
+        'schedule_set': "Horario {name}: {time} ({days}, {zone})\nPróximo envío: {when}",
+        'time_footer': (
+            "\n📍 **Ubicación en Tiempo Real:**\n"
+            "• Duración automática: {duration_hours}h\n"
+            "• Actualización: Automática"
+        ),
+        'labels': {'matutino': "Mañana", 'vespertino': "Tarde"},
+        'weekdays': ("Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"),
+        'date': "{weekday} {when:%d/%m %H:%M}",
+    },
+    'en': {
+        'status_header': "🤖 Bot Status\n\n⏰ Current time: {current_time}\n",
+        'status_static': (
+            "\n📍 Features:\n"
+            "• Converts locations to live locations automatically\n"
+            "• Duration: {duration_hours}h\n"
+            "• Receives live updates\n\n"
+        ),
+        'status_household': "🏠 Household members: {members}\n",
+        'status_operations': (
+            "📡 Live edits:\n"
+            "• Received: {received} | Sent: {sent}\n"
+            "• Coalesced: {coalesced} | Dropped: {dropped}\n"
+            "• Calls saved: {calls_saved}\n"
+            "• RetryAfter: {retry_after} | Rate: {rate_limit}/s\n"
+            "• No movement (not forwarded): {suppressed} | Keepalive: {keepalive}\n\n"
+            "📤 Outbox: {depth} pending | {drain_rate}/s\n"
+            "• Retries: {retried} | Dead letter: {dead}\n\n"
+        ),
+        'status_metrics_title': "⏱️ Performance (p50/p95/p99):\n",
+        'status_metrics_line': "• {name}: {p50:.0f}/{p95:.0f}/{p99:.0f} ms ({count} calls, {errors} errors)\n",
+        'status_api': "• API: {calls} calls, {errors} errors, {rate_limited} 429 limits\n\n",
+        'status_users': "👥 Authorized users: {users}\n🏠 Households: {groups}\n",
+        'status_footer': "✅ Bot running",
+        'start': "Hi {user_name}!\n\nRole: {user_role}\n\n",
+        'start_static': (
+            "🔄 **Live Location:**\n"
+            "• Send your regular location\n"
+            "• The bot turns it into a live location\n"
+            "• Duration: {duration_hours} hours\n"
+            "• Updates automatically if you share a live location\n\n"
+        ),
+        'start_commands': (
+            "\nCommands:\n"
+            "/ubicacion - Request location\n"
+            "/test - Test automation\n"
+            "/status - Bot status\n"
+            "/hogar - Household members\n"
+            "/invitar - Invite someone to your household\n"
+            "/horario - Adjust your automatic requests\n"
+            "/zona - Change your time zone"
+        ),
+        'schedule_zone': "🏠 Time zone: {timezone}\n\n",
+        'schedule_title': "📅 Automation:\n",
+        'schedule_line': "• {time_ampm} ({days}): {audience}\n",
+        'schedule_none': "• No automatic requests\n",
+        'audience_all': "Everyone",
+        'audience_roles': "{roles} only",
+        'time_header': (
+            "🕒 **Schedule Information**\n\n"
+            "🌍 Current UTC: {utc_time}\n"
+            "🕓 Local time ({timezone}): {local_time}\n\n"
+        ),
+        'time_title': "📅 **Automation:**\n",
+        'time_line': "• {label}: {local_time} {zone} = {utc_time} UTC ({days})\n",
+        'time_next_run': "• Next {job_name}: {when}\n",
+        'schedule_set': "Schedule {name}: {time} ({days}, {zone})\nNext run: {when}",
+        'time_footer': (
+            "\n📍 **Live Location:**\n"
+            "• Automatic duration: {duration_hours}h\n"
+            "• Updates: Automatic"
+        ),
+        'labels': {'matutino': "Morning", 'vespertino': "Evening"},
+        'weekdays': ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"),
+        'date': "{weekday} {when:%d/%m %H:%M}",
+    },
+}
+
+
+class MessageTemplates:
+    """Renderiza los textos de los comandos con caché de las partes estáticas.
+
+    Las secciones de horarios dependen del offset UTC de cada zona horaria
+    (las conversiones a UTC de /time): el offset es parte de la clave de la
+    caché y además la caché se vacía sola en el siguiente cambio de horario
+    de verano de la zona por defecto.
+    """
+
+    # Combinaciones de horarios distintas que se guardan antes de vaciar la caché
+    MAX_SCHEDULE_ENTRIES = 1024
+
+    def __init__(self, tz=CHILE_TZ, catalog=TEMPLATES):
+        self.tz = tz
+        self.catalog = catalog
+        self._cache = {}  # (locale, nombre) -> texto
+        self._schedule_cache = {}  # (locale, sección, zona, horarios, offsets) -> texto
+        self._offsets = {}  # zona -> (offset UTC en minutos, válido hasta)
+        self._valid_until = 0.0
+
+    def locale_for(self, user):
+        code = ((user and user.language_code) or '')[:2].lower()
+        return code if code in self.catalog else DEFAULT_LOCALE
+
+    def invalidate(self):
+        self._cache.clear()
+        self._schedule_cache.clear()
+        self._valid_until = 0.0
+
+    # Horizonte de búsqueda del próximo cambio de offset; sin cambio en ese
+    # plazo se vuelve a mirar al cumplirse
+    TRANSITION_HORIZON = 366 * 86400
+
+    def _next_transition(self, now, tz=None):
+        """Timestamp del próximo cambio de offset UTC de la zona (horario de verano)"""
+        tz = tz or self.tz
+
+        def offset(timestamp):
+            return datetime.fromtimestamp(timestamp, tz).utcoffset()
+
+        current = offset(now)
+        low = now
+        # Paso de un día hasta dar con un offset distinto; luego bisección al segundo
+        while low - now < self.TRANSITION_HORIZON:
+            high = low + 86400
+            if offset(high) != current:
+                while high - low > 1:
+                    middle = (low + high) / 2
+                    if offset(middle) == current:
+                        low = middle
+                    else:
+                        high = middle
+                return high
+            low = high
+        return now + self.TRANSITION_HORIZON
+
+    def _check_dst(self, now):
+        if now < self._valid_until:
+            return
+        self._cache.clear()
+        self._schedule_cache.clear()
+        self._valid_until = self._next_transition(now)
+
+    def _offset_minutes(self, tz, now):
+        """Offset UTC de una zona; se recalcula solo al pasar su próximo cambio de horario"""
+        cached = self._offsets.get(tz.zone)
+        if cached is None or now >= cached[1]:
+            offset = datetime.fromtimestamp(now, tz).utcoffset()
+            cached = self._offsets[tz.zone] = (
+                int(offset.total_seconds() // 60), self._next_transition(now, tz))
+        return cached[0]
+
+    def _static_values(self, locale):
+        return {'duration_hours': LIVE_LOCATION_DURATION // 3600}
+
+    def static(self, locale, name, now=None):
+        self._check_dst(time.time() if now is None else now)
+        key = (locale, name)
+        text = self._cache.get(key)
+        if text is None:
+            text = self._cache[key] = self.catalog[locale][name].format(**self._static_values(locale))
+        return text
+
+    def render(self, locale, name, **values):
+        return self.catalog[locale][name].format(**values)
+
+    def date(self, locale, when):
+        """'Mar 20/10 08:00' con el nombre del día en el idioma del usuario (no el de strftime)"""
+        strings = self.catalog[locale]
+        return strings['date'].format(weekday=strings['weekdays'][when.weekday()], when=when)
+
+    def schedules(self, locale, section, schedules, timezone=None, now=None):
+        """Bloque de horarios de /status ('status'), /start ('start') o /time ('time')"""
+        now = time.time() if now is None else now
+        self._check_dst(now)
+        timezone = timezone or self.tz
+        key = (locale, section, timezone.zone, tuple(schedule.key for schedule in schedules))
+        if section == 'time':
+            key += tuple(self._offset_minutes(schedule.tz, now) for schedule in schedules)
+        text = self._schedule_cache.get(key)
+        if text is None:
+            if len(self._schedule_cache) >= self.MAX_SCHEDULE_ENTRIES:
+                self._schedule_cache.clear()
+            text = self._schedule_cache[key] = self._render_schedules(
+                locale, section, schedules, timezone, now)
+        return text
+
+    def _render_schedules(self, locale, section, schedules, timezone, now):
+        strings = self.catalog[locale]
+        parts = []
+        if section == 'status':
+            parts.append(strings['schedule_zone'].format(timezone=timezone.zone))
+        parts.append(strings['time_title' if section == 'time' else 'schedule_title'])
+        for schedule in schedules:
+            days = self._days(strings['weekdays'], schedule.weekdays)
+            hour, minute = schedule.hour, schedule.minute
+            if section == 'time':
+                utc_minutes = (hour * 60 + minute - self._offset_minutes(schedule.tz, now)) % (24 * 60)
+                parts.append(strings['time_line'].format(
+                    label=strings['labels'].get(schedule.name, schedule.name),
+                    local_time=f"{hour:02d}:{minute:02d}", zone=schedule.tz.zone,
+                    utc_time=f"{utc_minutes // 60:02d}:{utc_minutes % 60:02d}", days=days))
+                continue
+            if schedule.roles is None:
+                audience = strings['audience_all']
+            else:
+                audience = strings['audience_roles'].format(roles=", ".join(sorted(schedule.roles)))
+            time_ampm = f"{hour % 12 or 12}:{minute:02d} {'AM' if hour < 12 else 'PM'}"
+            if schedule.tz.zone != timezone.zone:
+                time_ampm += f" {schedule.tz.zone}"
+            parts.append(strings['schedule_line'].format(time_ampm=time_ampm, days=days, audience=audience))
+        if not schedules:
+            parts.append(strings['schedule_none'])
+        return "".join(parts)
+
+    @staticmethod
+    def _days(names, weekdays):
+        """'Mar-Jue' para días seguidos, 'Lun, Mié, Vie' si no"""
+        days = sorted(weekdays)
+        if len(days) >= 3 and days[-1] - days[0] == len(days) - 1:
+            return f"{names[days[0]]}-{names[days[-1]]}"
+        return ", ".join(names[day] for day in days)
+
+
+def build_location_request_text(message):
+    return message + LOCATION_REQUEST_FOOTER
+
+
+def describe_recipients(recipients):
+    """'tu esposa' / 'tu esposa, tu hijo' para los mensajes de confirmación"""
+    return ", ".join(f"tu {role}" for _, role in recipients)
+
+
+def select_recipients(recipients, selector):
+    """Los destinatarios cuyo id o rol coincide con `selector` (sin distinguir mayúsculas)"""
+    selector = selector.lower()
+    return [(recipient_id, role) for recipient_id, role in recipients
+            if selector in (recipient_id, role.lower())]
+
+
+def shard_for(user_id, shards):
+    """Worker dueño de un usuario; estable entre procesos (hash() de Python no lo es)"""
+    return zlib.crc32(str(user_id).encode()) % shards
 
 
 class LocationBot:
-    def __init__(self, token):
+    def __init__(self, token, shard=0, shards=1):
         global bot_application
-        self.application = Application.builder().token(token).build()
+        # Con varios workers cada instancia atiende solo a los usuarios de su shard
+        self.shard = shard
+        self.shards = shards
+        self.metrics = Metrics()
+        self.application = (
+            Application.builder()
+            .token(token)
+            .request(api_request(self.metrics, API_POOL_SIZE))
+            # Una sola conexión de long polling: HTTP/2 no aporta nada ahí
+            .get_updates_request(api_request(self.metrics, 1, http_version='1.1'))
+            .base_url(f"{TELEGRAM_API_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+            # Cola acotada: si los handlers se atrasan, el servidor webhook (o el
+            # polling) espera antes de aceptar más updates en vez de acumularlos
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         bot_application = self.application
-        self.pending_requests = {}
-        # Para rastrear mensajes de ubicación en tiempo real
-        self.live_location_messages = {}
+        # Las difusiones usan su propio pool para no demorar las ediciones en tiempo real
+        if API_BROADCAST_POOL_SIZE:
+            self.broadcast_bot = Bot(
+                token,
+                base_url=f"{TELEGRAM_API_URL}/bot",
+                base_file_url=f"{TELEGRAM_API_URL}/file/bot",
+                request=api_request(self.metrics, API_BROADCAST_POOL_SIZE),
+            )
+        else:
+            self.broadcast_bot = self.application.bot
+        STARTUP.mark('application')
+        # Solicitudes pendientes y mensajes de ubicación en tiempo real
+        self.state = create_state_store()
+        restored = self.state.load(self.owns if shards > 1 else None)
+        logger.info("Estado restaurado (%s): %s entradas", STATE_BACKEND, restored)
+        self.registry = PairingRegistry(self.state)
+        self.registry.load()
+        self.registry.seed(DEFAULT_GROUP_ID, [(CHAT_ID_TUYO, 'esposo'), (CHAT_ID_ESPOSA, 'esposa')])
+        self.schedules = ScheduleRegistry(self.state)
+        self.schedules.load()
+        self._state_task = None
+        self.scheduler = AsyncScheduler()
+        self.dispatcher = BulkDispatcher()
+        # Todos los envíos pasan por la outbox; las ediciones siguen en el coalescer
+        self.outbox = Outbox(self.state, shard=shard, metrics=self.metrics)
+        self.outbox.add_bot('main', self.application.bot)
+        self.outbox.add_bot('broadcast', self.broadcast_bot)
+        self.outbox.add_hook('live_message', self.on_live_message_sent)
+        self.outbox.add_hook('status_message', self.on_status_message_sent)
+        self.templates = MessageTemplates()
+        # El límite global de Telegram es por bot: se reparte entre los workers
+        self.live_updates = LiveLocationCoalescer(
+            self.push_live_location, global_rate=LIVE_EDIT_GLOBAL_RATE / shards)
+        self.lifecycle = LiveLocationLifecycle(self.handle_live_expiry)
+        for (user_id, recipient_id), (_, expires_at) in self.state.live_messages.items():
+            self.lifecycle.track(user_id, recipient_id, expires_at)
+        self.movement = MovementFilter()
+        self.movement.overrides.update(self.state.load_thresholds())
+        # El historial se lee de disco después de arrancar (ver load_history)
+        if shards > 1:
+            self.history = LocationHistory(suffix=f"-{shard}")
+            self.eta = ETAService(self.history, remote=self.state.get_shared_fix)
+        else:
+            self.history = LocationHistory()
+            self.eta = ETAService(self.history)
+        self._history_task = None
+        self._fixes_to_publish = set()
+        # (emisor, destinatario) -> (message_id, texto base, última línea de ETA, instante)
+        self.status_messages = {}
+        self._eta_tasks = set()  # ediciones de ETA en curso (referencia hasta que terminan)
+        # user_id -> fin (epoch) de la ubicación en tiempo real que comparte el propio emisor;
+        # sin entrada (ubicación convertida o tras reiniciar) se decide solo por la última posición
+        self.sender_shares = {}
+        self.geofences = GeofenceIndex()
+        for user_id, name, latitude, longitude, radius in self.state.load_geofences():
+            if self.owns(user_id):
+                # Geocercas guardadas antes del límite de radio
+                radius = min(radius, GEOFENCE_MAX_RADIUS) if math.isfinite(radius) else GEOFENCE_MAX_RADIUS
+                self.geofences.add(Geofence(user_id, name, latitude, longitude, radius))
+        self._metrics_server = None
         self.setup_handlers()
+        self.register_gauges()
+        STARTUP.mark('estado')
+
+    async def post_init(self, application: Application):
+        STARTUP.mark('initialize')
+        self.live_updates.start()
+        self.outbox.start()
+        self.scheduler.start()
+        self._state_task = asyncio.create_task(self.maintain_state())
+        self._history_task = asyncio.create_task(self.load_history())
+        if METRICS_PORT:
+            self._metrics_server = await self.metrics.serve(port=METRICS_PORT + self.shard)
+        logger.info("Listo para recibir updates en %.0f ms (%s)", STARTUP.total() * 1000, STARTUP.summary())
+
+    async def load_history(self):
+        """Lee el historial en un hilo aparte mientras el bot ya atiende updates.
+
+        Los vencimientos de mensajes en tiempo real se procesan recién después,
+        porque para decidir si renovar hace falta la última posición del emisor.
+        """
+        started = time.perf_counter()
+        try:
+            tracks = await asyncio.get_running_loop().run_in_executor(
+                None, self.history.read_segments, None, self.owns if self.shards > 1 else None)
+            loaded = self.history.merge(tracks)
+            logger.info("Historial cargado: %s posiciones en %.0f ms",
+                        loaded, (time.perf_counter() - started) * 1000)
+        except Exception as e:
+            logger.error("Error cargando historial: %s", e)
+        self.lifecycle.start()
+
+    async def post_shutdown(self, application: Application):
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        await self.scheduler.stop()
+        await self.live_updates.stop()
+        await self.lifecycle.stop()
+        await self.outbox.stop()
+        if self._state_task is not None:
+            self._state_task.cancel()
+        if self._history_task is not None:
+            self._history_task.cancel()
+        for task in self._eta_tasks:
+            task.cancel()
+        await asyncio.gather(*self._eta_tasks, return_exceptions=True)
+        if self.broadcast_bot is not self.application.bot:
+            await self.broadcast_bot.shutdown()
+        self.state.close()
+        self.history.close()
+
+    async def maintain_state(self):
+        """Vuelca escrituras pendientes y purga entradas vencidas periódicamente"""
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                if time.monotonic() - last_purge >= 60:
+                    self.history.prune()
+                    purged = self.state.purge_expired()
+                    if purged:
+                        logger.info("Entradas de estado vencidas eliminadas: %s", purged)
+                    last_purge = time.monotonic()
+                self.state.flush()
+                self.history.flush()
+                if self.shards > 1:
+                    self.publish_fixes()
+                    if self.registry.refresh():
+                        # members_version también cambia con /horario, /zona y /recargar_horarios
+                        self.schedules.load()
+                        self.templates.invalidate()
+                        logger.info(
+                            "Hogares y horarios recargados: %s usuarios", len(self.registry.user_group))
+            except Exception as e:
+                logger.error("Error guardando estado: %s", e)
+
+    def owns(self, user_id):
+        """True si el usuario le corresponde a este worker"""
+        return self.shards == 1 or shard_for(user_id, self.shards) == self.shard
+
+    def record_fix(self, user_id, latitude, longitude):
+        if self.history.record(user_id, latitude, longitude) and self.shards > 1:
+            self._fixes_to_publish.add(user_id)
+
+    def publish_fixes(self):
+        """Comparte la última posición de los usuarios propios (para la ETA de otros workers)"""
+        users, self._fixes_to_publish = self._fixes_to_publish, set()
+        fixes = []
+        for user_id in users:
+            fix = self.history.last_fix(user_id)
+            if fix is not None:
+                fixes.append((user_id, *fix, self.history.average_speed(user_id, ETA_SPEED_WINDOW)))
+        self.state.publish_fixes(fixes)
+
+    async def serve_queue(self, worker_queue):
+        """Bucle de un worker: procesa en orden los updates que le reparte el
+        UpdateRouter hasta recibir None, y luego envía lo pendiente y se apaga"""
+        loop = asyncio.get_running_loop()
+        async with self.application:
+            await self.application.start()
+            await self.post_init(self.application)
+            while True:
+                data = await loop.run_in_executor(None, worker_queue.get)
+                if data is None:
+                    break
+                await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+            # stop() procesa primero todo lo que quedó en la cola de updates
+            await self.application.stop()
+            await self.live_updates.drain(WORKER_STOP_TIMEOUT)
+            await self.post_shutdown(self.application)
 
     def setup_handlers(self):
         self.application.add_handler(CommandHandler("start", self.start))
@@ -59,33 +3172,128 @@ class LocationBot:
             CommandHandler("test", self.test_automation))
         self.application.add_handler(CommandHandler("status", self.status))
         self.application.add_handler(CommandHandler("time", self.show_time))
-        # Manejar tanto ubicaciones nuevas como editadas (para tiempo real)
+        # Registro de hogares
+        self.application.add_handler(CommandHandler("nuevo_hogar", self.new_group))
+        self.application.add_handler(CommandHandler("invitar", self.invite))
+        self.application.add_handler(CommandHandler("unirme", self.join))
+        self.application.add_handler(CommandHandler("salir", self.leave))
+        self.application.add_handler(CommandHandler("hogar", self.show_group))
+        self.application.add_handler(CommandHandler("umbral", self.set_movement_thresholds))
+        self.application.add_handler(CommandHandler("historial", self.show_history))
+        self.application.add_handler(CommandHandler("geocerca", self.add_geofence))
+        self.application.add_handler(CommandHandler("geocercas", self.list_geofences))
+        self.application.add_handler(CommandHandler("borrar_geocerca", self.remove_geofence))
+        self.application.add_handler(CommandHandler("horario", self.set_schedule))
+        self.application.add_handler(CommandHandler("zona", self.set_timezone))
+        self.application.add_handler(CommandHandler("recargar_horarios", self.reload_schedules))
+        # Manejar tanto ubicaciones nuevas como editadas (para tiempo real).
+        # Se separan por tipo de update: con solo filters.LOCATION el primer
+        # handler también capturaba las ediciones y el segundo nunca se ejecutaba.
         self.application.add_handler(MessageHandler(
-            filters.LOCATION, self.handle_location))
+            filters.LOCATION & filters.UpdateType.MESSAGE, self.handle_location))
         self.application.add_handler(MessageHandler(
-            filters.LOCATION, self.handle_edited_location))
+            filters.LOCATION & filters.UpdateType.EDITED_MESSAGE, self.handle_edited_location))
+
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                handler.callback = self.timed(handler.callback)
+
+    def timed(self, callback):
+        """Envuelve un handler para medir su latencia, errores y llamadas a la API"""
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            calls = [0]
+            token = _api_calls_in_update.set(calls)
+            correlation_token = _correlation_id.set(f"upd-{update.update_id}")
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.metrics.inc('handler_errors', name)
+                raise
+            finally:
+                self.metrics.observe('handler_seconds', name, time.perf_counter() - started)
+                self.metrics.inc('api_calls_per_handler', name, calls[0])
+                _api_calls_in_update.reset(token)
+                _correlation_id.reset(correlation_token)
+
+        return wrapper
+
+    def register_gauges(self):
+        self.metrics.register_gauge('live_updates_pending', lambda: len(self.live_updates._pending))
+        self.metrics.register_gauge('live_updates_received', lambda: self.live_updates.stats['received'])
+        self.metrics.register_gauge('live_updates_sent', lambda: self.live_updates.stats['sent'])
+        self.metrics.register_gauge('live_updates_coalesced', lambda: self.live_updates.stats['coalesced'])
+        self.metrics.register_gauge('live_messages', lambda: len(self.state.live_messages))
+        self.metrics.register_gauge('live_messages_renewed', lambda: self.lifecycle.stats['renewed'])
+        self.metrics.register_gauge('live_messages_stopped', lambda: self.lifecycle.stats['stopped'])
+        self.metrics.register_gauge('movement_suppressed', lambda: self.movement.stats['suppressed'])
+        self.metrics.register_gauge('movement_forwarded', lambda: self.movement.stats['forwarded'])
+        self.metrics.register_gauge('registered_users', lambda: len(self.registry.user_group))
+        self.metrics.register_gauge('logs_sampled_out', lambda: _log_filter.stats['sampled_out'])
+        self.metrics.register_gauge('startup_seconds', STARTUP.total)
+        self.metrics.register_gauge('outbox_depth', lambda: len(self.outbox))
+        self.metrics.register_gauge('outbox_drain_rate', self.outbox.drain_rate)
+        self.metrics.register_gauge('outbox_sent', lambda: self.outbox.stats['sent'])
+        self.metrics.register_gauge('outbox_retried', lambda: self.outbox.stats['retried'])
+        self.metrics.register_gauge('outbox_dead', lambda: self.outbox.stats['dead'])
+        self.metrics.register_gauge('outbox_duplicates', lambda: self.outbox.stats['duplicates'])
 
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando para verificar el estado del bot"""
         if not await self.check_auth(update):
             return
 
-        current_time = datetime.now(CHILE_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        user_id = str(update.effective_user.id)
+        locale = self.templates.locale_for(update.effective_user)
+        timezone = self.schedules.timezone_for(user_id)
+        current_time = datetime.now(timezone).strftime("%Y-%m-%d %H:%M:%S")
+
+        # Las cifras de todo el bot (otros hogares, API) solo las ven los administradores
+        operations = user_id in ADMIN_USERS
+        group = self.registry.groups[self.registry.user_group[user_id]]
+        await update.message.reply_text("".join((
+            self.templates.render(locale, 'status_header', current_time=current_time),
+            self.templates.schedules(locale, 'status', self.schedules.for_user(user_id), timezone),
+            self.templates.static(locale, 'status_static'),
+            self.operations_summary(locale) if operations else "",
+            self.templates.render(locale, 'status_household', members=len(group)),
+            self.templates.static(locale, 'status_footer'),
+        )))
 
-        status_msg = f"🤖 Estado del Bot\n\n"
-        status_msg += f"⏰ Hora actual: {current_time}\n"
-        status_msg += f"🏠 Zona horaria: America/Santiago\n\n"
-        status_msg += f"📅 Automatización:\n"
-        status_msg += f"• 6:30 AM (Mar-Jue): Solo esposa\n"
-        status_msg += f"• 6:15 PM (Mar-Jue): Ambos\n\n"
-        status_msg += f"📍 Funcionalidad:\n"
-        status_msg += f"• Convierte ubicaciones a tiempo real automáticamente\n"
-        status_msg += f"• Duración: {LIVE_LOCATION_DURATION // 3600}h\n"
-        status_msg += f"• Recibe actualizaciones en tiempo real\n\n"
-        status_msg += f"👥 Usuarios autorizados: {len([x for x in AUTHORIZED_USERS if x])}\n"
-        status_msg += f"✅ Bot funcionando correctamente"
+    def operations_summary(self, locale):
+        """Contadores de todo el bot para /status (solo administradores)"""
+        outbox_stats = self.outbox.snapshot()
+        return "".join((
+            self.templates.render(
+                locale, 'status_operations', **self.live_updates.snapshot(), **self.movement.stats,
+                depth=outbox_stats['depth'], drain_rate=outbox_stats['drain_rate'],
+                retried=outbox_stats['retried'], dead=outbox_stats['dead']),
+            self.metrics_summary(locale),
+            self.templates.render(
+                locale, 'status_users', users=len(self.registry.user_group), groups=len(self.registry.groups)),
+        ))
 
-        await update.message.reply_text(status_msg)
+    def metrics_summary(self, locale):
+        """Resumen de latencias y llamadas a la API para /status"""
+        parts = [self.templates.render(locale, 'status_metrics_title')]
+        for name in ('handle_location', 'handle_edited_location', 'send_location_request'):
+            kind = 'handler' if name.startswith('handle') else 'operation'
+            metric = kind + '_seconds'
+            p = self.metrics.percentiles(metric, name)
+            if not p:
+                continue
+            parts.append(self.templates.render(
+                locale, 'status_metrics_line', name=name,
+                p50=p[0.5] * 1000, p95=p[0.95] * 1000, p99=p[0.99] * 1000,
+                count=self.metrics.count(metric + '_count', name),
+                errors=self.metrics.count(kind + '_errors', name)))
+        parts.append(self.templates.render(
+            locale, 'status_api', calls=self.metrics.count('api_seconds_count'),
+            errors=self.metrics.count('api_errors'), rate_limited=self.metrics.count('api_rate_limited')))
+        return "".join(parts)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.check_auth(update):
@@ -93,28 +3301,17 @@ class LocationBot:
 
         user_id = str(update.effective_user.id)
         user_name = update.effective_user.first_name or "Usuario"
-        user_role = "Esposo" if user_id == CHAT_ID_TUYO else "Esposa"
+        user_role = (self.registry.role_of(user_id) or DEFAULT_MEMBER_ROLE).capitalize()
 
-        keyboard = ReplyKeyboardMarkup([
-            [KeyboardButton("📍 Compartir Ubicación", request_location=True)]
-        ], resize_keyboard=True)
+        locale = self.templates.locale_for(update.effective_user)
 
         await update.message.reply_text(
-            f"Hola {user_name}!\n\n"
-            f"Rol: {user_role}\n\n"
-            f"🔄 **Funcionalidad de Ubicación en Tiempo Real:**\n"
-            f"• Envía tu ubicación normal\n"
-            f"• El bot la convierte automáticamente a tiempo real\n"
-            f"• Duración: {LIVE_LOCATION_DURATION // 3600} horas\n"
-            f"• Se actualiza automáticamente si compartes ubicación en vivo\n\n"
-            f"📅 Automatización:\n"
-            f"• 6:30 AM (Mar-Jue): Solo esposa\n"
-            f"• 6:15 PM (Mar-Jue): Ambos\n\n"
-            f"Comandos:\n"
-            f"/ubicacion - Solicitar ubicación\n"
-            f"/test - Probar automatización\n"
-            f"/status - Estado del bot",
-            reply_markup=keyboard
+            self.templates.render(locale, 'start', user_name=user_name, user_role=user_role)
+            + self.templates.static(locale, 'start_static')
+            + self.templates.schedules(
+                locale, 'start', self.schedules.for_user(user_id), self.schedules.timezone_for(user_id))
+            + self.templates.static(locale, 'start_commands'),
+            reply_markup=SHARE_LOCATION_KEYBOARD
         )
 
     async def request_location(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -122,20 +3319,20 @@ class LocationBot:
             return
 
         user_id = str(update.effective_user.id)
-        target_id, target_name = self.get_target_user(user_id)
+        recipients = self.get_recipients(user_id)
         requester_name = update.effective_user.first_name or "Usuario"
+        requester_role = self.registry.role_of(user_id)
 
-        if not target_id:
+        if not recipients:
             await update.message.reply_text("Error al determinar destinatario")
             return
 
-        self.pending_requests[target_id] = {
-            'requester': requester_name,
-            'time': datetime.now(CHILE_TZ)
-        }
-
-        await self.send_location_request(target_id, f"Tu {target_name} ({requester_name}) solicita tu ubicación")
-        await update.message.reply_text(f"Solicitud enviada a tu {target_name}")
+        for target_id, _ in recipients:
+            self.state.set_pending_request(target_id, requester_name)
+            await self.send_location_request(
+                f"upd-{update.update_id}:request:{target_id}", target_id,
+                f"Tu {requester_role} ({requester_name}) solicita tu ubicación")
+        await update.message.reply_text(f"Solicitud enviada a {describe_recipients(recipients)}")
 
     async def test_automation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await self.check_auth(update):
@@ -143,12 +3340,18 @@ class LocationBot:
 
         await update.message.reply_text("Probando automatización con ubicación en tiempo real...")
 
-        # Prueba matutina
-        await self.automatic_request_spouse_only(test_mode=True)
-        await asyncio.sleep(2)
-
-        # Prueba vespertina
-        await self.automatic_request_both(test_mode=True)
+        # La prueba llega solo al hogar de quien la pide
+        group_id = self.registry.user_group[str(update.effective_user.id)]
+        # Un envío por horario definido (matutino, vespertino, ...) con sus
+        # variantes por usuario, en el orden de las definiciones
+        active = self.schedules.active()
+        for index, name in enumerate(self.schedules.definitions):
+            if index:
+                await asyncio.sleep(2)
+            for schedule in active:
+                if schedule.name == name:
+                    await self.automatic_request(
+                        schedule, test_batch=f"upd-{update.update_id}", group_id=group_id)
 
         await update.message.reply_text("Prueba completada")
 
@@ -164,84 +3367,89 @@ class LocationBot:
             user_id = str(update.effective_user.id)
             location = update.message.location
             user_name = update.effective_user.first_name or "Usuario"
+            # Claves de la outbox: si Telegram reentrega el update no se duplica nada
+            key = f"upd-{update.update_id}"
 
-            self.pending_requests.pop(user_id, None)
+            self.state.pop_pending_request(user_id)
+            self.record_fix(user_id, location.latitude, location.longitude)
+            await self.check_geofences(key, user_id, user_name, location.latitude, location.longitude)
 
-            recipient_id, recipient_role = self.get_target_user(user_id)
-            if not recipient_id:
+            recipients = self.get_recipients(user_id)
+            if not recipients:
                 return
+            recipient_names = describe_recipients(recipients)
 
-            current_time = datetime.now(CHILE_TZ).strftime("%H:%M")
+            current_time = datetime.now(self.schedules.timezone_for(user_id)).strftime("%H:%M")
 
             # Si la ubicación YA tiene live_period, mantenerla
             if hasattr(location, 'live_period') and location.live_period and location.live_period > 0:
                 logger.info(
-                    f"Ubicación en tiempo real recibida de {user_name} (duración: {location.live_period}s)")
-
-                # Reenviar ubicación en tiempo real tal como viene
-                sent_message = await context.bot.send_location(
-                    chat_id=recipient_id,
-                    latitude=location.latitude,
-                    longitude=location.longitude,
-                    live_period=location.live_period
-                )
-
-                # Guardar referencia del mensaje para actualizaciones futuras
-                self.live_location_messages[f"{user_id}_{recipient_id}"] = sent_message.message_id
+                    "Ubicación en tiempo real recibida de %s (duración: %ss)",
+                    user_name, location.live_period)
 
                 duration_hours = location.live_period // 3600
                 duration_minutes = (location.live_period % 3600) // 60
+                self.sender_shares[user_id] = update.message.date.timestamp() + location.live_period
+
+                for recipient_id, _ in recipients:
+                    # Reenviar ubicación en tiempo real tal como viene; el hook
+                    # guarda la referencia del mensaje para actualizaciones futuras
+                    await self.outbox.send(
+                        f"{key}:location:{recipient_id}", 'send_location',
+                        {'chat_id': recipient_id, 'latitude': location.latitude,
+                         'longitude': location.longitude, 'live_period': location.live_period},
+                        hook=('live_message', user_id, recipient_id, location.live_period))
+                    self.movement.record(user_id, recipient_id, location.latitude, location.longitude)
+
+                    await self.send_status_message(
+                        f"{key}:status:{recipient_id}", user_id, recipient_id,
+                        f"🔄 Ubicación en Tiempo Real Activa\n\n"
+                        f"De: {user_name}\n"
+                        f"Hora: {current_time}\n"
+                        f"Duración: {duration_hours}h {duration_minutes}m\n"
+                        f"📍 Se actualiza automáticamente"
+                    )
 
-                await context.bot.send_message(
-                    chat_id=recipient_id,
-                    text=f"🔄 Ubicación en Tiempo Real Activa\n\n"
-                    f"De: {user_name}\n"
-                    f"Hora: {current_time}\n"
-                    f"Duración: {duration_hours}h {duration_minutes}m\n"
-                    f"📍 Se actualiza automáticamente"
-                )
-
-                await update.message.reply_text(
-                    f"✅ Tu ubicación en tiempo real se compartió con tu {recipient_role}\n"
-                    f"⏰ Duración: {duration_hours}h {duration_minutes}m\n"
-                    f"🔄 Se actualizará automáticamente"
-                )
+                await self.outbox.send(f"{key}:reply", 'send_message', {
+                    'chat_id': update.effective_chat.id,
+                    'text': f"✅ Tu ubicación en tiempo real se compartió con {recipient_names}\n"
+                            f"⏰ Duración: {duration_hours}h {duration_minutes}m\n"
+                            f"🔄 Se actualizará automáticamente"})
 
             else:
                 # Ubicación normal - convertir a tiempo real
-                logger.info(
-                    f"Convirtiendo ubicación normal de {user_name} a tiempo real")
-
-                sent_message = await context.bot.send_location(
-                    chat_id=recipient_id,
-                    latitude=location.latitude,
-                    longitude=location.longitude,
-                    live_period=LIVE_LOCATION_DURATION  # Convertir a tiempo real
-                )
-
-                # Guardar referencia del mensaje
-                self.live_location_messages[f"{user_id}_{recipient_id}"] = sent_message.message_id
-
-                await context.bot.send_message(
-                    chat_id=recipient_id,
-                    text=f"📍 Ubicación Convertida a Tiempo Real\n\n"
-                    f"De: {user_name}\n"
-                    f"Hora: {current_time}\n"
-                    f"Duración: {LIVE_LOCATION_DURATION // 3600}h\n"
-                    f"🔄 El bot la convirtió automáticamente"
-                )
-
-                await update.message.reply_text(
-                    f"✅ Tu ubicación se convirtió a tiempo real y se envió a tu {recipient_role}\n"
-                    f"⏰ Duración: {LIVE_LOCATION_DURATION // 3600}h\n"
-                    f"💡 Para mejores actualizaciones, comparte 'Ubicación en tiempo real' desde Telegram"
-                )
-
-            logger.info(
-                f"Ubicación procesada exitosamente: {user_name} -> {recipient_role}")
+                logger.info("Convirtiendo ubicación normal de %s a tiempo real", user_name)
+                self.sender_shares.pop(user_id, None)
+
+                for recipient_id, _ in recipients:
+                    await self.outbox.send(
+                        f"{key}:location:{recipient_id}", 'send_location',
+                        {'chat_id': recipient_id, 'latitude': location.latitude,
+                         'longitude': location.longitude,
+                         'live_period': LIVE_LOCATION_DURATION},  # Convertir a tiempo real
+                        hook=('live_message', user_id, recipient_id, LIVE_LOCATION_DURATION))
+                    self.movement.record(user_id, recipient_id, location.latitude, location.longitude)
+
+                    await self.send_status_message(
+                        f"{key}:status:{recipient_id}", user_id, recipient_id,
+                        f"📍 Ubicación Convertida a Tiempo Real\n\n"
+                        f"De: {user_name}\n"
+                        f"Hora: {current_time}\n"
+                        f"Duración: {LIVE_LOCATION_DURATION // 3600}h\n"
+                        f"🔄 El bot la convirtió automáticamente"
+                    )
+
+                await self.outbox.send(f"{key}:reply", 'send_message', {
+                    'chat_id': update.effective_chat.id,
+                    'text': f"✅ Tu ubicación se convirtió a tiempo real y se envió a {recipient_names}\n"
+                            f"⏰ Duración: {LIVE_LOCATION_DURATION // 3600}h\n"
+                            f"💡 Para mejores actualizaciones, comparte 'Ubicación en tiempo real' desde Telegram"})
+
+            logger.info("Ubicación procesada exitosamente: %s -> %s", user_name, recipient_names)
 
         except Exception as e:
-            logger.error(f"Error procesando ubicación: {e}")
+            logger.error("Error procesando ubicación: %s", e)
+            self.metrics.inc('handler_errors', 'handle_location')
             await update.message.reply_text("❌ Error al procesar ubicación")
 
     async def handle_edited_location(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -250,88 +3458,195 @@ class LocationBot:
         if not update.edited_message or not update.edited_message.location:
             return
 
+        # Sin respuesta a desconocidos (llegan muchas ediciones), pero tampoco se guardan
+        user_id = str(update.effective_user.id)
+        if not self.registry.is_authorized(user_id):
+            return
+
         try:
-            user_id = str(update.effective_user.id)
             user_name = update.effective_user.first_name or "Usuario"
             location = update.edited_message.location
 
-            logger.info(
-                f"Actualización de ubicación en tiempo real recibida de {user_name}")
+            logger.info("Actualización de ubicación en tiempo real recibida de %s", user_name,
+                        extra={'sample_key': ('edit', user_id)})
+            self.record_fix(user_id, location.latitude, location.longitude)
+            if location.live_period:
+                # Telegram permite extender la duración desde el cliente
+                self.sender_shares[user_id] = update.edited_message.date.timestamp() + location.live_period
+            await self.check_geofences(
+                f"upd-{update.update_id}", user_id, user_name, location.latitude, location.longitude)
+            for recipient_id, _ in self.get_recipients(user_id):
+                if (user_id, recipient_id) in self.status_messages:
+                    self.refresh_status_eta(user_id, recipient_id)
+
+            # Solo se encola si existe un mensaje en tiempo real que actualizar y
+            # hubo movimiento real; el envío lo hace el coalescer respetando los
+            # límites de Telegram
+            for recipient_id, _ in self.get_recipients(user_id):
+                if self.state.get_live_message(user_id, recipient_id) is None:
+                    continue
+                if self.movement.should_forward(
+                        user_id, recipient_id, location.latitude, location.longitude):
+                    self.live_updates.submit(
+                        user_id, recipient_id, location.latitude, location.longitude)
+
+        except Exception as e:
+            logger.error("Error manejando actualización de ubicación: %s", e)
+            self.metrics.inc('handler_errors', 'handle_edited_location')
+
+    async def push_live_location(self, user_id, recipient_id, latitude, longitude):
+        """Envía al destinatario la última coordenada agrupada por el coalescer"""
+        message_id = self.state.get_live_message(user_id, recipient_id)
+        if message_id is None:
+            return
+
+        try:
+            # Actualizar la ubicación en tiempo real
+            await self.application.bot.edit_message_live_location(
+                chat_id=recipient_id,
+                message_id=message_id,
+                latitude=latitude,
+                longitude=longitude
+            )
+
+            logger.info("Ubicación en tiempo real actualizada: %s -> %s", user_id, recipient_id,
+                        extra={'sample_key': ('push', user_id, recipient_id)})
 
-            recipient_id, recipient_role = self.get_target_user(user_id)
-            if not recipient_id:
+        except RetryAfter:
+            # El coalescer se encarga del backoff y del reintento
+            raise
+        except BadRequest as edit_error:
+            error_text = edit_error.message.lower()
+            if "not modified" in error_text:
                 return
+            logger.warning("No se pudo actualizar ubicación en tiempo real: %s", edit_error)
+            if "can't be edited" in error_text or "not found" in error_text:
+                # El mensaje ya no acepta ediciones: se envía UNA ubicación nueva
+                # (la clave es por mensaje reemplazado) y el hook la guarda como
+                # el mensaje vigente para las próximas ediciones
+                await self.outbox.send(
+                    f"replace:{user_id}:{recipient_id}:{message_id}", 'send_location',
+                    {'chat_id': recipient_id, 'latitude': latitude, 'longitude': longitude,
+                     'live_period': LIVE_LOCATION_DURATION},
+                    hook=('live_message', user_id, recipient_id, LIVE_LOCATION_DURATION))
 
-            # Buscar mensaje de ubicación en tiempo real correspondiente
-            message_key = f"{user_id}_{recipient_id}"
-            if message_key in self.live_location_messages:
-                message_id = self.live_location_messages[message_key]
+    def remember_live_message(self, user_id, recipient_id, message_id, live_period):
+        """Guarda el mensaje en tiempo real vigente del par y programa su vencimiento"""
+        self.state.set_live_message(user_id, recipient_id, message_id, live_period)
+        self.lifecycle.track(user_id, recipient_id, time.time() + live_period)
 
-                try:
-                    # Actualizar la ubicación en tiempo real
-                    await context.bot.edit_message_live_location(
-                        chat_id=recipient_id,
-                        message_id=message_id,
-                        latitude=location.latitude,
-                        longitude=location.longitude
-                    )
+    def on_live_message_sent(self, message, user_id, recipient_id, live_period):
+        """Hook de la outbox: el envío de una ubicación en tiempo real se completó"""
+        self.remember_live_message(user_id, recipient_id, message.message_id, live_period)
 
-                    logger.info(
-                        f"Ubicación en tiempo real actualizada: {user_name} -> {recipient_role}")
-
-                except Exception as edit_error:
-                    logger.warning(
-                        f"No se pudo actualizar ubicación en tiempo real: {edit_error}")
-                    # Si no se puede editar, enviar nueva ubicación
-                    await context.bot.send_location(
-                        chat_id=recipient_id,
-                        latitude=location.latitude,
-                        longitude=location.longitude,
-                        live_period=LIVE_LOCATION_DURATION
-                    )
+    def forget_live_message(self, user_id, recipient_id):
+        self.state.delete_live_message(user_id, recipient_id)
+        self.lifecycle.untrack(user_id, recipient_id)
+        self.movement.forget(user_id, recipient_id)
+        self.status_messages.pop((user_id, recipient_id), None)
 
-        except Exception as e:
-            logger.error(f"Error manejando actualización de ubicación: {e}")
-
-    async def send_location_request(self, chat_id, message):
-        keyboard = ReplyKeyboardMarkup([
-            [KeyboardButton("📍 Compartir Ubicación", request_location=True)]
-        ], resize_keyboard=True, one_time_keyboard=True)
-
-        full_message = f"{message}\n\n"
-        full_message += f"📍 **Opciones de Ubicación:**\n"
-        full_message += f"• Ubicación normal: El bot la convierte a tiempo real automáticamente\n"
-        full_message += f"• Ubicación en tiempo real: Se mantiene y actualiza automáticamente\n\n"
-        full_message += f"💡 **Recomendación:** Para mejor precisión, usa 'Ubicación en tiempo real' desde Telegram"
-
-        await self.application.bot.send_message(
-            chat_id=chat_id,
-            text=full_message,
-            reply_markup=keyboard
-        )
+    async def handle_live_expiry(self, user_id, recipient_id):
+        """Al acercarse el fin del live_period: renueva si el emisor sigue
+        enviando posiciones y su propia ubicación en tiempo real dura más que
+        el mensaje reenviado; si no, detiene el mapa y libera el estado"""
+        message_id = self.state.get_live_message(user_id, recipient_id)
+        if message_id is None:
+            self.forget_live_message(user_id, recipient_id)
+            return
+
+        now = time.time()
+        expires_at = self.state.live_messages[(user_id, recipient_id)][1]
+        sender_expires_at = self.sender_shares.get(user_id)
+        last_fix = self.history.last_fix(user_id)
+        active = (last_fix is not None and now - last_fix[0] < LIVE_RENEW_IF_ACTIVE
+                  and (sender_expires_at is None or sender_expires_at > expires_at))
+        live_period = LIVE_LOCATION_DURATION
+        if sender_expires_at is not None:
+            live_period = max(60, min(live_period, int(sender_expires_at - now)))
+            if sender_expires_at <= now:
+                del self.sender_shares[user_id]
+
+        # Detenerlo es cortesía (vence solo en LIVE_RENEW_MARGIN): un fallo no
+        # debe dejar el par a medias
+        try:
+            await self.application.bot.stop_message_live_location(
+                chat_id=recipient_id, message_id=message_id)
+        except BadRequest as e:
+            logger.info("Mensaje en tiempo real ya detenido: %s", e)
+        except (NetworkError, RetryAfter) as e:
+            logger.warning("No se pudo detener el mensaje en tiempo real %s -> %s: %s",
+                           user_id, recipient_id, e)
+
+        if active:
+            await self.outbox.send(
+                f"renew:{user_id}:{recipient_id}:{message_id}", 'send_location',
+                {'chat_id': recipient_id, 'latitude': last_fix[1], 'longitude': last_fix[2],
+                 'live_period': live_period},
+                hook=('live_message', user_id, recipient_id, live_period))
+            self.lifecycle.stats['renewed'] += 1
+            logger.info("Ubicación en tiempo real renovada: %s -> %s", user_id, recipient_id)
+        else:
+            self.forget_live_message(user_id, recipient_id)
+            self.lifecycle.stats['stopped'] += 1
+            logger.info("Ubicación en tiempo real finalizada: %s -> %s", user_id, recipient_id)
+
+    async def send_location_request(self, key, chat_id, message):
+        try:
+            with self.metrics.timer('operation_seconds', 'send_location_request', errors='operation_errors'):
+                await self.outbox.send(key, 'send_message', {
+                    'chat_id': chat_id,
+                    'text': build_location_request_text(message),
+                    'reply_markup': LOCATION_REQUEST_KEYBOARD,
+                }, raise_errors=True)
+        except Exception:
+            pass  # contado en operation_errors; la outbox lo reintenta o lo deja en dead letter
+
+    async def broadcast_location_request(self, chat_ids, message, label, batch):
+        """Envía la misma solicitud de ubicación a muchos chats en paralelo.
 
-    async def automatic_request_both(self, test_mode=False):
-        current_time = datetime.now(CHILE_TZ).strftime("%H:%M")
-        prefix = "[PRUEBA] " if test_mode else ""
+        Todos los envíos se anotan en la outbox (una sola escritura) antes del
+        primero, con claves `batch:chat_id`: repetir una difusión que se cortó
+        solo envía lo que faltaba. Lo que el dispatcher no logra entregar sigue
+        en la outbox con sus reintentos.
+        """
+        full_message = build_location_request_text(message)
+        # Se inicializa recién en la primera difusión (no retrasa el arranque)
+        await self.broadcast_bot.initialize()
 
-        message = f"{prefix}📍 Ubicación Automática Vespertina\n\nHora: {current_time}\nComparte tu ubicación para coordinar el regreso"
+        keys = {chat_id: f"{batch}:{chat_id}" for chat_id in chat_ids}
+        added = set(self.outbox.enqueue_many([
+            (key, 'send_message',
+             {'chat_id': chat_id, 'text': full_message, 'reply_markup': LOCATION_REQUEST_KEYBOARD},
+             'broadcast', None)
+            for chat_id, key in keys.items()]))
 
-        if CHAT_ID_TUYO:
-            await self.send_location_request(CHAT_ID_TUYO, message)
-        if CHAT_ID_ESPOSA:
-            await self.send_location_request(CHAT_ID_ESPOSA, message)
+        async def send(chat_id):
+            await self.outbox.deliver(keys[chat_id])
 
-        logger.info(f"Solicitudes vespertinas enviadas - {current_time}")
+        with self.outbox.claim(added):
+            return await self.dispatcher.dispatch(
+                [chat_id for chat_id, key in keys.items() if key in added], send, label)
 
-    async def automatic_request_spouse_only(self, test_mode=False):
-        current_time = datetime.now(CHILE_TZ).strftime("%H:%M")
-        prefix = "[PRUEBA] " if test_mode else ""
+    def batch_key(self, schedule, test_batch=None):
+        """Clave de una difusión programada: una por horario y día local, o por
+        update (`test_batch`) en las pruebas; nunca depende del reloj del envío"""
+        if test_batch is not None:
+            return f"{test_batch}:{schedule.job_id}"
+        return f"{schedule.job_id}:{datetime.now(schedule.tz):%Y-%m-%d}"
 
-        message = f"{prefix}📍 Ubicación Automática Matutina\n\nHora: {current_time}\nComparte tu ubicación para el trayecto al trabajo"
+    async def automatic_request(self, schedule, test_batch=None, group_id=None):
+        """Solicitud de ubicación de un horario a su audiencia (ver ScheduleRegistry.audience).
+        Con `test_batch` (el update de /test) es una prueba para el hogar `group_id`."""
+        current_time = datetime.now(schedule.tz).strftime("%H:%M")
+        prefix = "[PRUEBA] " if test_batch is not None else ""
+        message = prefix + schedule.message.format(time=current_time)
 
-        if CHAT_ID_ESPOSA:
-            await self.send_location_request(CHAT_ID_ESPOSA, message)
-            logger.info(f"Solicitud matutina enviada - {current_time}")
+        report = await self.broadcast_location_request(
+            self.schedules.audience(schedule, self.registry, group_id), message,
+            f"Solicitudes {schedule.job_id}", self.batch_key(schedule, test_batch))
+        if report['delivered']:
+            logger.info("Solicitudes %s enviadas - %s", schedule.job_id, current_time)
+        return report
 
     async def check_auth(self, update: Update) -> bool:
         if not update.message and not update.edited_message:
@@ -343,172 +3658,619 @@ class LocationBot:
         else:
             user_id = str(update.edited_message.from_user.id)
 
-        if user_id not in AUTHORIZED_USERS:
+        if not self.registry.is_authorized(user_id):
             if update.message:
                 await update.message.reply_text("❌ No autorizado")
             return False
 
         return True
 
-    def get_target_user(self, user_id: str):
-        if user_id == CHAT_ID_TUYO:
-            return CHAT_ID_ESPOSA, "esposa"
-        elif user_id == CHAT_ID_ESPOSA:
-            return CHAT_ID_TUYO, "esposo"
-        return None, None
+    def get_recipients(self, user_id: str):
+        return self.registry.recipients(user_id)
+
+    async def new_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Crea un hogar vacío y entrega el código para unirse (solo administradores)"""
+        if str(update.effective_user.id) not in ADMIN_USERS:
+            await update.message.reply_text("❌ No autorizado")
+            return
+
+        role = context.args[0].lower() if context.args else DEFAULT_MEMBER_ROLE
+        group_id = self.registry.create_group()
+        code = self.registry.create_invite(group_id, role)
+        await update.message.reply_text(
+            f"🏠 Hogar creado: {group_id}\n\n"
+            f"Código de invitación ({role}): {code}\n"
+            f"Úsalo con /unirme {code} (válido {INVITE_TTL // 3600}h)")
+
+    async def invite(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Genera un código para unirse al hogar de quien lo pide"""
+        if not await self.check_auth(update):
+            return
+
+        user_id = str(update.effective_user.id)
+        role = context.args[0].lower() if context.args else DEFAULT_MEMBER_ROLE
+        code = self.registry.create_invite(self.registry.user_group[user_id], role)
+        await update.message.reply_text(
+            f"📨 Código de invitación ({role}): {code}\n"
+            f"La otra persona debe enviar /unirme {code} (válido {INVITE_TTL // 3600}h)")
+
+    async def join(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/unirme <código> [rol] - no requiere estar autorizado"""
+        if not context.args:
+            await update.message.reply_text("Uso: /unirme <código> [rol]")
+            return
+
+        user_id = str(update.effective_user.id)
+        role = context.args[1].lower() if len(context.args) > 1 else None
+        group_id = self.registry.redeem_invite(context.args[0], user_id, role)
+        if group_id is None:
+            await update.message.reply_text("❌ Código inválido o vencido")
+            return
+
+        logger.info("Usuario %s se unió al hogar %s", user_id, group_id)
+        await update.message.reply_text(
+            f"✅ Te uniste al hogar como {self.registry.role_of(user_id)}\n"
+            f"Miembros: {len(self.registry.groups[group_id])}\n"
+            f"Envía /start para ver los comandos")
+
+    async def leave(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.check_auth(update):
+            return
+
+        self.registry.remove_member(str(update.effective_user.id))
+        await update.message.reply_text("👋 Saliste de tu hogar")
+
+    async def show_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.check_auth(update):
+            return
+
+        user_id = str(update.effective_user.id)
+        msg = f"🏠 Tu hogar\n\n"
+        msg += f"• Tú: {self.registry.role_of(user_id)}\n"
+        for member_id, role in self.get_recipients(user_id):
+            msg += f"• {role} ({member_id})\n"
+        await update.message.reply_text(msg)
+
+    async def set_movement_thresholds(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/umbral [destinatario] [metros segundos [keepalive]] - filtro de movimiento hacia tu hogar"""
+        if not await self.check_auth(update):
+            return
+
+        user_id = str(update.effective_user.id)
+        recipients = self.get_recipients(user_id)
+        usage = "Uso: /umbral [rol o id] <metros> <segundos> [keepalive]"
+        args = list(context.args)
+        target = None
+        if args:
+            # Si el primer argumento es un rol o id del hogar, se ajusta solo ese destinatario
+            selected = select_recipients(recipients, args[0])
+            if selected:
+                target = args.pop(0)
+                recipients = selected
+            else:
+                try:
+                    float(args[0])
+                except ValueError:
+                    await update.message.reply_text(f"❌ No hay nadie en tu hogar con rol o id {args[0]}")
+                    return
+        if not args:
+            msg = f"📏 Filtro de movimiento (metros / segundos / keepalive):\n"
+            for recipient_id, role in recipients:
+                distance, interval, keepalive = self.movement.thresholds(user_id, recipient_id)
+                msg += f"• {role}: {distance:.0f} m / {interval:.0f} s / {keepalive:.0f} s\n"
+            msg += f"\n{usage}"
+            await update.message.reply_text(msg)
+            return
+
+        try:
+            distance = float(args[0])
+            interval = float(args[1]) if len(args) > 1 else MOVEMENT_MIN_INTERVAL
+            keepalive = float(args[2]) if len(args) > 2 else MOVEMENT_KEEPALIVE
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if distance < 0 or interval < 0 or keepalive <= 0:
+            await update.message.reply_text("❌ Los valores deben ser positivos")
+            return
+
+        for recipient_id, _ in recipients:
+            self.movement.set_thresholds(user_id, recipient_id, distance, interval, keepalive)
+            self.state.save_thresholds(user_id, recipient_id, (distance, interval, keepalive))
+        target_text = f" a {describe_recipients(recipients)}" if target else ""
+        await update.message.reply_text(
+            f"✅ Se reenviará tu ubicación{target_text} al moverte {distance:.0f} m "
+            f"(mínimo cada {interval:.0f} s, keepalive {keepalive:.0f} s)")
+
+    def eta_line(self, user_id, recipient_id):
+        """Línea de ETA para el destinatario, o '' si no ambos comparten ubicación"""
+        estimate = self.eta.estimate(user_id, recipient_id)
+        if estimate is None:
+            return ""
+        arrival_minutes = round(estimate['eta_s'][user_id] / 60)
+        meet_minutes = round(estimate['meet_s'] / 60)
+        meeting_lat, meeting_lon = estimate['meeting_point']
+        return (f"\n\n🧭 A {estimate['distance_m'] / 1000:.1f} km de ti\n"
+                f"⏳ Llega donde estás en ~{arrival_minutes} min\n"
+                f"🤝 Punto de encuentro (~{meet_minutes} min): {meeting_lat:.4f}, {meeting_lon:.4f}")
+
+    async def send_status_message(self, key, user_id, recipient_id, text):
+        """Envía el mensaje de estado de un envío en tiempo real, con ETA si hay datos"""
+        eta_line = self.eta_line(user_id, recipient_id)
+        await self.outbox.send(
+            key, 'send_message', {'chat_id': recipient_id, 'text': text + eta_line},
+            hook=('status_message', user_id, recipient_id, text, eta_line))
+
+    def on_status_message_sent(self, message, user_id, recipient_id, text, eta_line):
+        """Hook de la outbox: guarda el mensaje de estado para refrescar su ETA"""
+        self.status_messages[(user_id, recipient_id)] = (message.message_id, text, eta_line, time.monotonic())
+
+    def refresh_status_eta(self, user_id, recipient_id):
+        """Actualiza la ETA del mensaje de estado si cambió, como máximo una vez
+        por ETA_CACHE_TTL y en segundo plano para no frenar el handler"""
+        if self.state.get_live_message(user_id, recipient_id) is None:
+            # El mensaje en tiempo real venció o se purgó: la ETA ya no aplica
+            self.status_messages.pop((user_id, recipient_id), None)
+            return
+        message_id, text, previous_line, refreshed_at = self.status_messages[(user_id, recipient_id)]
+        now = time.monotonic()
+        if now - refreshed_at < ETA_CACHE_TTL:
+            return
+        eta_line = self.eta_line(user_id, recipient_id)
+        if eta_line == previous_line:
+            return
+        self.status_messages[(user_id, recipient_id)] = (message_id, text, eta_line, now)
+
+        async def edit():
+            try:
+                await self.application.bot.edit_message_text(
+                    chat_id=recipient_id, message_id=message_id, text=text + eta_line)
+            except Exception as e:
+                logger.warning("No se pudo actualizar la ETA: %s", e)
+
+        task = asyncio.create_task(edit())
+        self._eta_tasks.add(task)
+        task.add_done_callback(self._eta_tasks.discard)
+
+    async def check_geofences(self, update_key, user_id, user_name, latitude, longitude):
+        """Avisa al hogar cuando el usuario entra o sale de una de sus geocercas.
+
+        Las claves de la outbox salen del update (`update_key`), así una
+        reentrega del mismo update no repite el aviso.
+        """
+        for fence, event in self.geofences.check(user_id, latitude, longitude):
+            if event == 'arrived':
+                text = f"🏁 {user_name} llegó a {fence.name}"
+            else:
+                text = f"🚗 {user_name} salió de {fence.name}"
+            logger.info("Geocerca: %s", text)
+            key = f"{update_key}:geofence:{fence.name}:{event}"
+            for recipient_id, _ in self.get_recipients(user_id):
+                await self.outbox.send(
+                    f"{key}:{recipient_id}", 'send_message', {'chat_id': recipient_id, 'text': text})
+
+    async def add_geofence(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/geocerca <nombre> [radio] - crea una geocerca en tu última ubicación"""
+        if not await self.check_auth(update):
+            return
+
+        if not context.args:
+            await update.message.reply_text("Uso: /geocerca <nombre> [radio en metros]")
+            return
+
+        user_id = str(update.effective_user.id)
+        name = context.args[0].lower()
+        try:
+            radius = float(context.args[1]) if len(context.args) > 1 else GEOFENCE_DEFAULT_RADIUS
+        except ValueError:
+            await update.message.reply_text("❌ El radio debe ser un número de metros")
+            return
+        if not math.isfinite(radius) or not 0 < radius <= GEOFENCE_MAX_RADIUS:
+            await update.message.reply_text(
+                f"❌ El radio debe ser mayor que 0 y de hasta {GEOFENCE_MAX_RADIUS} metros")
+            return
+
+        last_fix = self.history.last_fix(user_id)
+        if last_fix is None:
+            await update.message.reply_text(
+                "📍 Primero comparte tu ubicación; la geocerca se crea en tu última posición")
+            return
+
+        _, latitude, longitude = last_fix
+        self.geofences.add(Geofence(user_id, name, latitude, longitude, radius))
+        self.state.save_geofence(user_id, name, latitude, longitude, radius)
+        await update.message.reply_text(
+            f"✅ Geocerca '{name}' creada ({radius:.0f} m)\n"
+            f"Tu hogar recibirá un aviso cuando llegues o salgas")
+
+    async def list_geofences(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.check_auth(update):
+            return
+
+        user_id = str(update.effective_user.id)
+        fences = self.geofences.user_fences(user_id)
+        if not fences:
+            await update.message.reply_text("No tienes geocercas. Crea una con /geocerca <nombre>")
+            return
+
+        states = self.geofences.inside.get(user_id, {})
+        msg = f"📌 Tus geocercas:\n"
+        for fence in fences:
+            here = " (estás aquí)" if states.get(fence.name) else ""
+            msg += f"• {fence.name}: {fence.radius:.0f} m{here}\n"
+        await update.message.reply_text(msg)
+
+    async def remove_geofence(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.check_auth(update):
+            return
+
+        if not context.args:
+            await update.message.reply_text("Uso: /borrar_geocerca <nombre>")
+            return
+
+        user_id = str(update.effective_user.id)
+        name = context.args[0].lower()
+        if self.geofences.remove(user_id, name):
+            self.state.delete_geofence(user_id, name)
+            await update.message.reply_text(f"🗑️ Geocerca '{name}' eliminada")
+        else:
+            await update.message.reply_text(f"❌ No existe la geocerca '{name}'")
+
+    async def show_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/historial [n] - últimas posiciones, distancia de hoy y tendencia de velocidad"""
+        if not await self.check_auth(update):
+            return
+
+        user_id = str(update.effective_user.id)
+        try:
+            count = min(20, max(1, int(context.args[0]))) if context.args else 5
+        except ValueError:
+            count = 5
+
+        fixes = self.history.last_fixes(user_id, count)
+        if not fixes:
+            await update.message.reply_text("📭 Aún no hay posiciones registradas")
+            return
+
+        # "Hoy" en la zona del usuario (/zona); localize() respeta el horario de verano
+        timezone = self.schedules.timezone_for(user_id)
+        midnight = timezone.localize(datetime.combine(datetime.now(timezone).date(), datetime.min.time()))
+        distance_today = self.history.distance_since(user_id, int(midnight.timestamp()))
+
+        msg = f"🗺️ Historial de ubicación\n\n"
+        msg += f"📍 Últimas {len(fixes)} posiciones:\n"
+        for timestamp, latitude, longitude in fixes:
+            local_time = datetime.fromtimestamp(timestamp, timezone).strftime('%H:%M:%S')
+            msg += f"• {local_time}: {latitude:.5f}, {longitude:.5f}\n"
+        msg += f"\n🚶 Distancia hoy: {distance_today / 1000:.2f} km\n"
+
+        # ETA hacia la última posición conocida de cada miembro del hogar según la
+        # velocidad media de distintas ventanas (si baja, el ETA crece)
+        trend = self.history.speed_trend(user_id)
+        msg += f"\n📈 Velocidad media:\n"
+        for window, speed in trend:
+            speed_text = f"{speed * 3.6:.1f} km/h" if speed is not None else "sin datos"
+            msg += f"• Últimos {window // 60} min: {speed_text}\n"
+        here = fixes[0]
+        for member_id, role in self.get_recipients(user_id):
+            there = self.history.last_fix(member_id)
+            if there is None:
+                continue
+            distance = haversine_m(here[1], here[2], there[1], there[2])
+            etas = [f"{distance / speed / 60:.0f} min" if speed else "—" for _, speed in trend]
+            msg += f"\n⏳ ETA a tu {role} ({distance / 1000:.1f} km): {' / '.join(etas)}"
+        await update.message.reply_text(msg)
 
     async def show_time(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando para verificar horarios"""
         if not await self.check_auth(update):
             return
 
-        chile_time = datetime.now(CHILE_TZ)
+        user_id = str(update.effective_user.id)
+        locale = self.templates.locale_for(update.effective_user)
+        timezone = self.schedules.timezone_for(user_id)
+        schedules = self.schedules.for_user(user_id)
         utc_time = datetime.now(pytz.UTC)
+        local_time = utc_time.astimezone(timezone)
 
-        # Calcular próximos horarios de ejecución
-        offset_hours = int((chile_time.utcoffset().total_seconds()) / 3600)
-        morning_utc = (6 - offset_hours + 24) % 24
-        evening_utc = (18 - offset_hours + 24) % 24
-
-        msg = f"🕒 **Información de Horarios**\n\n"
-        msg += f"🌍 UTC actual: {utc_time.strftime('%H:%M:%S')}\n"
-        msg += f"🇨🇱 Chile actual: {chile_time.strftime('%H:%M:%S')}\n\n"
-        msg += f"📅 **Automatización:**\n"
-        msg += f"• Mañana: 06:30 Chile = {morning_utc:02d}:30 UTC\n"
-        msg += f"• Tarde: 18:15 Chile = {evening_utc:02d}:15 UTC\n\n"
-        msg += f"📍 **Ubicación en Tiempo Real:**\n"
-        msg += f"• Duración automática: {LIVE_LOCATION_DURATION // 3600}h\n"
-        msg += f"• Actualización: Automática\n"
-        msg += f"📆 Días: Martes, Miércoles, Jueves"
+        # Las conversiones a UTC vienen de la caché (se recalculan al cambiar el horario de verano)
+        parts = [
+            self.templates.render(
+                locale, 'time_header', timezone=timezone.zone,
+                utc_time=utc_time.strftime('%H:%M:%S'), local_time=local_time.strftime('%H:%M:%S')),
+            self.templates.schedules(locale, 'time', schedules, timezone, now=utc_time.timestamp()),
+        ]
+        for schedule in schedules:
+            when = schedule.next_run(utc_time)
+            if when is None:
+                continue
+            parts.append(self.templates.render(
+                locale, 'time_next_run',
+                job_name=schedule.name, when=self.templates.date(locale, when.astimezone(timezone))))
+        parts.append(self.templates.static(locale, 'time_footer'))
 
-        await update.message.reply_text(msg)
+        await update.message.reply_text("".join(parts))
+
+    async def set_schedule(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/horario <nombre> [HH:MM] [días] | off | on | reset"""
+        if not await self.check_auth(update):
+            return
 
+        user_id = str(update.effective_user.id)
+        names = ", ".join(self.schedules.definitions)
+        if not context.args:
+            await update.message.reply_text(
+                "Uso: /horario <nombre> [HH:MM] [días] | off | on | reset\n"
+                "Ej.: /horario matutino 07:00 lun-vie\n"
+                f"Horarios: {names}")
+            return
+
+        name, *options = context.args
+        if name not in self.schedules.definitions:
+            await update.message.reply_text(f"Horario desconocido: {name} (hay: {names})")
+            return
 
-# Scheduler functions (sin cambios - mantienen la funcionalidad existente)
-def run_async_in_thread(coro):
-    def run():
+        changes = {}
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(coro)
-            loop.close()
-        except Exception as e:
-            logger.error(f"Error en async thread: {e}")
+            for option in options:
+                option = option.lower()
+                if option == 'reset':
+                    self.schedules.reset(user_id, name)
+                    await update.message.reply_text(f"Horario {name} restablecido")
+                    return
+                if option in ('off', 'on'):
+                    changes['enabled'] = option == 'on'
+                elif ':' in option:
+                    changes['hour'], changes['minute'] = parse_time(option)
+                else:
+                    parse_weekdays(option)
+                    changes['days'] = option
+        except (ValueError, KeyError):
+            await update.message.reply_text("Formato inválido. Ej.: /horario matutino 07:00 lun-vie")
+            return
 
-    threading.Thread(target=run, daemon=True).start()
+        if changes:
+            self.schedules.update(user_id, name, **changes)
+        schedule = next((s for s in self.schedules.for_user(user_id) if s.name == name), None)
+        if schedule is None:
+            await update.message.reply_text(f"Horario {name} desactivado")
+            return
+        when = schedule.next_run(datetime.now(pytz.UTC))
+        locale = self.templates.locale_for(update.effective_user)
+        await update.message.reply_text(self.templates.render(
+            locale, 'schedule_set', name=name, time=f"{schedule.hour:02d}:{schedule.minute:02d}",
+            days=MessageTemplates._days(TEMPLATES[locale]['weekdays'], schedule.weekdays),
+            zone=schedule.tz.zone,
+            when=self.templates.date(locale, when.astimezone(schedule.tz)) if when else '—'))
 
+    async def set_timezone(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/zona [America/Santiago | reset]: zona horaria de todos tus horarios"""
+        if not await self.check_auth(update):
+            return
 
-async def run_morning():
-    if bot_application and CHAT_ID_ESPOSA:
-        try:
-            bot_instance = LocationBot.__new__(LocationBot)
-            bot_instance.application = bot_application
-            bot_instance.pending_requests = {}
-            bot_instance.live_location_messages = {}
-            await bot_instance.automatic_request_spouse_only()
-        except Exception as e:
-            logger.error(f"Error matutino: {e}")
+        user_id = str(update.effective_user.id)
+        if not context.args:
+            await update.message.reply_text(
+                f"Tu zona horaria: {self.schedules.timezone_for(user_id).zone}\n"
+                "Uso: /zona <zona> (ej. America/Bogota) o /zona reset")
+            return
+
+        zone = context.args[0]
+        if zone.lower() == 'reset':
+            self.schedules.update(user_id, '*', timezone=None)
+        else:
+            try:
+                zone = pytz.timezone(zone).zone
+            except pytz.UnknownTimeZoneError:
+                await update.message.reply_text(f"Zona horaria desconocida: {zone}")
+                return
+            self.schedules.update(user_id, '*', timezone=zone)
+        await update.message.reply_text(
+            f"Zona horaria: {self.schedules.timezone_for(user_id).zone}")
+
+    async def reload_schedules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Relee SCHEDULE_FILE (solo administradores)"""
+        if not await self.check_auth(update):
+            return
 
+        if str(update.effective_user.id) not in ADMIN_USERS:
+            await update.message.reply_text("Solo un administrador puede recargar los horarios")
+            return
 
-async def run_evening():
-    if bot_application:
         try:
-            bot_instance = LocationBot.__new__(LocationBot)
-            bot_instance.application = bot_application
-            bot_instance.pending_requests = {}
-            bot_instance.live_location_messages = {}
-            await bot_instance.automatic_request_both()
-        except Exception as e:
-            logger.error(f"Error vespertino: {e}")
+            count = self.schedules.load()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("Error recargando horarios: %s", e)
+            await update.message.reply_text(f"Error en {self.schedules.path}: {e}")
+            return
+        self.state.notify_change()  # los otros workers recargan en maintain_state
+        self.templates.invalidate()
+        await update.message.reply_text(f"Horarios recargados: {count}")
 
 
-def morning_job():
-    """Trabajo matutino con logging de zona horaria"""
-    chile_time = datetime.now(CHILE_TZ)
+# Trabajos programados: se ejecutan en el loop de la Application con la
+# instancia viva del bot (mismo estado y mismo cliente HTTP)
+async def scheduled_job(bot, schedule):
+    """Trabajo de un horario con logging de zona horaria"""
     utc_time = datetime.now(pytz.UTC)
+    logger.info("Ejecutando trabajo %s - UTC %s, local %s",
+                schedule.job_id, utc_time.strftime('%H:%M:%S'),
+                utc_time.astimezone(schedule.tz).strftime('%H:%M:%S'),
+                extra={'job': schedule.name})
 
-    logger.info(f"Ejecutando trabajo matutino - ubicación en tiempo real")
-    logger.info(f"UTC: {utc_time.strftime('%H:%M:%S')}")
-    logger.info(f"Chile: {chile_time.strftime('%H:%M:%S')}")
+    try:
+        await bot.automatic_request(schedule)
+    except Exception as e:
+        logger.error("Error en %s: %s", schedule.job_id, e)
 
-    run_async_in_thread(run_morning())
 
+def schedule_jobs(bot):
+    """Programa los horarios del registro (se recalculan en cada ejecución).
 
-def evening_job():
-    """Trabajo vespertino con logging de zona horaria"""
-    chile_time = datetime.now(CHILE_TZ)
-    utc_time = datetime.now(pytz.UTC)
+    Los usuarios con el mismo horario efectivo comparten un trabajo, así un
+    solo timer del AsyncScheduler atiende a todos los horarios.
+    """
+    bot.schedules.attach(bot.scheduler, lambda schedule: scheduled_job(bot, schedule))
 
-    logger.info(f"Ejecutando trabajo vespertino - ubicación en tiempo real")
-    logger.info(f"UTC: {utc_time.strftime('%H:%M:%S')}")
-    logger.info(f"Chile: {chile_time.strftime('%H:%M:%S')}")
+    runs = bot.scheduler.next_runs()
+    for job_id, when in runs[:5]:
+        logger.info("Próximo trabajo %s: %s UTC", job_id, when.strftime('%Y-%m-%d %H:%M'))
+    logger.info("Horarios programados: %s", len(runs))
+    logger.info("Duración ubicación tiempo real: %sh", LIVE_LOCATION_DURATION // 3600)
 
-    run_async_in_thread(run_evening())
 
+class UpdateRouter:
+    """Proceso de entrada del modo con varios workers.
 
-def schedule_jobs():
-    """Programación de trabajos - calcula correctamente la hora de Chile"""
-    schedule.clear()
+    Recibe los updates con su propia Application (polling o webhook, sin
+    handlers del bot) y los reparte por shard_for(user_id) a una cola por
+    worker. Cada worker consume su cola de a un update, así se conserva el
+    orden del stream de ediciones de cada usuario. Si un worker se atrasa su
+    cola se llena y el router espera, igual que la cola acotada de updates.
+    """
 
-    # Obtener offset de Chile respecto a UTC
-    chile_time = datetime.now(CHILE_TZ)
-    utc_time = datetime.now(pytz.UTC)
+    def __init__(self, token, shards):
+        self.shards = shards
+        import multiprocessing  # solo se usa en este modo
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(shards)]
+        self.workers = [
+            context.Process(target=run_worker, args=(shard, shards, self.queues[shard]),
+                            name=f"weekbot-worker-{shard}")
+            for shard in range(shards)
+        ]
+        self.stats = {'routed': 0, 'waited': 0}
+        self.application = (
+            Application.builder()
+            .token(token)
+            .get_updates_request(api_request(Metrics(), 1, http_version='1.1'))
+            .base_url(f"{TELEGRAM_API_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+            .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+        self.application.add_handler(TypeHandler(Update, self.route))
 
-    # Calcular diferencia en horas
-    offset_hours = int((chile_time.utcoffset().total_seconds()) / 3600)
+    async def post_init(self, application: Application):
+        self.start_workers()
 
-    # Convertir horarios de Chile a UTC para el scheduler
-    morning_utc_hour = (6 - offset_hours + 24) % 24  # 6:30 AM Chile
-    evening_utc_hour = (18 - offset_hours + 24) % 24  # 6:15 PM Chile
+    async def post_shutdown(self, application: Application):
+        await self.stop_workers()
+        logger.info("Router detenido: %s updates repartidos", self.stats['routed'])
 
-    # Programar trabajos en horario UTC (que es lo que entiende Railway)
-    for day in ['tuesday', 'wednesday', 'thursday']:
-        getattr(schedule.every(), day).at(
-            f"{morning_utc_hour:02d}:30").do(morning_job)
-        getattr(schedule.every(), day).at(
-            f"{evening_utc_hour:02d}:15").do(evening_job)
+    def start_workers(self):
+        for worker in self.workers:
+            worker.start()
+        logger.info("%s workers iniciados", self.shards)
 
-    logger.info(
-        f"Trabajos programados (UTC): {morning_utc_hour:02d}:30 y {evening_utc_hour:02d}:15")
-    logger.info(f"Equivale en Chile: 06:30 y 18:15")
-    logger.info(f"Offset Chile-UTC: {offset_hours} horas")
-    logger.info(
-        f"Duración ubicación tiempo real: {LIVE_LOCATION_DURATION // 3600}h")
+    async def stop_workers(self, timeout=WORKER_STOP_TIMEOUT):
+        """Pide a cada worker que termine su cola y espera a que salga"""
+        loop = asyncio.get_running_loop()
+        for worker_queue in self.queues:
+            await loop.run_in_executor(None, worker_queue.put, None)
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.join, timeout)
+            if worker.is_alive():
+                logger.warning("%s no terminó a tiempo; se detiene", worker.name)
+                worker.terminate()
 
+    @staticmethod
+    def shard_key(update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.update_id
 
-def run_scheduler():
-    while True:
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.submit(self.shard_key(update), update.to_dict())
+
+    async def submit(self, key, data):
+        """Encola el update (dict de la Bot API) en el worker que corresponde a `key`"""
+        worker_queue = self.queues[shard_for(key, self.shards)]
         try:
-            schedule.run_pending()
-            time.sleep(60)
-        except Exception as e:
-            logger.error(f"Error scheduler: {e}")
-            time.sleep(60)
+            worker_queue.put_nowait(data)
+        except queue.Full:
+            self.stats['waited'] += 1
+            await asyncio.get_running_loop().run_in_executor(None, worker_queue.put, data)
+        self.stats['routed'] += 1
+
+
+def run_worker(shard, shards, worker_queue):
+    """Punto de entrada de cada proceso worker"""
+    # Ctrl+C llega a todo el grupo de procesos: el apagado lo ordena el router
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    validate_config()
+    bot = LocationBot(BOT_TOKEN, shard=shard, shards=shards)
+    if shard == 0:
+        schedule_jobs(bot)  # Los envíos programados los hace un solo worker
+    logger.info("Worker %s/%s listo", shard + 1, shards)
+    asyncio.run(bot.serve_queue(worker_queue))
+
+
+def run_sharded():
+    if STATE_BACKEND != 'sqlite':
+        raise ValueError("WORKER_COUNT > 1 requiere STATE_BACKEND=sqlite (estado compartido)")
+    router = UpdateRouter(BOT_TOKEN, WORKER_COUNT)
+    logger.info("Modo con %s workers (reparto por user_id)", WORKER_COUNT)
+    if BOT_MODE == 'webhook':
+        run_webhook(router)
+    else:
+        router.application.run_polling(timeout=POLL_TIMEOUT, drop_pending_updates=DROP_PENDING_UPDATES)
+
+
+def run_webhook(bot):
+    """Recibe updates por webhook (servidor HTTP local de python-telegram-bot).
+
+    Telegram envía el header X-Telegram-Bot-Api-Secret-Token con WEBHOOK_SECRET
+    y el servidor rechaza cualquier request que no lo traiga.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL no configurado (requerido con BOT_MODE=webhook)")
+
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+    logger.info("Modo webhook: escuchando en %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    bot.application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=DROP_PENDING_UPDATES
+    )
 
 
 def main():
+    validate_config()
     logger.info("Iniciando bot con ubicación en tiempo real...")
-    logger.info(f"BOT_TOKEN configurado: {'Sí' if BOT_TOKEN else 'No'}")
-    logger.info(
-        f"Usuarios configurados: {len([x for x in AUTHORIZED_USERS if x])}")
-    logger.info(
-        f"Duración ubicación tiempo real: {LIVE_LOCATION_DURATION // 3600}h")
+    logger.info("BOT_TOKEN configurado: %s", 'Sí' if BOT_TOKEN else 'No')
+    logger.info("Duración ubicación tiempo real: %sh", LIVE_LOCATION_DURATION // 3600)
 
     try:
-        bot = LocationBot(BOT_TOKEN)
-        schedule_jobs()
+        if WORKER_COUNT > 1:
+            run_sharded()
+            return
 
-        scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-        scheduler_thread.start()
+        bot = LocationBot(BOT_TOKEN)
+        logger.info(
+            "Usuarios configurados: %s en %s hogares",
+            len(bot.registry.user_group), len(bot.registry.groups))
+        schedule_jobs(bot)
 
         logger.info(
             "Bot iniciado - Automatización de ubicación en tiempo real activa")
-        bot.application.run_polling(drop_pending_updates=True)
+        if BOT_MODE == 'webhook':
+            run_webhook(bot)
+        else:
+            bot.application.run_polling(timeout=POLL_TIMEOUT, drop_pending_updates=DROP_PENDING_UPDATES)
 
     except KeyboardInterrupt:
         logger.info("Bot detenido")
     except Exception as e:
-        logger.error(f"Error crítico: {e}")
+        logger.error("Error crítico: %s", e)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,9 @@
+"""Punto de entrada del worker (Procfile).
+
+Ejecutar `python bot_ubicacion.py` recompila el módulo en cada arranque;
+importándolo desde aquí Python reutiliza el bytecode de __pycache__.
+"""
+from bot_ubicacion import main
+
+if __name__ == '__main__':
+    main()
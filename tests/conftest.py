@@ -0,0 +1,7 @@
+import os
+import sys
+
+# bot_ubicacion lee la configuración al importarse: estado en memoria y sin .env
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('SCHEDULE_FILE', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
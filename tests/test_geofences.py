@@ -0,0 +1,61 @@
+from bot_ubicacion import GEOFENCE_EXIT_FACTOR, Geofence, GeofenceIndex
+
+HOME = (-33.4489, -70.6693)
+METERS_PER_DEG_LAT = 111_320
+
+
+def north_of(point, meters):
+    return point[0] + meters / METERS_PER_DEG_LAT, point[1]
+
+
+def make_index(radius=150):
+    index = GeofenceIndex()
+    index.add(Geofence('1', 'casa', *HOME, radius))
+    return index
+
+
+def events(index, point):
+    return [(fence.name, event) for fence, event in index.check('1', *point)]
+
+
+def test_first_fix_only_sets_state():
+    index = make_index()
+    assert events(index, HOME) == []
+    assert index.inside['1'] == {'casa': True}
+
+
+def test_arrival_and_departure():
+    index = make_index()
+    assert events(index, north_of(HOME, 2000)) == []
+    assert events(index, north_of(HOME, 50)) == [('casa', 'arrived')]
+    assert events(index, north_of(HOME, 50)) == []
+    assert events(index, north_of(HOME, 2000)) == [('casa', 'left')]
+
+
+def test_exit_uses_hysteresis():
+    index = make_index(radius=100)
+    events(index, HOME)
+    # Fuera del radio pero dentro del margen de salida: sigue adentro
+    assert events(index, north_of(HOME, 100 * (GEOFENCE_EXIT_FACTOR + 1) / 2)) == []
+    assert events(index, north_of(HOME, 100 * GEOFENCE_EXIT_FACTOR + 20)) == [('casa', 'left')]
+
+
+def test_departure_detected_from_another_cell():
+    index = make_index()
+    events(index, HOME)
+    # Lejos, en una celda de la grilla donde la geocerca no está indexada
+    assert events(index, (HOME[0] + 1, HOME[1] + 1)) == [('casa', 'left')]
+
+
+def test_fences_are_per_user():
+    index = make_index()
+    assert index.check('2', *HOME) == []
+
+
+def test_remove_clears_cells_and_state():
+    index = make_index()
+    events(index, HOME)
+    assert index.remove('1', 'casa')
+    assert not index.cells
+    assert index.inside['1'] == {}
+    assert events(index, north_of(HOME, 2000)) == []
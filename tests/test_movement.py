@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot_ubicacion import LocationBot, MovementFilter, select_recipients
+
+
+class FakeMessage:
+    def __init__(self, user_id):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def run_command(bot, user_id, args):
+    message = FakeMessage(user_id)
+    update = SimpleNamespace(message=message, edited_message=None, effective_user=message.from_user)
+    asyncio.run(bot.set_movement_thresholds(update, SimpleNamespace(args=args)))
+    return message.replies
+
+
+def make_bot():
+    bot = LocationBot('123:abc')
+    bot.registry.add_member('hogar', '1', 'esposo')
+    bot.registry.add_member('hogar', '2', 'esposa')
+    bot.registry.add_member('hogar', '3', 'hijo')
+    return bot
+
+
+def test_select_recipients_by_role_or_id():
+    recipients = (('2', 'esposa'), ('3', 'hijo'))
+    assert select_recipients(recipients, 'Esposa') == [('2', 'esposa')]
+    assert select_recipients(recipients, '3') == [('3', 'hijo')]
+    assert select_recipients(recipients, 'abuela') == []
+
+
+def test_thresholds_are_per_pair():
+    movement = MovementFilter(min_distance=25, min_interval=0, keepalive=120)
+    movement.set_thresholds('1', '2', 500, 0, 120)
+    for recipient_id in ('2', '3'):
+        movement.record('1', recipient_id, -33.45, -70.66, now=0)
+    # ~110 m: pasa el umbral por defecto pero no el de 500 m
+    assert movement.should_forward('1', '3', -33.451, -70.66, now=10)
+    assert not movement.should_forward('1', '2', -33.451, -70.66, now=10)
+
+
+def test_umbral_with_role_tunes_one_recipient():
+    bot = make_bot()
+    replies = run_command(bot, 1, ['esposa', '80', '30'])
+    assert bot.movement.thresholds('1', '2')[:2] == (80, 30)
+    assert bot.movement.thresholds('1', '3') == bot.movement.defaults
+    assert 'tu esposa' in replies[-1]
+
+
+def test_umbral_without_target_tunes_whole_household():
+    bot = make_bot()
+    run_command(bot, 1, ['80', '30'])
+    assert bot.movement.thresholds('1', '2')[:2] == (80, 30)
+    assert bot.movement.thresholds('1', '3')[:2] == (80, 30)
+
+
+def test_umbral_unknown_recipient():
+    bot = make_bot()
+    replies = run_command(bot, 1, ['abuela', '80'])
+    assert replies[-1].startswith("❌")
+    assert bot.movement.overrides == {}
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from bot_ubicacion import MemoryStateStore, Outbox
+
+
+class FakeBot:
+    """Bot que falla con los errores indicados antes de responder"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def initialize(self):
+        pass
+
+    async def send_message(self, **params):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(params)
+        return {'message_id': len(self.sent)}
+
+
+def make_outbox(bot, **kwargs):
+    state = MemoryStateStore()
+    outbox = Outbox(state, retry_base=0.01, retry_max=0.01, **kwargs)
+    outbox.add_bot('main', bot)
+    return state, outbox
+
+
+def test_send_delivers_and_runs_hook():
+    async def scenario():
+        bot = FakeBot()
+        state, outbox = make_outbox(bot)
+        results = []
+        outbox.add_hook('sent', lambda result, tag: results.append((result, tag)))
+        result = await outbox.send('k', 'send_message', {'chat_id': 1}, hook=('sent', 'x'))
+        return bot, state, outbox, result, results
+
+    bot, state, outbox, result, results = asyncio.run(scenario())
+    assert result == {'message_id': 1}
+    assert results == [({'message_id': 1}, 'x')]
+    assert state.outbox_counts() == {'sent': 1}
+    assert len(outbox) == 0
+
+
+def test_duplicate_key_is_not_sent_twice():
+    async def scenario():
+        bot = FakeBot()
+        _, outbox = make_outbox(bot)
+        await outbox.send('k', 'send_message', {'chat_id': 1})
+        await outbox.send('k', 'send_message', {'chat_id': 1})
+        return bot, outbox
+
+    bot, outbox = asyncio.run(scenario())
+    assert len(bot.sent) == 1
+    assert outbox.stats['duplicates'] == 1
+
+
+def test_transient_errors_are_retried():
+    async def scenario():
+        bot = FakeBot(NetworkError("caída"), RetryAfter(0))
+        state, outbox = make_outbox(bot)
+        outbox.start()
+        assert await outbox.send('k', 'send_message', {'chat_id': 1}) is None
+        for _ in range(100):
+            if not len(outbox):
+                break
+            await asyncio.sleep(0.01)
+        await outbox.stop()
+        return bot, state, outbox
+
+    bot, state, outbox = asyncio.run(scenario())
+    assert len(bot.sent) == 1
+    assert outbox.stats['retried'] == 2
+    assert state.outbox_counts() == {'sent': 1}
+
+
+def test_permanent_error_goes_to_dead_letter():
+    async def scenario():
+        bot = FakeBot(BadRequest("chat not found"))
+        state, outbox = make_outbox(bot)
+        await outbox.send('k', 'send_message', {'chat_id': 1})
+        return state, outbox
+
+    state, outbox = asyncio.run(scenario())
+    assert outbox.stats['dead'] == 1
+    assert state.outbox_counts() == {'dead': 1}
+    assert state.outbox['k'][9] == "chat not found"
+
+
+def test_too_many_attempts_go_to_dead_letter():
+    async def scenario():
+        bot = FakeBot(NetworkError("1"), NetworkError("2"))
+        state, outbox = make_outbox(bot, max_attempts=2)
+        outbox.start()
+        await outbox.send('k', 'send_message', {'chat_id': 1})
+        for _ in range(100):
+            if not len(outbox):
+                break
+            await asyncio.sleep(0.01)
+        await outbox.stop()
+        return state
+
+    assert asyncio.run(scenario()).outbox_counts() == {'dead': 1}
+
+
+def test_send_can_raise_for_callers_that_count_errors():
+    async def scenario():
+        _, outbox = make_outbox(FakeBot(BadRequest("no")))
+        try:
+            await outbox.send('k', 'send_message', {'chat_id': 1}, raise_errors=True)
+        except BadRequest:
+            return True
+        return False
+
+    assert asyncio.run(scenario())
+
+
+def test_replay_resends_pending_and_expires_old_rows():
+    async def scenario():
+        bot = FakeBot()
+        state, outbox = make_outbox(bot, max_age=600)
+        now = time.time()
+        state.add_outbox([
+            ('reciente', 0, 'main', 'send_message', '{"chat_id": 1}', None, now - 60),
+            ('viejo', 0, 'main', 'send_message', '{"chat_id": 2}', None, now - 3600),
+            ('otro-shard', 1, 'main', 'send_message', '{"chat_id": 3}', None, now),
+        ])
+        outbox.start()
+        for _ in range(100):
+            if bot.sent:
+                break
+            await asyncio.sleep(0.01)
+        await outbox.stop()
+        return bot, state, outbox
+
+    bot, state, outbox = asyncio.run(scenario())
+    assert bot.sent == [{'chat_id': 1}]
+    assert outbox.stats['replayed'] == 1
+    assert state.outbox['viejo'][5] == 'dead'
+    assert state.outbox['otro-shard'][5] == 'pending'
@@ -0,0 +1,127 @@
+from datetime import date, datetime
+
+import pytz
+
+import bot_ubicacion as bot
+from bot_ubicacion import AsyncScheduler, MemoryStateStore, PairingRegistry, ScheduleRegistry, WeeklyJob
+
+SANTIAGO = pytz.timezone('America/Santiago')
+
+
+def make_registries():
+    state = MemoryStateStore()
+    pairing = PairingRegistry(state)
+    pairing.add_member('hogar', '1', 'esposo')
+    pairing.add_member('hogar', '2', 'esposa')
+    pairing.add_member('otro', '3', 'esposa')
+    schedules = ScheduleRegistry(state, path=None)
+    schedules.load()
+    return state, pairing, schedules
+
+
+def by_name(schedules, name):
+    return [schedule for schedule in schedules.active() if schedule.name == name]
+
+
+def test_next_run_keeps_local_time_across_dst():
+    job = WeeklyJob('diario', range(7), 6, 30, None, SANTIAGO)
+    # Chile adelanta la hora la noche del 5 al 6 de septiembre de 2026
+    before = job.next_run(datetime(2026, 9, 4, 12, tzinfo=pytz.UTC))
+    after = job.next_run(before)
+    assert before.astimezone(SANTIAGO).strftime('%d %H:%M') == '05 06:30'
+    assert after.astimezone(SANTIAGO).strftime('%d %H:%M') == '06 06:30'
+    assert before.hour == 10 and after.hour == 9
+
+
+def test_next_run_shifts_nonexistent_time():
+    job = WeeklyJob('medianoche', [6], 0, 15, None, SANTIAGO)
+    run = job.next_run(datetime(2026, 9, 1, tzinfo=pytz.UTC))
+    assert run.astimezone(SANTIAGO).strftime('%Y-%m-%d %H:%M') == '2026-09-06 01:15'
+
+
+def test_next_run_skips_holidays():
+    holidays = {date(2026, 9, 15), date(2026, 9, 22)}
+    job = WeeklyJob('martes', [1], 6, 30, None, SANTIAGO, holidays)
+    run = job.next_run(datetime(2026, 9, 10, tzinfo=pytz.UTC))
+    assert run.astimezone(SANTIAGO).date() == date(2026, 9, 29)
+
+
+def test_update_moves_user_to_derived_schedule():
+    _, pairing, schedules = make_registries()
+    morning = schedules.definitions['matutino']
+    assert sorted(schedules.audience(morning, pairing)) == ['2', '3']
+
+    schedules.update('2', 'matutino', hour=7, minute=0)
+    derived, = [s for s in by_name(schedules, 'matutino') if s is not morning]
+    assert (derived.hour, derived.minute) == (7, 0)
+    assert schedules.audience(morning, pairing) == ['3']
+    assert schedules.audience(derived, pairing) == ['2']
+    assert schedules.for_user('2')[0] is derived
+
+
+def test_users_with_same_override_share_schedule():
+    _, pairing, schedules = make_registries()
+    schedules.update('2', 'matutino', hour=7, minute=0)
+    schedules.update('3', 'matutino', hour=7, minute=0)
+    assert schedules.for_user('2')[0] is schedules.for_user('3')[0]
+    assert len(by_name(schedules, 'matutino')) == 2
+
+
+def test_reset_returns_user_to_definition():
+    state, pairing, schedules = make_registries()
+    morning = schedules.definitions['matutino']
+    schedules.update('2', 'matutino', hour=7, minute=0)
+    assert schedules.reset('2', 'matutino')
+    assert by_name(schedules, 'matutino') == [morning]
+    assert sorted(schedules.audience(morning, pairing)) == ['2', '3']
+    assert state.load_user_schedules() == []
+    assert not schedules.reset('2', 'matutino')
+
+
+def test_disabled_schedule_excludes_user():
+    _, pairing, schedules = make_registries()
+    schedules.update('2', 'matutino', enabled=False)
+    assert schedules.audience(schedules.definitions['matutino'], pairing) == ['3']
+    assert [s.name for s in schedules.for_user('2')] == ['vespertino']
+
+
+def test_timezone_override_applies_to_all_schedules():
+    _, pairing, schedules = make_registries()
+    schedules.update('1', '*', timezone='Europe/Madrid')
+    assert {s.tz.zone for s in schedules.for_user('1')} == {'Europe/Madrid'}
+    assert schedules.timezone_for('1').zone == 'Europe/Madrid'
+    evening = schedules.definitions['vespertino']
+    assert '1' not in schedules.audience(evening, pairing)
+
+
+def test_audience_can_be_limited_to_a_household():
+    _, pairing, schedules = make_registries()
+    evening = schedules.definitions['vespertino']
+    assert sorted(schedules.audience(evening, pairing)) == ['1', '2', '3']
+    assert sorted(schedules.audience(evening, pairing, 'hogar')) == ['1', '2']
+
+
+def test_updates_only_reschedule_changed_jobs():
+    _, _, schedules = make_registries()
+    scheduler = AsyncScheduler()
+    schedules.attach(scheduler, lambda schedule: None)
+    for user in range(200):
+        schedules.update(str(user), 'matutino', hour=user // 60, minute=user % 60)
+    for update in range(1000):
+        schedules.update(str(update % 200), 'matutino', hour=(update * 7) % 24, minute=(update * 13) % 60)
+
+    assert set(scheduler.jobs) == {schedule.job_id for schedule in schedules.active()}
+    # Las entradas obsoletas del heap se compactan: no crecen con cada /horario
+    assert len(scheduler._heap) <= 2 * len(scheduler.jobs) + 64
+
+
+def test_seed_skips_existing_members():
+    state = MemoryStateStore()
+    pairing = PairingRegistry(state)
+    pairing.seed(bot.DEFAULT_GROUP_ID, [('1', 'esposo'), ('2', 'esposa')])
+    pairing.remove_member('2')
+
+    restarted = PairingRegistry(state)
+    restarted.load()
+    restarted.seed(bot.DEFAULT_GROUP_ID, [('1', 'esposo'), ('2', 'esposa')])
+    assert not restarted.is_authorized('2')
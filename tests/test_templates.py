@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pytz
+
+from bot_ubicacion import MessageTemplates
+
+SANTIAGO = pytz.timezone('America/Santiago')
+
+
+def test_date_uses_locale_weekday_names():
+    templates = MessageTemplates()
+    when = SANTIAGO.localize(datetime(2026, 10, 20, 8, 0))  # martes
+    assert templates.date('es', when) == "Mar 20/10 08:00"
+    assert templates.date('en', when) == "Tue 20/10 08:00"
+
+
+def test_next_transition_finds_dst_change():
+    templates = MessageTemplates()
+    now = datetime(2026, 8, 1, tzinfo=pytz.UTC).timestamp()
+    transition = templates._next_transition(now, SANTIAGO)
+    # Chile adelanta la hora la noche del 5 al 6 de septiembre de 2026 (04:00 UTC)
+    expected = datetime(2026, 9, 6, 4, tzinfo=pytz.UTC).timestamp()
+    assert expected <= transition <= expected + 1
+
+
+def test_next_transition_without_dst_checks_again_later():
+    templates = MessageTemplates()
+    now = datetime(2026, 8, 1, tzinfo=pytz.UTC).timestamp()
+    assert templates._next_transition(now, pytz.UTC) == now + MessageTemplates.TRANSITION_HORIZON
+
+
+def test_status_sections_are_localized():
+    templates = MessageTemplates()
+    text = templates.render('en', 'status_household', members=3)
+    assert text == "🏠 Household members: 3\n"